@@ -1,89 +1,98 @@
 import os
-from fastapi import FastAPI, Form, Request
-from fastapi.responses import HTMLResponse
+import hmac
+import html
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+from fastapi import FastAPI, Form, Header, HTTPException, Request
+from fastapi.responses import HTMLResponse, StreamingResponse
+import httpx
 import ollama
-from supabase import create_client, Client
 from dotenv import load_dotenv
+from storage import Storage, get_storage
+from product_snapshot import ProductSnapshot
+from product_search import product_key
+from answer_cache import AnswerCache
+from product_lookup import ProductLookup
 
 # Load environment variables
 load_dotenv()
 
-# Initialize FastAPI app
-app = FastAPI()
-
-# Get Supabase and Ollama credentials from environment variables
-SUPABASE_URL = os.environ.get("SUPABASE_URL")
-SUPABASE_KEY = os.environ.get("SUPABASE_KEY")
+# Get Ollama credentials from environment variables
 OLLAMA_API_KEY = os.environ.get("OLLAMA_API_KEY")
 OLLAMA_MODEL = os.environ.get("OLLAMA_MODEL", "gpt-oss:20b-cloud")
 PRODUCTS_TABLE_NAME = os.environ.get("PRODUCTS_TABLE_NAME", "products")
+# How many of the best-matching products are sent to the LLM with each question
+AGENT_TOP_K = int(os.environ.get("AGENT_TOP_K", "20"))
+# Required in the X-Admin-Token header of the /admin endpoints; without it they are disabled
+AGENT_ADMIN_TOKEN = os.environ.get("AGENT_ADMIN_TOKEN")
+# Questions answered by the LLM at once; more wait for a free slot
+AGENT_MAX_CONCURRENCY = int(os.environ.get("AGENT_MAX_CONCURRENCY", "8"))
+# Seconds a question may take, waiting for a slot included, before the answer is cut off
+AGENT_TIMEOUT = float(os.environ.get("AGENT_TIMEOUT", "120"))
+# Ollama embedding model used to match differently worded questions in the answer cache, if set
+ANSWER_CACHE_EMBED_MODEL = os.environ.get("ANSWER_CACHE_EMBED_MODEL")
+
+# Initialize the product storage (Supabase, or a local SQLite/Parquet store per STORAGE_BACKEND)
+storage: Storage = None
+try:
+    storage = get_storage()
+except (ValueError, ImportError) as e:
+    print(f"Product storage is not available: {e}")
+
+# The products and their search index, kept in memory and refreshed in the background
+# from the products written since the last refresh
+snapshot: ProductSnapshot = ProductSnapshot(storage, PRODUCTS_TABLE_NAME) if storage else None
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Loads the product snapshot before the first question and keeps it fresh while serving."""
+    if snapshot:
+        try:
+            await snapshot.refresh(full=True)
+            print(f"Loaded {len(snapshot.index)} products into the snapshot.")
+        except Exception as e:
+            print(f"Could not load the product snapshot, retrying in the background: {e}")
+        snapshot.start()
+    yield
+    if snapshot:
+        await snapshot.stop()
+    await client.close()
 
-# Initialize Supabase client
-supabase: Client = None
-if SUPABASE_URL and SUPABASE_KEY:
-    supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+
+# Initialize FastAPI app
+app = FastAPI(lifespan=lifespan)
 
 # Check for Ollama API key
 if not OLLAMA_API_KEY:
     raise ValueError("The OLLAMA_API_KEY environment variable must be set for Ollama Cloud.")
 
-# Initialize Ollama client for Cloud service
-client = ollama.Client(
+# Initialize Ollama client for Cloud service. It is async, so a slow answer does not hold
+# up other users, and shares one pool of kept-alive connections between all questions.
+client = ollama.AsyncClient(
     host="https://ollama.com",
-    headers={'Authorization': f'Bearer {OLLAMA_API_KEY}'}
+    headers={'Authorization': f'Bearer {OLLAMA_API_KEY}'},
+    timeout=httpx.Timeout(AGENT_TIMEOUT, connect=10.0),
+    limits=httpx.Limits(max_connections=AGENT_MAX_CONCURRENCY, max_keepalive_connections=AGENT_MAX_CONCURRENCY),
 )
+llm_slots = asyncio.Semaphore(AGENT_MAX_CONCURRENCY)
 
-# HTML for the web form
-html_form = """
-<!DOCTYPE html>
-<html>
-<head>
-    <title>AI Agent</title>
-</head>
-<body>
-    <h1>Ask the AI Agent</h1>
-    <form action="/" method="post">
-        <input type="text" name="question" style="width: 300px;" />
-        <button type="submit">Ask</button>
-    </form>
-    <h2>Answer:</h2>
-    <p>{response}</p>
-</body>
-</html>
-"""
-
-@app.get("/", response_class=HTMLResponse)
-async def read_root():
-    """Display the form."""
-    return html_form.format(response="")
+async def embed_question(text: str) -> list:
+    response = await client.embed(model=ANSWER_CACHE_EMBED_MODEL, input=text)
+    return response['embeddings'][0]
 
-@app.post("/", response_class=HTMLResponse)
-async def ask_agent(question: str = Form(...)):
-    """Handle the form submission and respond to the user's question."""
-    try:
-        # Check if Supabase client is initialized
-        if not supabase:
-            return html_form.format(response="Supabase client is not initialized. Please check your environment variables.")
+# Answers to questions asked before, dropped as soon as a product they depend on changes
+answer_cache = AnswerCache(embed=embed_question if ANSWER_CACHE_EMBED_MODEL else None)
+if snapshot:
+    snapshot.listeners.append(answer_cache.invalidate)
 
-        # Fetch product data from Supabase
-        response = supabase.table(PRODUCTS_TABLE_NAME).select("*").execute()
-        products = response.data
+# Name and price indexes over the snapshot, to answer lookups without the LLM
+product_lookup = ProductLookup(snapshot.index.products) if snapshot else None
+if snapshot:
+    snapshot.listeners.append(lambda keys, words: product_lookup.update(keys))
 
-        # Check if we got any products
-        if not products:
-            return html_form.format(response="No product data found in the database.")
-
-        # Prepare the context for the LLM
-        context = " ".join([f"Product: {p['name']}, Price: {p['price']}, Description: {p['description']}" for p in products])
-
-        # Create a prompt for the LLM
-        prompt = f"Context: {context}\\n\\n<customer_query>{question}</customer_query>"
-
-        # Get the response from the LLM
-        response = client.chat(
-            model=OLLAMA_MODEL,
-            messages=[
-                {"role": "system", "content": """You are Najjar Online's dedicated customer support AI agent. Your primary responsibility is to provide accurate and professional product information by querying the Supabase database and formatting responses appropriately.
+SYSTEM_PROMPT = """You are Najjar Online's dedicated customer support AI agent. Your primary responsibility is to provide accurate and professional product information by querying the Supabase database and formatting responses appropriately.
 
 INPUT:
 <customer_query>[[customer_query]]</customer_query>
@@ -150,17 +159,148 @@ Remember: Every response must be:
 - Clear and helpful
 - Accurate and complete
 
-Never provide information that hasn't been verified through the database. Always maintain a professional, helpful tone while ensuring accuracy and clarity in all communications.   Jump Logic/Success Prompt: When the response is relevant to the user's query, directly addresses their intent, or appropriately moves the conversation forward—such as by asking clarifying questions or requesting additional information—it should offer a clear, complete, and contextually appropriate resolution. If further action is required, the response includes timely and relevant follow-up such as next steps, useful links, or confirmations. Throughout the exchange, the assistant remains consistent with prior context, handles any limitations gracefully, and ensures that the user’s needs are met or clearly identifies what is required to proceed."""},
-                {"role": "user", "content": prompt}
-            ]
-        )
-        answer = response['message']['content']
+Never provide information that hasn't been verified through the database. Always maintain a professional, helpful tone while ensuring accuracy and clarity in all communications.   Jump Logic/Success Prompt: When the response is relevant to the user's query, directly addresses their intent, or appropriately moves the conversation forward—such as by asking clarifying questions or requesting additional information—it should offer a clear, complete, and contextually appropriate resolution. If further action is required, the response includes timely and relevant follow-up such as next steps, useful links, or confirmations. Throughout the exchange, the assistant remains consistent with prior context, handles any limitations gracefully, and ensures that the user’s needs are met or clearly identifies what is required to proceed."""
+
+# HTML for the web form
+html_form = """
+<!DOCTYPE html>
+<html>
+<head>
+    <title>AI Agent</title>
+</head>
+<body>
+    <h1>Ask the AI Agent</h1>
+    <form action="/" method="post">
+        <input type="text" name="question" style="width: 300px;" />
+        <button type="submit">Ask</button>
+    </form>
+    <h2>Answer:</h2>
+    <p style="white-space: pre-wrap;">{response}</p>
+</body>
+</html>
+"""
+# The form before and after the answer, to stream the answer in between
+form_head, form_tail = html_form.split("{response}")
+
+async def stream_answer(messages: list) -> AsyncIterator[str]:
+    """Yields the LLM's answer as it is generated, within AGENT_TIMEOUT and a free slot."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + AGENT_TIMEOUT
+    await asyncio.wait_for(llm_slots.acquire(), AGENT_TIMEOUT)
+    try:
+        parts = await asyncio.wait_for(client.chat(model=OLLAMA_MODEL, messages=messages, stream=True),
+                                       deadline - loop.time())
+        try:
+            while True:
+                try:
+                    part = await asyncio.wait_for(parts.__anext__(), deadline - loop.time())
+                except StopAsyncIteration:
+                    break
+                if part['message']['content']:
+                    yield part['message']['content']
+        finally:
+            # Also closes the connection's stream when the user goes away mid-answer
+            await parts.aclose()
+    finally:
+        llm_slots.release()
+
+async def stream_page(messages: list, question: str, keys: list) -> AsyncIterator[str]:
+    """
+    The answer page, sent in chunks so the browser shows the answer while it is written.
+    A complete answer is cached, unless the products changed while it was written.
+    """
+    version = snapshot.version
+    yield form_head
+    try:
+        answer = []
+        async for text in stream_answer(messages):
+            answer.append(text)
+            yield html.escape(text)
+        if snapshot.version == version:
+            await answer_cache.put(question, "".join(answer), keys)
+    except asyncio.TimeoutError:
+        yield "\n\n" + html.escape("Sorry, this is taking too long. Please try again in a moment.")
+    except Exception as e:
+        yield html.escape(f"An error occurred: {e}")
+    yield form_tail
+
+@app.get("/", response_class=HTMLResponse)
+async def read_root():
+    """Display the form."""
+    return html_form.format(response="")
+
+@app.post("/", response_class=HTMLResponse)
+async def ask_agent(question: str = Form(...)):
+    """Handle the form submission and respond to the user's question."""
+    try:
+        # Check if the product storage is initialized
+        if not snapshot:
+            return html_form.format(response="Product storage is not initialized. Please check your environment variables.")
+
+        # The products come from the in-memory snapshot, not from storage
+        product_index = await snapshot.get()
+
+        # Check if we got any products
+        if not len(product_index):
+            return html_form.format(response="No product data found in the database.")
+
+        # Lookups (a product's price, products in a price range, a name search) are
+        # answered straight from the indexes; everything else goes to the LLM
+        direct = product_lookup.answer(question)
+        if direct is not None:
+            return html_form.format(response=html.escape(direct))
+
+        # Questions asked before are answered without the LLM, while their products are unchanged
+        cached = await answer_cache.get(question)
+        if cached is not None:
+            return html_form.format(response=html.escape(cached))
 
-        return html_form.format(response=answer)
+        # Only the products that best match the question go to the LLM
+        matches = product_index.search(question, k=AGENT_TOP_K)
+
+        # Prepare the context for the LLM
+        context = " ".join([f"Product: {p['name']}, Price: {p['price']}, Description: {p['description']}" for p in matches]) \
+            or "No products in the database match this question."
+
+        # Create a prompt for the LLM
+        prompt = f"Context: {context}\\n\\n<customer_query>{question}</customer_query>"
+
+        # Stream the response from the LLM
+        messages = [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ]
+        keys = [product_key(p) for p in matches]
+        return StreamingResponse(stream_page(messages, question, keys), media_type="text/html",
+                                 headers={"X-Accel-Buffering": "no"})
 
     except Exception as e:
         return html_form.format(response=f"An error occurred: {e}")
 
+def check_admin_token(token: Optional[str]):
+    if not AGENT_ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="The admin endpoints are disabled; set AGENT_ADMIN_TOKEN to use them.")
+    if not token or not hmac.compare_digest(token.encode(), AGENT_ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Invalid admin token.")
+    if not snapshot:
+        raise HTTPException(status_code=503, detail="Product storage is not initialized.")
+
+@app.post("/admin/reload")
+async def reload_products(x_admin_token: Optional[str] = Header(None)):
+    """Reloads the whole products table into the snapshot now, e.g. right after an extract."""
+    check_admin_token(x_admin_token)
+    try:
+        changed = await snapshot.refresh(full=True)
+    except Exception as e:
+        raise HTTPException(status_code=502, detail=f"Could not reload the products: {e}")
+    return {"changed": len(changed), **snapshot.metrics()}
+
+@app.get("/admin/metrics")
+async def snapshot_metrics(x_admin_token: Optional[str] = Header(None)):
+    """Snapshot, lookup and answer cache counts, and how stale the served products are."""
+    check_admin_token(x_admin_token)
+    return {**snapshot.metrics(), "lookups": product_lookup.metrics(), "answer_cache": answer_cache.metrics()}
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8001)
\ No newline at end of file
@@ -0,0 +1,148 @@
+import os
+import re
+import math
+import time
+from collections import Counter, OrderedDict
+from typing import Awaitable, Callable, Iterable, List, Optional, Set
+
+from product_search import tokenize
+
+# Most answers kept, and how long an answer is served before the LLM is asked again (seconds)
+ANSWER_CACHE_SIZE = int(os.environ.get("ANSWER_CACHE_SIZE", "1000"))
+ANSWER_CACHE_TTL = float(os.environ.get("ANSWER_CACHE_TTL", "3600"))
+# Cosine similarity above which a differently worded question gets a cached answer, when
+# questions are embedded (ANSWER_CACHE_EMBED_MODEL in agent.py)
+ANSWER_CACHE_SIMILARITY = float(os.environ.get("ANSWER_CACHE_SIMILARITY", "0.95"))
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+_NUMBER_RE = re.compile(r"\d+(?:[.,]\d+)?")
+
+
+def normalize_question(question: str) -> str:
+    """The question in lowercase words only, so case, spacing and punctuation do not matter."""
+    return " ".join(_WORD_RE.findall(question.lower()))
+
+
+def _unit(vector: List[float]) -> List[float]:
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return [x / norm for x in vector]
+
+
+class _Entry:
+    __slots__ = ("answer", "expires", "keys", "words", "numbers", "embedding")
+
+    def __init__(self, answer: str, expires: float, keys: Set, words: Set[str], numbers: Set[str],
+                 embedding: Optional[List[float]]):
+        self.answer = answer
+        self.expires = expires
+        self.keys = keys
+        self.words = words
+        self.numbers = numbers
+        self.embedding = embedding
+
+
+class AnswerCache:
+    """
+    LLM answers to customer questions, by normalized question, with LRU and TTL eviction.
+
+    Each answer remembers the products it was given and the search words of its question.
+    `invalidate` drops the answers that used a changed product, and those whose question
+    shares a word with one, since the products it would be given may now be different.
+
+    With `embed` (an async function from text to a vector), a question that is not cached
+    word for word is matched to the most similar cached question, if their cosine similarity
+    is at least `similarity` and both name the same numbers, so "book 17" never gets the
+    answer for "book 18".
+    """
+
+    def __init__(self, max_entries: int = ANSWER_CACHE_SIZE, ttl: float = ANSWER_CACHE_TTL,
+                 embed: Optional[Callable[[str], Awaitable[List[float]]]] = None,
+                 similarity: float = ANSWER_CACHE_SIMILARITY):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.embed = embed
+        self.similarity = similarity
+        self.counts = Counter()
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        # Embeddings of recently asked questions, so an answer is stored without embedding again
+        self._embeddings: "OrderedDict[str, List[float]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    async def _embedding(self, text: str) -> Optional[List[float]]:
+        embedding = self._embeddings.get(text)
+        if embedding is None:
+            try:
+                embedding = _unit(await self.embed(text))
+            except Exception as e:
+                self.counts["embed_errors"] += 1
+                print(f"Could not embed the question for the answer cache: {e}")
+                return None
+            self._embeddings[text] = embedding
+            if len(self._embeddings) > self.max_entries:
+                self._embeddings.popitem(last=False)
+        return embedding
+
+    def _live(self, key: str, now: float) -> Optional[_Entry]:
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires <= now:
+            del self._entries[key]
+            self.counts["expired"] += 1
+            return None
+        return entry
+
+    async def get(self, question: str) -> Optional[str]:
+        """The cached answer to `question`, or None."""
+        text = normalize_question(question)
+        now = time.monotonic()
+        entry = self._live(text, now)
+        if entry is None and self.embed is not None and self._entries:
+            embedding = await self._embedding(text)
+            if embedding is not None:
+                numbers = set(_NUMBER_RE.findall(text))
+                best, best_score = None, self.similarity
+                for key, candidate in list(self._entries.items()):
+                    if candidate.embedding is None or candidate.numbers != numbers or not self._live(key, now):
+                        continue
+                    score = sum(a * b for a, b in zip(embedding, candidate.embedding))
+                    if score >= best_score:
+                        best, best_score = key, score
+                if best is not None:
+                    text, entry = best, self._entries[best]
+                    self.counts["similar_hits"] += 1
+        if entry is None:
+            self.counts["misses"] += 1
+            return None
+        self._entries.move_to_end(text)
+        self.counts["hits"] += 1
+        return entry.answer
+
+    async def put(self, question: str, answer: str, keys: Iterable):
+        """Caches `answer`, given the products with `keys`, for `question`."""
+        text = normalize_question(question)
+        embedding = await self._embedding(text) if self.embed is not None else None
+        self._entries[text] = _Entry(answer, time.monotonic() + self.ttl, set(keys), set(tokenize(text)),
+                                     set(_NUMBER_RE.findall(text)), embedding)
+        self._entries.move_to_end(text)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.counts["evicted"] += 1
+
+    def invalidate(self, keys: Set, words: Set[str]) -> int:
+        """Drops the answers that used any of the products `keys` or asked about any of `words`."""
+        stale = [text for text, entry in self._entries.items()
+                 if not entry.keys.isdisjoint(keys) or not entry.words.isdisjoint(words)]
+        for text in stale:
+            del self._entries[text]
+        self.counts["invalidated"] += len(stale)
+        return len(stale)
+
+    def metrics(self) -> dict:
+        lookups = self.counts["hits"] + self.counts["misses"]
+        return {
+            "answers": len(self._entries),
+            "hit_rate": round(self.counts["hits"] / lookups, 3) if lookups else None,
+            **{name: self.counts[name] for name in ("hits", "similar_hits", "misses", "expired", "evicted",
+                                                     "invalidated", "embed_errors")},
+        }
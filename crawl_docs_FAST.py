@@ -1,18 +1,15 @@
 import os
 import sys
-import psutil
+import time
 import asyncio
-import requests
-from xml.etree import ElementTree
-from supabase import create_client, Client
+import argparse
 from dotenv import load_dotenv
+from storage import Storage, get_storage
 
 load_dotenv()
 
-# Supabase connection details
-SUPABASE_URL = os.environ.get("SUPABASE_URL")
-SUPABASE_KEY = os.environ.get("SUPABASE_KEY")
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+# Pages are stored in Supabase, or locally when STORAGE_BACKEND is sqlite or parquet
+storage: Storage = get_storage()
 
 __location__ = os.path.dirname(os.path.abspath(__file__))
 __output__ = os.path.join(__location__, "output")
@@ -21,22 +18,110 @@ __output__ = os.path.join(__location__, "output")
 parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(parent_dir)
 
-from typing import List
+from collections import Counter
+from typing import List, Optional, Tuple
 from crawl4ai import AsyncWebCrawler, BrowserConfig, CrawlerRunConfig, CacheMode
+from memory_controller import MemoryAdaptiveController
+from sitemap_discovery import iter_sitemap_entries
+from page_cache import PAGE_CACHE_MAX_MB, PageCache, render_key
+from supabase_writer import SupabaseWriter
+from sharding import ShardOutput, run_sharded, shard_limits, shard_urls
+from politeness import MAX_RETRIES, THROTTLE_STATUSES, AdaptiveRateLimiter, backoff_delay
+from crawl4ai.markdown_generation_strategy import DefaultMarkdownGenerator
 
-async def crawl_parallel(urls: List[str], max_concurrent: int = 3):
-    print("\n=== Parallel Crawling with Browser Reuse + Memory Check ===")
+DOCS_CACHE_KEY = render_key(browser="docs", page_timeout=CrawlerRunConfig().page_timeout)
+
+def insert_pages(rows: List[dict]):
+    """Inserts a batch of crawled pages into the Data table in one request."""
+    storage.insert('Data', rows)
+
+async def crawl_stream(crawler: AsyncWebCrawler, urls: List[str], config: CrawlerRunConfig,
+                       controller: MemoryAdaptiveController, url_timeout: float = 120.0,
+                       rate_limiter: Optional[AdaptiveRateLimiter] = None):
+    """
+    Crawls URLs with a sliding window of pages in flight, sized by the memory
+    controller. A new crawl starts as soon as any slot frees up, and results are
+    yielded in completion order rather than input order.
+
+    With a `rate_limiter`, each request waits for its host's turn, and pages the host
+    answers with 429 or 503 are crawled again after a jittered backoff, up to
+    `MAX_RETRIES` times. Retries wait outside the window, so they do not hold up other
+    pages, and only their last result is yielded.
+
+    Yields:
+        Tuple[str, object, float]: The URL, its CrawlResult (or the exception raised,
+        including asyncio.TimeoutError) and the seconds the crawl took.
+    """
+    loop = asyncio.get_running_loop()
+    url_iter = iter(urls)
+    # Task -> (URL, attempt)
+    pending = {}
+
+    async def timed_crawl(url: str, delay: float = 0.0):
+        if delay:
+            await asyncio.sleep(delay)
+        async with controller.slot():
+            if rate_limiter is not None:
+                await rate_limiter.wait(url)
+            started = loop.time()
+            try:
+                result = await asyncio.wait_for(crawler.arun(url=url, config=config), timeout=url_timeout)
+            except Exception as e:
+                result = e
+            return result, loop.time() - started
+
+    def fill_slots():
+        # Tasks beyond the controller's current limit just wait for a slot
+        retrying = sum(1 for _, attempt in pending.values() if attempt)
+        while len(pending) - retrying < controller.max_concurrency:
+            url = next(url_iter, None)
+            if url is None:
+                return
+            pending[asyncio.create_task(timed_crawl(url))] = (url, 0)
 
-    # We'll keep track of peak memory usage across all tasks
-    peak_memory = 0
-    process = psutil.Process(os.getpid())
+    def throttled(url: str, result) -> bool:
+        if rate_limiter is None or isinstance(result, Exception):
+            return False
+        return rate_limiter.record(url, result.status_code, headers=result.response_headers)
 
-    def log_memory(prefix: str = ""):
-        nonlocal peak_memory
-        current_mem = process.memory_info().rss  # in bytes
-        if current_mem > peak_memory:
-            peak_memory = current_mem
-        print(f"{prefix} Current Memory: {current_mem // (1024 * 1024)} MB, Peak: {peak_memory // (1024 * 1024)} MB")
+    fill_slots()
+    try:
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            finished = []
+            for task in done:
+                url, attempt = pending.pop(task)
+                result, elapsed = task.result()
+                if throttled(url, result) and attempt < MAX_RETRIES:
+                    retry = asyncio.create_task(timed_crawl(url, backoff_delay(attempt + 1)))
+                    pending[retry] = (url, attempt + 1)
+                    continue
+                finished.append((url, result, elapsed))
+            # Refill before handing results out so slots never sit idle while the caller works
+            fill_slots()
+            for item in finished:
+                yield item
+    finally:
+        for task in pending:
+            task.cancel()
+
+async def crawl_parallel(urls: List[str], max_concurrent: Optional[int] = None, memory_limit_mb: Optional[int] = None,
+                         url_timeout: float = 120.0, shard: Optional[Tuple[int, int]] = None,
+                         output: Optional[ShardOutput] = None, rate_limit: float = 0.0):
+    """
+    Crawls `urls` and stores their markdown, sending each host at most `rate_limit`
+    requests per second (0 for no limit until it answers 429 or 503). In a worker process
+    of `crawl_sharded`, only the worker's share of the URLs is crawled and pages go to
+    `output` instead.
+    """
+    print("\n=== Parallel Crawling with Browser Reuse + Memory Check ===")
+    if shard is not None:
+        urls = shard_urls(urls, *shard)
+        print(f"Worker {shard[0]}: {len(urls)} URLs to crawl")
+
+    # Concurrency follows memory usage (including Chromium) up to max_concurrent
+    controller = MemoryAdaptiveController(memory_limit_mb=memory_limit_mb, max_concurrency=max_concurrent)
+    log_memory = controller.log_memory
 
     # Minimal browser config
     browser_config = BrowserConfig(
@@ -46,90 +131,181 @@ async def crawl_parallel(urls: List[str], max_concurrent: int = 3):
     )
     crawl_config = CrawlerRunConfig(cache_mode=CacheMode.BYPASS)
 
+    # Rendered pages are kept in the local page cache so markdown can be rebuilt offline
+    page_cache = PageCache() if PAGE_CACHE_MAX_MB > 0 else None
+    rate_limiter = AdaptiveRateLimiter(rate_limit)
+
     # Create the crawler instance
     crawler = AsyncWebCrawler(config=browser_config)
     await crawler.start()
+    await controller.start()
+
+    # Pages are inserted in batches by a background writer instead of one request per page;
+    # worker processes send them to the parent's writer instead
+    writer = SupabaseWriter(insert_pages, label="pages") if output is None else None
 
     try:
-        # We'll chunk the URLs in batches of 'max_concurrent'
         success_count = 0
         fail_count = 0
-        for i in range(0, len(urls), max_concurrent):
-            batch = urls[i : i + max_concurrent]
-            tasks = []
-
-            for j, url in enumerate(batch):
-                # Unique session_id per concurrent sub-task
-                session_id = f"parallel_session_{i + j}"
-                task = crawler.arun(url=url, config=crawl_config, session_id=session_id)
-                tasks.append(task)
-
-            # Check memory usage prior to launching tasks
-            log_memory(prefix=f"Before batch {i//max_concurrent + 1}: ")
-
-            # Gather results
-            results = await asyncio.gather(*tasks, return_exceptions=True)
-
-            # Check memory usage after tasks complete
-            log_memory(prefix=f"After batch {i//max_concurrent + 1}: ")
-
-            # Evaluate results
-            for url, result in zip(batch, results):
-                if isinstance(result, Exception):
-                    print(f"Error crawling {url}: {result}")
-                    fail_count += 1
-                elif result.success:
-                    success_count += 1
-                    # Store the result in Supabase
+        busy_time = 0.0
+        started = time.perf_counter()
+
+        # Check memory usage prior to launching tasks
+        log_memory(prefix="Before crawl: ")
+
+        done_count = 0
+        async for url, result, elapsed in crawl_stream(crawler, urls, crawl_config, controller, url_timeout, rate_limiter):
+            done_count += 1
+            busy_time += elapsed
+
+            # Evaluate results as they stream in
+            if isinstance(result, asyncio.TimeoutError):
+                print(f"Timed out crawling {url} after {url_timeout:.0f}s")
+                fail_count += 1
+            elif isinstance(result, Exception):
+                print(f"Error crawling {url}: {result}")
+                fail_count += 1
+            elif result.status_code in THROTTLE_STATUSES:
+                print(f"Giving up on {url} after {MAX_RETRIES + 1} attempts: HTTP status {result.status_code}")
+                fail_count += 1
+            elif result.success:
+                success_count += 1
+                if page_cache is not None and result.html:
                     try:
-                        data, count = supabase.table('Data').insert({"url": url, "content": result.markdown}).execute()
+                        await asyncio.to_thread(page_cache.put, url, DOCS_CACHE_KEY, result.html)
                     except Exception as e:
-                        print(f"Error inserting data for {url}: {e}")
-                else:
-                    fail_count += 1
+                        print(f"Could not cache {url}: {e}")
+                # Store the result in Supabase
+                await (output or writer).put({"url": url, "content": result.markdown})
+            else:
+                fail_count += 1
 
+            # Check memory usage once per window's worth of pages
+            if done_count % controller.max_concurrency == 0:
+                log_memory(prefix=f"After {done_count}/{len(urls)} pages: ")
+
+        if writer is not None:
+            await writer.close()
+        wall_time = time.perf_counter() - started
+        if output is not None:
+            # The parent prints one summary for all workers
+            await output.close(Counter(success=success_count, failed=fail_count, busy_time=busy_time,
+                                       slot_time=wall_time * controller.max_concurrency,
+                                       throttled=sum(rate_limiter.throttled.values())))
+            return
         print(f"\nSummary:")
         print(f"  - Successfully crawled: {success_count}")
         print(f"  - Failed: {fail_count}")
+        rate_limiter.print_stats()
+        if wall_time > 0:
+            print(f"  - Slot utilization: {busy_time / (wall_time * controller.max_concurrency):.0%} of {controller.max_concurrency} slots over {wall_time:.1f}s")
+        writer.print_stats()
 
     finally:
         print("\nClosing crawler...")
+        if writer is not None:
+            await writer.close()
+        await controller.stop()
         await crawler.close()
+        if page_cache is not None:
+            page_cache.close()
         # Final memory log
         log_memory(prefix="Final: ")
-        print(f"\nPeak memory usage (MB): {peak_memory // (1024 * 1024)}")
+        print(f"\nPeak memory usage (MB): {controller.peak_memory // (1024 * 1024)}")
 
-def get_pydantic_ai_docs_urls():
+async def crawl_sharded(urls: List[str], workers: int, max_concurrent: Optional[int] = None,
+                        memory_limit_mb: Optional[int] = None, rate_limit: float = 0.0):
+    """Splits `urls` between `workers` processes, each with its own browser, and stores pages from one writer here."""
+    print(f"\n=== Crawling with {workers} Worker Processes ===")
+    writer = SupabaseWriter(insert_pages, label="pages")
+    started = time.perf_counter()
+    try:
+        stats = await run_sharded(crawl_parallel, workers, writer, urls=urls, max_concurrent=max_concurrent,
+                                  **shard_limits(workers, rate_limit, memory_limit_mb))
+        await writer.close()
+        wall_time = time.perf_counter() - started
+        print(f"\nSummary:")
+        print(f"  - Successfully crawled: {stats['success']}")
+        print(f"  - Failed: {stats['failed']}")
+        if stats['throttled']:
+            print(f"  - Throttled with 429/503, retried with backoff: {stats['throttled']}")
+        if stats['failed_workers']:
+            print(f"  - Workers that failed: {stats['failed_workers']}")
+        if stats['slot_time'] > 0:
+            print(f"  - Slot utilization: {stats['busy_time'] / stats['slot_time']:.0%} across {workers} workers")
+        print(f"  - Throughput: {len(urls) / wall_time if wall_time else 0:.2f} pages/s over {wall_time:.1f}s")
+        writer.print_stats()
+    finally:
+        await writer.close()
+
+async def get_pydantic_ai_docs_urls():
     """
     Fetches all URLs from the Pydantic AI documentation.
     Uses the sitemap (https://www.antoineonline.com/media/sitemap/sitemap_intr_en.xml) to get these URLs.
-    
+    Sitemap indexes and gzipped sitemaps are followed, and each file is parsed
+    incrementally instead of being loaded into memory whole.
+
     Returns:
         List[str]: List of URLs
-    """            
+    """
     sitemap_url = "https://www.antoineonline.com/media/sitemap/sitemap_intr_en.xml"
     try:
-        response = requests.get(sitemap_url)
-        response.raise_for_status()
-        
-        # Parse the XML
-        root = ElementTree.fromstring(response.content)
-        
-        # Extract all URLs from the sitemap
-        # The namespace is usually defined in the root element
-        namespace = {'ns': 'http://www.sitemaps.org/schemas/sitemap/0.9'}
-        urls = [loc.text for loc in root.findall('.//ns:loc', namespace)]
-        
-        return urls
+        return [entry.loc async for entry in iter_sitemap_entries([sitemap_url])]
     except Exception as e:
         print(f"Error fetching sitemap: {e}")
-        return []        
+        return []
+
+async def store_from_cache():
+    """Rebuilds markdown for every cached page and stores it, without crawling."""
+    print("\n=== Storing Markdown from the Local Page Cache ===")
+    page_cache = PageCache()
+    markdown_generator = DefaultMarkdownGenerator()
+    writer = SupabaseWriter(insert_pages, label="pages")
+    fail_count = 0
+    try:
+        for url in page_cache.iter_urls(DOCS_CACHE_KEY):
+            html = page_cache.get(url, DOCS_CACHE_KEY)
+            if html is None:
+                continue
+            try:
+                markdown = markdown_generator.generate_markdown(input_html=html, base_url=url).raw_markdown
+            except Exception as e:
+                print(f"Error rebuilding markdown for cached page {url}: {e}")
+                fail_count += 1
+                continue
+            await writer.put({"url": url, "content": markdown})
+
+        await writer.close()
+        print(f"\nSummary:")
+        print(f"  - Stored from cache: {writer.written}")
+        print(f"  - Failed: {fail_count + writer.failed}")
+    finally:
+        await writer.close()
+        page_cache.close()
 
 async def main():
-    urls = get_pydantic_ai_docs_urls()
+    parser = argparse.ArgumentParser(description="Crawl the documentation sitemap into Supabase.")
+    parser.add_argument("--from-cache", action="store_true", help="Rebuild and store markdown from the local page cache instead of crawling.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Worker processes to split the URLs between, each with its own browser.")
+    parser.add_argument("--rate-limit", type=float, default=0.0,
+                        help="Maximum requests per second per host, 0 for no limit until a host answers 429 or 503.")
+    args = parser.parse_args()
+
+    if args.from_cache and args.workers > 1:
+        print("Error: --from-cache reads the local page cache in one process and cannot be combined with --workers.")
+        return
+    if args.from_cache:
+        await store_from_cache()
+        return
+
+    urls = await get_pydantic_ai_docs_urls()
     if urls:
         print(f"Found {len(urls)} URLs to crawl")
-        await crawl_parallel(urls, max_concurrent=10)
+        if args.workers > 1:
+            await crawl_sharded(urls, args.workers, rate_limit=args.rate_limit)
+        else:
+            await crawl_parallel(urls, rate_limit=args.rate_limit)
     else:
         print("No URLs found to crawl")    
 
@@ -0,0 +1,189 @@
+import json
+import sqlite3
+import time
+from hashlib import sha256
+from collections import Counter
+from typing import Dict, Iterable, NamedTuple, Optional, Tuple
+
+from sitemap_discovery import parse_lastmod
+from url_utils import canonicalize_url, url_fingerprint
+
+
+class PageState(NamedTuple):
+    url: str
+    etag: Optional[str]
+    last_modified: Optional[str]
+    sitemap_lastmod: Optional[str]
+    content_hash: Optional[str]
+    last_crawled: Optional[float]
+    fetch_tier: Optional[str] = None
+
+
+# Fields that say which product a row is, not what it contains
+IDENTITY_FIELDS = ("url", "sku")
+
+
+def content_hash(product: Dict) -> str:
+    """
+    Stable hash of an extracted product's content, independent of key order. Identity
+    fields are left out, so the same product found under a second URL hashes the same.
+    """
+    content = {name: value for name, value in product.items() if name not in IDENTITY_FIELDS}
+    return sha256(json.dumps(content, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def dedup_key(product: Dict) -> str:
+    """The identity of a product: its SKU when one was extracted, otherwise its canonical URL."""
+    sku = product.get("sku")
+    if sku:
+        return f"sku:{str(sku).strip()}"
+    return canonicalize_url(product["url"])
+
+
+class DedupIndex:
+    """
+    Run-wide index of the products seen so far, used to avoid sending the same row twice.
+
+    Each product is classified against what this run has already seen and, when given,
+    the content hash stored by the previous run:
+
+    - "new": first seen, with no previous hash
+    - "changed": the content differs from the previous run, or a page seen earlier in
+      this run without a SKU was extracted again with different content
+    - "unchanged": first seen this run, with the same content as the previous run
+    - "duplicate": already seen this run with the same content, or a SKU already seen
+      this run, whichever page it was found on; the first copy is the one kept
+
+    Keys and hashes are kept as 64-bit integers, so a million products take tens of MB.
+    """
+
+    NEW = "new"
+    CHANGED = "changed"
+    UNCHANGED = "unchanged"
+    DUPLICATE = "duplicate"
+
+    def __init__(self):
+        self._hashes: Dict[int, int] = {}
+        self.counts = Counter()
+
+    def classify(self, product: Dict, product_hash: str, previous_hash: Optional[str] = None) -> str:
+        fingerprint = url_fingerprint(dedup_key(product))
+        short_hash = int(product_hash[:16], 16)
+        seen = self._hashes.get(fingerprint)
+        if seen is not None and (seen == short_hash or product.get("sku")):
+            # The first copy of a SKU is kept; without one the key is the page itself, and a
+            # later extraction of it is the newer one
+            self.counts[self.DUPLICATE] += 1
+            return self.DUPLICATE
+        self._hashes[fingerprint] = short_hash
+        if seen is not None:
+            outcome = self.CHANGED
+        elif previous_hash is None:
+            outcome = self.NEW
+        else:
+            outcome = self.UNCHANGED if previous_hash == product_hash else self.CHANGED
+        self.counts[outcome] += 1
+        return outcome
+
+    def print_stats(self):
+        print(f"  - New: {self.counts[self.NEW]}, changed: {self.counts[self.CHANGED]}, "
+              f"unchanged: {self.counts[self.UNCHANGED]}, duplicates in this run: {self.counts[self.DUPLICATE]}")
+
+
+class CrawlState:
+    """
+    Per-URL record of what the last extract run saw, used to skip unchanged pages.
+
+    For each product URL this keeps the HTTP validators (ETag and Last-Modified), the
+    sitemap lastmod written by `discover --sitemap`, a hash of the extracted product, when
+    it was last crawled and which fetch tier (HTTP or browser) served it. Crawl updates are
+    buffered and written by `flush()`.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        # Worker processes of a sharded run share the file, so wait for the write lock rather than failing
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS pages (
+                url TEXT PRIMARY KEY,
+                etag TEXT,
+                last_modified TEXT,
+                sitemap_lastmod TEXT,
+                content_hash TEXT,
+                last_crawled REAL,
+                fetch_tier TEXT
+            )
+        """)
+        try:
+            self.conn.execute("ALTER TABLE pages ADD COLUMN fetch_tier TEXT")
+        except sqlite3.OperationalError:
+            pass  # already there, or the table was just created with it
+        self.conn.commit()
+        self._pending = []
+
+    def get(self, url: str) -> Optional[PageState]:
+        row = self.conn.execute(
+            "SELECT url, etag, last_modified, sitemap_lastmod, content_hash, last_crawled, fetch_tier FROM pages WHERE url = ?",
+            (url,),
+        ).fetchone()
+        return PageState(*row) if row else None
+
+    def record_sitemap_lastmods(self, entries: Iterable[Tuple[str, Optional[str]]]):
+        with self.conn:
+            self.conn.executemany("""
+                INSERT INTO pages (url, sitemap_lastmod) VALUES (?, ?)
+                ON CONFLICT (url) DO UPDATE SET sitemap_lastmod = excluded.sitemap_lastmod
+            """, entries)
+
+    def record_crawl(self, url: str, etag: Optional[str] = None, last_modified: Optional[str] = None,
+                     product_hash: Optional[str] = None, tier: Optional[str] = None):
+        """Buffers the outcome of fetching `url`; validators, hash and tier are only replaced when given."""
+        self._pending.append((url, etag, last_modified, product_hash, time.time(), tier))
+
+    def flush(self):
+        if not self._pending:
+            return
+        with self.conn:
+            self.conn.executemany("""
+                INSERT INTO pages (url, etag, last_modified, content_hash, last_crawled, fetch_tier) VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (url) DO UPDATE SET
+                    etag = COALESCE(excluded.etag, etag),
+                    last_modified = COALESCE(excluded.last_modified, last_modified),
+                    content_hash = COALESCE(excluded.content_hash, content_hash),
+                    last_crawled = excluded.last_crawled,
+                    fetch_tier = COALESCE(excluded.fetch_tier, fetch_tier)
+            """, self._pending)
+        self._pending = []
+
+    def close(self):
+        # Unflushed updates are dropped on purpose: they are only flushed once the
+        # products they describe have been stored
+        self.conn.close()
+
+
+def unchanged_since_last_crawl(state: Optional[PageState]) -> bool:
+    """True if the sitemap says the page has not been modified since we last crawled it."""
+    if state is None or state.last_crawled is None:
+        return False
+    lastmod = parse_lastmod(state.sitemap_lastmod)
+    if lastmod is None:
+        return False
+    modified_at = lastmod.timestamp()
+    if "T" not in state.sitemap_lastmod:
+        # A bare date could mean any time that day
+        modified_at += 24 * 60 * 60
+    return modified_at <= state.last_crawled
+
+
+def conditional_headers(state: Optional[PageState]) -> Dict[str, str]:
+    """If-None-Match / If-Modified-Since headers for a cheap revalidation request."""
+    headers = {}
+    if state is not None:
+        if state.etag:
+            headers["If-None-Match"] = state.etag
+        if state.last_modified:
+            headers["If-Modified-Since"] = state.last_modified
+    return headers
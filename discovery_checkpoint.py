@@ -0,0 +1,72 @@
+import sqlite3
+from typing import Iterable, Iterator, List, Tuple
+
+
+class DiscoveryCheckpoint:
+    """
+    On-disk state of a discovery crawl, so a crashed or interrupted run can be resumed.
+
+    Every URL ever queued is a row in `pages`: `visited = 0` rows are the frontier and
+    `visited = 1` rows have already been fetched. Product URLs found so far live in
+    `product_urls`. Callers buffer their progress and hand it over in `save()`, which
+    writes it in a single transaction.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS pages (
+                url TEXT PRIMARY KEY,
+                depth INTEGER NOT NULL,
+                visited INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS pages_frontier ON pages (visited, depth);
+            CREATE TABLE IF NOT EXISTS product_urls (url TEXT PRIMARY KEY);
+        """)
+        self.conn.commit()
+
+    def reset(self, start_url: str):
+        """Clears any previous run and seeds the frontier with `start_url`."""
+        with self.conn:
+            self.conn.execute("DELETE FROM meta")
+            self.conn.execute("DELETE FROM pages")
+            self.conn.execute("DELETE FROM product_urls")
+            self.conn.execute("INSERT INTO meta (key, value) VALUES ('start_url', ?)", (start_url,))
+            self.conn.execute("INSERT INTO pages (url, depth) VALUES (?, 0)", (start_url,))
+
+    @property
+    def start_url(self):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'start_url'").fetchone()
+        return row[0] if row else None
+
+    def frontier(self) -> List[Tuple[str, int]]:
+        """Queued but not yet visited pages, in BFS order."""
+        return self.conn.execute("SELECT url, depth FROM pages WHERE visited = 0 ORDER BY depth, rowid").fetchall()
+
+    def iter_seen_urls(self) -> Iterator[str]:
+        for (url,) in self.conn.execute("SELECT url FROM pages"):
+            yield url
+
+    def visited_count(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM pages WHERE visited = 1").fetchone()[0]
+
+    def product_count(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM product_urls").fetchone()[0]
+
+    def iter_product_urls(self) -> Iterator[str]:
+        for (url,) in self.conn.execute("SELECT url FROM product_urls ORDER BY rowid"):
+            yield url
+
+    def save(self, visited: Iterable[str], queued: Iterable[Tuple[str, int]], products: Iterable[str]):
+        """Persists a batch of progress atomically."""
+        with self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO pages (url, depth) VALUES (?, ?)", queued)
+            self.conn.executemany("UPDATE pages SET visited = 1 WHERE url = ?", ((url,) for url in visited))
+            self.conn.executemany("INSERT OR IGNORE INTO product_urls (url) VALUES (?)", ((url,) for url in products))
+
+    def close(self):
+        self.conn.close()
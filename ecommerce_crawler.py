@@ -1,26 +1,28 @@
 import os
+import re
 import sys
-import psutil
 import asyncio
 import json
+import time
 import argparse
-from supabase import create_client, Client
+import requests
+from itertools import islice
 from dotenv import load_dotenv
-from pydantic import BaseModel, Field, ValidationError
-from typing import Optional, List
+from pydantic import ValidationError
+from collections import Counter
+from typing import Iterable, Optional, List, Tuple
+from storage import Storage, get_storage
 
 load_dotenv()
 
-# Supabase connection details
-SUPABASE_URL = os.environ.get("SUPABASE_URL")
-SUPABASE_KEY = os.environ.get("SUPABASE_KEY")
-supabase: Client = None
+# Products are stored in Supabase, or locally when STORAGE_BACKEND is sqlite or parquet
+storage: Storage = None
 
-def get_supabase_client():
-    global supabase
-    if supabase is None:
-        supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
-    return supabase
+def get_storage_backend() -> Storage:
+    global storage
+    if storage is None:
+        storage = get_storage()
+    return storage
 
 # E-commerce target URL
 ECOMMERCE_TARGET_URL = os.environ.get("ECOMMERCE_TARGET_URL")
@@ -31,7 +33,28 @@ CSS_SELECTOR_NAME = os.environ.get("CSS_SELECTOR_NAME", "h1.title, .product-titl
 CSS_SELECTOR_PRICE = os.environ.get("CSS_SELECTOR_PRICE", "div.product-price, .product-price-container")
 CSS_SELECTOR_DESCRIPTION = os.environ.get("CSS_SELECTOR_DESCRIPTION", "div.description, .product-description")
 CSS_SELECTOR_IMAGE_URL = os.environ.get("CSS_SELECTOR_IMAGE_URL", "div.main-image img, .product-gallery-preview img, .main-image-container img")
+# Optional: when set, products are de-duplicated on the SKU instead of the URL
+CSS_SELECTOR_SKU = os.environ.get("CSS_SELECTOR_SKU", "")
+# Listing mode: one block per product on category pages, its link, and the next-page link
+LISTING_URLS = os.environ.get("LISTING_URLS", "")
+LISTING_SELECTOR_BASE = os.environ.get("LISTING_SELECTOR_BASE", ".product-item, .product-card")
+LISTING_SELECTOR_NAME = os.environ.get("LISTING_SELECTOR_NAME", ".product-item-link, .product-name, .product-title")
+LISTING_SELECTOR_PRICE = os.environ.get("LISTING_SELECTOR_PRICE", ".price")
+LISTING_SELECTOR_DESCRIPTION = os.environ.get("LISTING_SELECTOR_DESCRIPTION", "")
+LISTING_SELECTOR_IMAGE_URL = os.environ.get("LISTING_SELECTOR_IMAGE_URL", "img")
+LISTING_SELECTOR_LINK = os.environ.get("LISTING_SELECTOR_LINK", "a")
+LISTING_SELECTOR_NEXT_PAGE = os.environ.get("LISTING_SELECTOR_NEXT_PAGE", "a.next, a[rel=next], .pages-item-next a")
+MAX_LISTING_PAGES = int(os.environ.get("MAX_LISTING_PAGES", "10000"))
 URLS_FILE = "product_urls.txt"
+# Pages extracted at once when --concurrency is not given: one at a time, as extract always
+# has, so a run never hits a store harder than asked for. MAX_CONCURRENCY is not used here.
+EXTRACT_CONCURRENCY = 1
+URL_READ_CHUNK = 1000  # URLs read from the URL file per hop to a worker thread
+CHECKPOINT_FILE = "discovery_checkpoint.db"
+CRAWL_STATE_FILE = "crawl_state.db"
+CHECKPOINT_INTERVAL = 30  # seconds between discovery checkpoints
+MAX_DISCOVERY_DEPTH = 10  # Limit depth to 10 to avoid infinite loops, but still get deep enough
+MAX_DISCOVERY_PAGES = 1100000
 
 __location__ = os.path.dirname(os.path.abspath(__file__))
 __output__ = os.path.join(__location__, "output")
@@ -41,29 +64,42 @@ parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(parent_dir)
 
 from crawl4ai import AsyncWebCrawler, BrowserConfig, CrawlerRunConfig, CacheMode, JsonCssExtractionStrategy
-from crawl4ai.deep_crawling import BFSDeepCrawlStrategy
 from crawl4ai.deep_crawling.filters import FilterChain, URLPatternFilter
+from memory_controller import MemoryAdaptiveController
+from url_classifier import ProductURLClassifier, ProductURLFilter
+from discovery_checkpoint import DiscoveryCheckpoint
+from url_utils import FingerprintSet, canonicalize_url, iter_urls
+from sitemap_discovery import find_sitemaps, iter_sitemap_entries
+from crawl_state import CrawlState, DedupIndex, conditional_headers, content_hash, unchanged_since_last_crawl
+from page_cache import PAGE_CACHE_MAX_MB, PageCache, render_key
+from static_fetch import HTTP_USER_AGENT, StaticFetcher, has_required_fields
+from supabase_writer import SupabaseWriter, WRITE_BATCH_SIZE
+from normalize import normalize_products
+from sharding import ShardOutput, run_sharded, shard_limits, shard_of
+from work_queue import QUEUE_LEASE_SECONDS, WORK_QUEUE_FILE, LeaseClient, WorkQueue
+from politeness import MAX_RETRIES, AdaptiveRateLimiter, Throttled, backoff_delay, requeue_later
+from render_profile import RENDER_PROFILE, RENDER_PROFILES, RenderProfile, print_render_stats, wait_for_fields
 
-# Pydantic model for product data extraction
-class Product(BaseModel):
-    name: str = Field(..., description="The name of the product")
-    price: float = Field(..., description="The price of the product")
-    description: Optional[str] = Field(None, description="The description of the product")
-    image_url: Optional[str] = Field(None, description="The URL of the product image")
+def validate_product(product_data: dict, url: str) -> dict:
+    """Normalizes and validates one product as it streams in; raises ValueError if it is invalid."""
+    products, errors = normalize_products([product_data], [canonicalize_url(url)], with_sku=bool(CSS_SELECTOR_SKU))
+    if errors:
+        raise ValueError(errors[0][1])
+    return products[0]
 
-async def discover_product_urls():
-    print("\n=== Discovering Product URLs ===")
+def upsert_products(products: List[dict]) -> int:
+    """Upserts a batch of validated products on their canonical URL and returns how many rows were sent."""
+    # A product that changed twice in one run may appear twice; the later version wins
+    unique_products = list({p['url']: p for p in products}.values())
+    return get_storage_backend().upsert(PRODUCTS_TABLE_NAME, unique_products, on_conflict='url')
 
-    # We'll keep track of peak memory usage across all tasks
-    peak_memory = 0
-    process = psutil.Process(os.getpid())
+async def discover_product_urls(max_concurrent: Optional[int] = None, memory_limit_mb: Optional[int] = None,
+                                resume: bool = False, rate_limit: float = 0.0):
+    print("\n=== Discovering Product URLs ===")
 
-    def log_memory(prefix: str = ""):
-        nonlocal peak_memory
-        current_mem = process.memory_info().rss  # in bytes
-        if current_mem > peak_memory:
-            peak_memory = current_mem
-        print(f"{prefix} Current Memory: {current_mem // (1024 * 1024)} MB, Peak: {peak_memory // (1024 * 1024)} MB")
+    # We'll keep track of peak memory usage and pace the crawl to stay under the ceiling
+    controller = MemoryAdaptiveController(memory_limit_mb=memory_limit_mb, max_concurrency=max_concurrent)
+    log_memory = controller.log_memory
 
     # Minimal browser config
     browser_config = BrowserConfig(
@@ -72,77 +108,333 @@ async def discover_product_urls():
         extra_args=["--disable-gpu", "--disable-dev-shm-usage", "--no-sandbox"],
     )
 
-    # URL filtering to focus on valid HTTP/HTTPS links
+    # URL filtering to focus on valid HTTP/HTTPS links, pruning assets and
+    # filter/facet variants before they are fetched
+    classifier = ProductURLClassifier(include=PRODUCT_URL_PATTERN)
     filter_chain = FilterChain([
         URLPatternFilter(
-            patterns=["http://*", "https://*"],
-        )
+            # A compiled pattern is matched against the full URL; "http://*" globs are
+            # treated as path prefixes by newer crawl4ai releases and match nothing
+            patterns=[re.compile(r"^https?://")],
+        ),
+        ProductURLFilter(classifier),
     ])
 
-    # Deep crawling strategy
-    deep_crawl_strategy = BFSDeepCrawlStrategy(
-        max_depth=10,  # Limit depth to 10 to avoid infinite loops, but still get deep enough
-        max_pages=1100000,
-        include_external=False,
-        filter_chain=filter_chain,
-    )
-
     crawl_config = CrawlerRunConfig(
         cache_mode=CacheMode.BYPASS,
-        deep_crawl_strategy=deep_crawl_strategy,
-        stream=True,
         page_timeout=120000,
     )
 
+    # The BFS frontier, visited pages and product URLs all live in the checkpoint
+    # store, so an interrupted crawl can pick up where it left off
+    checkpoint = DiscoveryCheckpoint(CHECKPOINT_FILE)
+    if resume and checkpoint.start_url:
+        frontier = checkpoint.frontier()
+        seen_urls = FingerprintSet(checkpoint.iter_seen_urls())
+        pages_crawled = checkpoint.visited_count()
+        print(f"Resuming from {CHECKPOINT_FILE}: {pages_crawled} pages visited, {len(frontier)} queued, "
+              f"{checkpoint.product_count()} product URLs found so far.")
+    else:
+        if resume:
+            print(f"No checkpoint found in {CHECKPOINT_FILE}, starting a new crawl.")
+        start_url = canonicalize_url(ECOMMERCE_TARGET_URL)
+        checkpoint.reset(start_url)
+        frontier = [(start_url, 0)]
+        seen_urls = FingerprintSet([start_url])
+        pages_crawled = 0
+
+    url_queue = asyncio.Queue()
+    for item in frontier:
+        url_queue.put_nowait(item)
+
+    # Throttled pages stay in the frontier and are put back after a backoff
+    rate_limiter = AdaptiveRateLimiter(rate_limit)
+    retry_tasks = set()
+    throttled_attempts = {}
+
+    # Progress made since the last checkpoint
+    visited_buffer, queued_buffer, product_buffer = [], [], []
+
+    def save_checkpoint():
+        nonlocal visited_buffer, queued_buffer, product_buffer
+        checkpoint.save(visited_buffer, queued_buffer, product_buffer)
+        visited_buffer, queued_buffer, product_buffer = [], [], []
+
+    async def checkpoint_loop():
+        while True:
+            await asyncio.sleep(CHECKPOINT_INTERVAL)
+            save_checkpoint()
+            print(f"Checkpoint saved: {pages_crawled} pages visited, {url_queue.qsize()} queued.")
+
+    async def handle_result(url: str, depth: int, result):
+        if not result.success:
+            return
+
+        # Include/exclude patterns and image links are all handled by the classifier
+        if classifier.is_product(result.url):
+            product_buffer.append(canonicalize_url(result.url))
+
+        # Queue the next BFS level, staying on the same site
+        if depth >= MAX_DISCOVERY_DEPTH:
+            return
+        for link in result.links.get("internal", []):
+            href = link.get("href")
+            if not href:
+                continue
+            link_url = canonicalize_url(href, base=url)
+            if link_url in seen_urls or not await filter_chain.apply(link_url):
+                continue
+            seen_urls.add(link_url)
+            queued_buffer.append((link_url, depth + 1))
+            url_queue.put_nowait((link_url, depth + 1))
+
+    async def worker():
+        nonlocal pages_crawled
+        while True:
+            url, depth = await url_queue.get()
+            requeued = False
+            try:
+                # Past the page budget the rest of the queue is just drained
+                if pages_crawled >= MAX_DISCOVERY_PAGES:
+                    continue
+                pages_crawled += 1
+                async with controller.slot():
+                    await rate_limiter.wait(url)
+                    try:
+                        result = await crawler.arun(url=url, config=crawl_config)
+                    except Exception as e:
+                        print(f"Error crawling {url}: {e}")
+                        result = None
+                if result is not None and rate_limiter.record(url, result.status_code, headers=result.response_headers):
+                    attempt = throttled_attempts.get(url, 0) + 1
+                    if attempt <= MAX_RETRIES:
+                        throttled_attempts[url] = attempt
+                        pages_crawled -= 1
+                        requeue_later(url_queue, (url, depth), backoff_delay(attempt), retry_tasks)
+                        requeued = True
+                        continue
+                    print(f"Giving up on {url} after {attempt} attempts: HTTP status {result.status_code}")
+                    result = None
+                throttled_attempts.pop(url, None)
+                visited_buffer.append(url)
+                if result is not None:
+                    try:
+                        await handle_result(url, depth, result)
+                    except Exception as e:
+                        print(f"Error processing links from {url}: {e}")
+            finally:
+                if not requeued:
+                    url_queue.task_done()
+
     # Create the crawler instance
     crawler = AsyncWebCrawler(config=browser_config)
     await crawler.start()
+    await controller.start()
 
-    product_urls = set()
+    tasks = []
     try:
         log_memory(prefix="Before crawl: ")
 
-        async for result in await crawler.arun(url=ECOMMERCE_TARGET_URL, config=crawl_config):
-            # Perfected discovery logic to ensure only valid product URLs are captured
-            if result.success and PRODUCT_URL_PATTERN in result.url:
-                # Exclude common non-product patterns
-                if any(keyword in result.url for keyword in ['/products', 'filter?']):
-                    continue
-
-                # Exclude direct image links
-                is_image = any(result.url.lower().endswith(ext) for ext in ['.jpg', '.jpeg', '.png', '.gif', '.svg', '.webp'])
-                if is_image:
-                    continue
+        tasks.append(asyncio.create_task(checkpoint_loop()))
+        tasks.extend(asyncio.create_task(worker()) for _ in range(controller.max_concurrency))
+        await url_queue.join()
+        save_checkpoint()
 
-                # Add the validated URL
-                product_urls.add(result.url)
-
-        print(f"\nFound {len(product_urls)} unique product URLs.")
+        print(f"\nVisited {pages_crawled} pages, found {checkpoint.product_count()} unique product URLs.")
+        rate_limiter.print_stats()
+        print(f"Seen-URL set: {len(seen_urls)} URLs in {seen_urls.memory_bytes() // 1024} KB "
+              f"({seen_urls.bytes_per_url():.1f} bytes/URL, false-positive rate {seen_urls.false_positive_rate():.2e})")
 
         with open(URLS_FILE, "w") as f:
-            for url in product_urls:
+            for url in checkpoint.iter_product_urls():
                 f.write(f"{url}\n")
         print(f"Saved product URLs to {URLS_FILE}")
 
     finally:
         print("\nClosing crawler...")
+        for task in [*tasks, *retry_tasks]:
+            task.cancel()
+        await asyncio.gather(*tasks, *retry_tasks, return_exceptions=True)
+        # Keep whatever was found, even if the crawl was interrupted
+        save_checkpoint()
+        checkpoint.close()
+        await controller.stop()
         await crawler.close()
         # Final memory log
         log_memory(prefix="Final: ")
-        print(f"\nPeak memory usage (MB): {peak_memory // (1024 * 1024)}")
+        print(f"\nPeak memory usage (MB): {controller.peak_memory // (1024 * 1024)}")
 
-async def extract_product_data():
-    print("\n=== Extracting Product Data ===")
+async def discover_from_sitemaps(sitemap_urls: List[str]):
+    print("\n=== Discovering Product URLs from Sitemaps ===")
 
-    if not os.path.exists(URLS_FILE):
-        print(f"Error: {URLS_FILE} not found. Please run the 'discover' mode first.")
-        return
+    if not sitemap_urls:
+        sitemap_urls = await asyncio.to_thread(find_sitemaps, ECOMMERCE_TARGET_URL)
+    print(f"Reading sitemaps: {', '.join(sitemap_urls)}")
+
+    classifier = ProductURLClassifier(include=PRODUCT_URL_PATTERN)
+    seen_urls = FingerprintSet()
+    # lastmod values let `extract --incremental` skip pages that have not changed
+    state = CrawlState(CRAWL_STATE_FILE)
+    lastmods = []
+    entry_count = 0
+    product_count = 0
+    started = time.perf_counter()
+
+    # Product URLs are written out as they are parsed; nothing is rendered in a browser
+    with open(URLS_FILE, "w") as f:
+        async for entry in iter_sitemap_entries(sitemap_urls):
+            entry_count += 1
+            url = canonicalize_url(entry.loc)
+            if classifier.is_product(url) and seen_urls.add(url):
+                f.write(f"{url}\n")
+                product_count += 1
+                if entry.lastmod:
+                    lastmods.append((url, entry.lastmod))
+                    if len(lastmods) >= 1000:
+                        state.record_sitemap_lastmods(lastmods)
+                        lastmods = []
+    state.record_sitemap_lastmods(lastmods)
+    state.close()
+
+    print(f"\nRead {entry_count} sitemap entries in {time.perf_counter() - started:.1f}s, "
+          f"found {product_count} unique product URLs.")
+    print(f"Saved product URLs to {URLS_FILE}")
+
+async def extract_from_cache(urls: Iterable[str], extraction_strategy: JsonCssExtractionStrategy,
+                             page_cache: PageCache, cache_keys: List[str]):
+    """
+    Re-runs CSS extraction and validation over cached pages, without a browser or network.
+
+    Each URL is looked up under `cache_keys` in order, so pages served by either fetch tier are found.
+    """
+    print("Extracting from the local page cache...")
+
+    writer = SupabaseWriter(upsert_products, label="products")
+    dedup = DedupIndex()
+    fail_count = 0
+    url_count = 0
+    cached_count = 0
+    start_time = time.perf_counter()
+
+    # Extracted rows are buffered and normalized a writer batch at a time
+    raw_rows, row_urls = [], []
+
+    async def flush_rows():
+        nonlocal fail_count, raw_rows, row_urls
+        products, errors = normalize_products(raw_rows, row_urls, with_sku=bool(CSS_SELECTOR_SKU))
+        raw_rows, row_urls = [], []
+        for url, message in errors:
+            print(f"Error validating extracted content for {url}: {message}")
+        fail_count += len(errors)
+        for product in products:
+            if dedup.classify(product, content_hash(product)) != DedupIndex.DUPLICATE:
+                await writer.put(product)
+
+    try:
+        for url in urls:
+            url_count += 1
+            html = next((page for page in (page_cache.get(url, key) for key in cache_keys) if page is not None), None)
+            if html is None:
+                continue
+            cached_count += 1
+            try:
+                product_data_list = extraction_strategy.run(url, [html])
+            except Exception as e:
+                print(f"Error parsing cached page {url}: {e}")
+                fail_count += 1
+                continue
+            if not product_data_list:
+                print(f"Warning: No data extracted for {url}, skipping.")
+                fail_count += 1
+                continue
+            raw_rows.append(product_data_list[0])
+            row_urls.append(canonicalize_url(url))
+            if len(raw_rows) >= WRITE_BATCH_SIZE:
+                await flush_rows()
+
+        if raw_rows:
+            await flush_rows()
+        await writer.close()
+
+        elapsed = time.perf_counter() - start_time
+        print(f"\nSummary:")
+        print(f"  - Successfully extracted and stored: {writer.written}")
+        print(f"  - Failed or no data: {fail_count}")
+        print(f"  - Not in cache: {url_count - cached_count}")
+        print(f"  - Throughput: {cached_count / elapsed if elapsed else 0:.2f} pages/s from cache")
+        dedup.print_stats()
+        writer.print_stats()
+    finally:
+        await writer.close()
+        page_cache.close()
+
+def print_queue_status(work_queue: WorkQueue):
+    counts = work_queue.counts()
+    print(f"  - Work queue: " + ", ".join(f"{count} {status}" for status, count in counts.items()))
 
-    with open(URLS_FILE, "r") as f:
-        # Read and filter out any empty lines
-        urls = [line.strip() for line in f.readlines() if line.strip()]
+def print_extract_summary(stats: Counter, written: int, elapsed: float, incremental: bool, workers: str):
+    print(f"\nSummary:")
+    print(f"  - Successfully extracted and stored: {written}")
+    print(f"  - Failed or no data: {stats['failed']}")
+    print(f"  - Served over HTTP: {stats['http']}")
+    print(f"  - Served by the browser: {stats['browser']} ({stats['fallback']} fell back from HTTP)")
+    if incremental:
+        print(f"  - Skipped, unchanged per sitemap lastmod: {stats['skipped']}")
+        print(f"  - Skipped, 304 Not Modified: {stats['not_modified']}")
+    if stats['throttled']:
+        print(f"  - Throttled with 429/503: {stats['throttled']} ({stats['retried']} put back for a retry)")
+    print_render_stats(stats)
+    print(f"  - Throughput: {stats['pages'] / elapsed if elapsed else 0:.2f} pages/s with {workers}")
 
-    print(f"Found {len(urls)} URLs to process.")
+async def extract_product_data(concurrency: Optional[int] = None, rate_limit: float = 0.0, memory_limit_mb: Optional[int] = None,
+                               incremental: bool = False, full_refresh: bool = False, from_cache: bool = False,
+                               tier: str = "auto", shard: Optional[Tuple[int, int]] = None, output: Optional[ShardOutput] = None,
+                               queue: Optional[str] = None, urls_file: str = URLS_FILE, offset: int = 0,
+                               limit: Optional[int] = None, render_profile: str = RENDER_PROFILE):
+    """
+    Extracts product data from every URL in `urls_file`.
+
+    URLs are streamed from the file (gzip-compressed if it ends in `.gz`, or stdin for
+    "-") through a bounded queue, so crawling starts with the first URL and memory does
+    not grow with the size of the file. `offset` and `limit` select a slice of the URLs.
+
+    `tier` picks how pages are fetched: "auto" fetches the server-rendered HTML over plain
+    HTTP and only opens the page in the browser when the name or price is missing,
+    "http" never uses the browser and "browser" always does. Pages that need the browser
+    are rendered with `render_profile` ("lean" or "default", see RenderProfile).
+
+    Each host's request rate starts at `rate_limit` (0 for none) and adapts to how the host
+    responds. URLs answered with 429 or 503 are retried after a jittered backoff, up to
+    `MAX_RETRIES` times.
+
+    With `queue`, URLs are leased from that WorkQueue database instead, until it has none
+    left to hand out. A URL is marked done once its product is stored (or once it needs
+    no storing), and failed URLs are put back for a retry.
+
+    Products whose content hash matches the one recorded by the last run are not sent
+    again, unless `full_refresh` is set.
+
+    In a worker process of `extract_sharded`, `shard` is (this worker, number of workers):
+    only the worker's share of the URLs is crawled, and products go to `output` instead of
+    storage.
+    """
+    print("\n=== Extracting Product Data ===" if shard is None else f"\n=== Worker {shard[0]}: Extracting Product Data ===")
+
+    if queue is not None and not from_cache:
+        print(f"Leasing URLs from the work queue in {queue}.")
+    elif urls_file != "-" and not os.path.exists(urls_file):
+        print(f"Error: {urls_file} not found. Please run the 'discover' mode first.")
+        return
+    else:
+        print(f"Reading URLs from {'stdin' if urls_file == '-' else urls_file}"
+              + (f", starting at URL {offset}" if offset else "") + (f", at most {limit}" if limit is not None else "") + ".")
+
+    if output is None:
+        try:
+            get_storage_backend()
+        except (ValueError, ImportError) as e:
+            print(f"Error: {e}")
+            return
 
     # CSS selectors for product data
     extraction_schema = {
@@ -154,92 +446,696 @@ async def extract_product_data():
             {"name": "image_url", "selector": CSS_SELECTOR_IMAGE_URL, "type": "attribute", "attribute": "src"}
         ]
     }
+    if CSS_SELECTOR_SKU:
+        extraction_schema["fields"].append({"name": "sku", "selector": CSS_SELECTOR_SKU, "type": "text"})
 
     # Extraction strategy
     extraction_strategy = JsonCssExtractionStrategy(schema=extraction_schema)
 
-    crawl_config = CrawlerRunConfig(
+    # The browser tier renders with `render_profile`; the lean one returns as soon as the
+    # name and price are on the page
+    profile = RenderProfile(render_profile, wait_for=wait_for_fields(CSS_SELECTOR_NAME, CSS_SELECTOR_PRICE))
+    crawl_config = profile.run_config(
         cache_mode=CacheMode.BYPASS,
         extraction_strategy=extraction_strategy,
     )
 
-    # Create the crawler instance
-    crawler = AsyncWebCrawler()
-    await crawler.start()
+    # Fetched pages are kept in the local page cache so selectors can be re-run offline.
+    # Server-rendered and browser-rendered HTML can differ, so each tier and render
+    # profile has its own key.
+    page_cache = PageCache() if PAGE_CACHE_MAX_MB > 0 else None
+    cache_keys = {
+        "browser": profile.cache_key(),
+        "http": render_key(browser=None, user_agent=HTTP_USER_AGENT),
+    }
+    if from_cache:
+        if page_cache is None:
+            print("Error: the page cache is disabled (PAGE_CACHE_MAX_MB=0).")
+            return
+        # Pages rendered with the other profile are just as good for re-extraction
+        other_keys = [RenderProfile(name, wait_for=profile.wait_for).cache_key() for name in RENDER_PROFILES if name != profile.name]
+        await extract_from_cache(iter_urls(urls_file, offset, limit), extraction_strategy, page_cache,
+                                 [cache_keys["browser"], *other_keys, cache_keys["http"]])
+        return
+
+    # Concurrency follows memory usage (including Chromium) up to `concurrency`
+    controller = MemoryAdaptiveController(memory_limit_mb=memory_limit_mb, max_concurrency=concurrency or EXTRACT_CONCURRENCY)
+    workers = controller.max_concurrency
+    # Two leased URLs per worker keeps them busy without holding URLs other nodes could take
+    leases = LeaseClient(WorkQueue(queue), batch_size=2 * workers) if queue is not None else None
+
+    # The browser is only started once a page actually needs it
+    crawler = None
+    crawler_lock = asyncio.Lock()
+    fetcher = StaticFetcher(pool_size=workers)
+    await controller.start()
 
-    products_batch = []
-    batch_size = 50
-    success_count = 0
+    # Which tier served each URL is always recorded. In incremental mode, pages the sitemap
+    # or the server says are unchanged are skipped, and products whose content hash did
+    # not change are not re-sent.
+    state = CrawlState(CRAWL_STATE_FILE)
+
+    # Products are stored by a background writer. Crawl state for a product is only
+    # recorded once the batch holding it has been written. Worker processes send their
+    # products to the parent instead, which stores them and records their state.
+    unwritten_state = {}
+    writer = None
+    if output is None:
+        def on_written(batch: List[dict]):
+            for product in batch:
+                record = unwritten_state.pop(product['url'], None)
+                if record is not None:
+                    state.record_crawl(*record)
+                    if leases is not None:
+                        leases.complete([record[0]])
+            state.flush()
+
+        writer = SupabaseWriter(upsert_products, on_written=on_written, label="products")
+    # Products already seen this run are never sent twice
+    dedup = DedupIndex()
     fail_count = 0
+    skipped_count = 0
+    not_modified_count = 0
+    tier_counts = {"http": 0, "browser": 0}
+    fallback_count = 0
+    retry_count = 0
+
+    def failed(url: str, error: str, retry: bool = True):
+        nonlocal fail_count
+        fail_count += 1
+        if leases is not None:
+            leases.fail(url, error, retry)
+
+    def retry_later(url: str, attempt: int, error: str) -> bool:
+        """Puts a throttled URL back for another try; True if it was, False once it is out of retries."""
+        nonlocal retry_count
+        if leases is not None:
+            # The work queue holds the URL back and counts its attempts
+            retry_count += 1
+            leases.fail(url, error)
+            return False
+        if attempt >= MAX_RETRIES:
+            print(f"Giving up on {url} after {attempt + 1} attempts: {error}")
+            failed(url, error)
+            return False
+        retry_count += 1
+        requeue_later(url_queue, (url, attempt + 1), backoff_delay(attempt + 1), retry_tasks)
+        return True
+
+    async def get_crawler() -> AsyncWebCrawler:
+        nonlocal crawler
+        async with crawler_lock:
+            if crawler is None:
+                print(f"Starting browser ({profile.name} render profile) for pages that need rendering...")
+                crawler = await profile.start_crawler()
+        return crawler
+
+    async def handle_extracted(url: str, product_data_list: list, response_headers: dict, html: str,
+                               page_state=None, served_by: str = "browser"):
+        if html and page_cache is not None:
+            # Compressing and writing the page blocks, and a cache failure must not stop the crawl
+            try:
+                await asyncio.to_thread(page_cache.put, url, cache_keys[served_by], html)
+            except Exception as e:
+                print(f"Could not cache {url}: {e}")
+
+        try:
+            if not product_data_list:
+                print(f"Warning: No data extracted for {url}, skipping.")
+                failed(url, "no data extracted")
+                return
+            # Validate the extracted data against the Pydantic model
+            product_data_validated = validate_product(product_data_list[0], url)
+            tier_counts[served_by] += 1
+
+            product_hash = content_hash(product_data_validated)
+            headers = {k.lower(): v for k, v in (response_headers or {}).items()}
+            record = (url, headers.get('etag'), headers.get('last-modified'), product_hash, served_by)
+            outcome = dedup.classify(product_data_validated, product_hash,
+                                     page_state.content_hash if page_state is not None else None)
+            # Only new and changed products are sent, unless a full refresh asks for all of them
+            if outcome == DedupIndex.DUPLICATE:
+                # The first copy may not be written yet, so its hash is not recorded here
+                state.record_crawl(url, record[1], record[2], tier=served_by)
+                return
+            if outcome == DedupIndex.UNCHANGED and not full_refresh:
+                state.record_crawl(*record)
+                return
+
+            # The queue entry is completed by whoever stores the product, once it is written
+            if leases is not None:
+                leases.hand_off(url)
+            if output is not None:
+                # The parent stores the product and records its state once it is written. With a
+                # queue it also renews the URL's lease, under this worker's owner, until then.
+                await output.put(product_data_validated, (record, leases.owner if leases is not None else None))
+                return
+            unwritten_state[product_data_validated['url']] = record
+            await writer.put(product_data_validated)
+
+        except (IndexError, ValidationError, ValueError) as e:
+            print(f"Error validating or parsing extracted content for {url}: {e}")
+            # The same page would fail the same way again
+            failed(url, f"invalid product: {e}", retry=False)
+
+    # Bounded worker pool: the memory controller decides how many of the workers may
+    # have a page open at once. With concurrency=1 this is exactly the old serial loop.
+    # Each host's request rate adapts to its latency and to 429/503 responses, and
+    # throttled URLs wait out their backoff off the pool instead of holding a worker.
+    rate_limiter = AdaptiveRateLimiter(rate_limit)
+    url_queue = asyncio.Queue(maxsize=4 * workers)
+    retry_tasks = set()
+    url_count = 0
+
+    async def feed_urls():
+        """Reads URLs off the event loop, in chunks, and hands them to the workers."""
+        nonlocal url_count
+        source = iter_urls(urls_file, offset, limit)
+        # Lines on stdin may trickle in from another process, so they are passed on one by one
+        chunk_size = 1 if urls_file == "-" else URL_READ_CHUNK
+        while True:
+            chunk = await asyncio.to_thread(lambda: list(islice(source, chunk_size)))
+            if not chunk:
+                break
+            for url in chunk:
+                if shard is None or shard_of(url, shard[1]) == shard[0]:
+                    url_count += 1
+                    await url_queue.put((url, 0))
+        # Throttled URLs keep coming back until they succeed or run out of retries
+        await url_queue.join()
+        for _ in range(workers):
+            await url_queue.put(None)
+
+    async def worker():
+        nonlocal skipped_count, not_modified_count, fallback_count
+        while True:
+            if leases is not None:
+                url = await leases.next()
+                if url is None:
+                    return
+                attempt = 0
+            else:
+                item = await url_queue.get()
+                if item is None:
+                    return
+                url, attempt = item
+
+            requeued = False
+            try:
+                page_state = state.get(url)
+                headers = {}
+                if incremental:
+                    if unchanged_since_last_crawl(page_state):
+                        skipped_count += 1
+                        continue
+                    headers = conditional_headers(page_state)
+
+                # HTTP tier: one plain GET, which doubles as the conditional revalidation
+                if tier != "browser" or headers:
+                    await rate_limiter.wait(url)
+                    started = time.perf_counter()
+                    try:
+                        page = await fetcher.fetch(url, headers)
+                    except requests.RequestException as e:
+                        print(f"Error fetching {url} over HTTP: {e}")
+                        page = None
+                    if page is not None and rate_limiter.record(url, page.status_code, time.perf_counter() - started, page.headers):
+                        # The browser would be throttled too
+                        requeued = retry_later(url, attempt, f"HTTP status {page.status_code}")
+                        continue
+                    if page is not None and page.status_code == 304:
+                        state.record_crawl(url)
+                        not_modified_count += 1
+                        continue
+                    if tier != "browser":
+                        if page is not None and page.status_code == 200:
+                            try:
+                                product_data_list = await asyncio.to_thread(extraction_strategy.run, url, [page.html])
+                            except Exception as e:
+                                print(f"Error parsing {url}: {e}")
+                                product_data_list = []
+                            if tier == "http" or has_required_fields(product_data_list):
+                                await handle_extracted(url, product_data_list, page.headers, page.html, page_state, "http")
+                                continue
+                        elif tier == "http" or (page is not None and page.status_code in (404, 410)):
+                            # A missing page will not render in the browser either
+                            if page is not None:
+                                print(f"Error fetching {url} over HTTP: status {page.status_code}")
+                            if page is None:
+                                failed(url, "HTTP request failed")
+                            else:
+                                failed(url, f"HTTP status {page.status_code}", retry=page.status_code not in (404, 410))
+                            continue
+                        fallback_count += 1
+
+                # Browser tier
+                try:
+                    browser = await get_crawler()
+                    async with controller.slot():
+                        await rate_limiter.wait(url)
+                        result = await profile.arun(browser, url, crawl_config)
+                except Exception as e:
+                    print(f"Error crawling {url}: {e}")
+                    failed(url, f"crawl error: {e}")
+                    continue
+                # Render times are not comparable with plain HTTP, so only the status is recorded
+                if rate_limiter.record(url, result.status_code, headers=result.response_headers):
+                    requeued = retry_later(url, attempt, f"HTTP status {result.status_code}")
+                    continue
+                if not result.success:
+                    print(f"Error crawling {url}: {result.error_message}")
+                    failed(url, f"crawl error: {result.error_message}")
+                    continue
+                try:
+                    product_data_list = json.loads(result.extracted_content or "[]")
+                except json.JSONDecodeError as e:
+                    print(f"Error validating or parsing extracted content for {url}: {e}")
+                    failed(url, f"invalid extracted content: {e}")
+                    continue
+                await handle_extracted(url, product_data_list, result.response_headers, result.html, page_state, "browser")
+            finally:
+                if leases is not None:
+                    leases.settle(url)
+                elif not requeued:
+                    url_queue.task_done()
+
+    start_time = time.perf_counter()
+    tasks = []
     try:
-        for url in urls:
-            result = await crawler.arun(url=url, config=crawl_config)
-            if result.success and result.extracted_content:
+        controller.log_memory(prefix="Before crawl: ")
+        if leases is None:
+            tasks.append(asyncio.create_task(feed_urls()))
+        tasks.extend(asyncio.create_task(worker()) for _ in range(workers))
+        await asyncio.gather(*tasks)
+
+        # Write any remaining products, then record the state of pages that were not stored
+        if writer is not None:
+            await writer.close()
+        state.flush()
+        if leases is not None:
+            await leases.close()
+
+        elapsed = time.perf_counter() - start_time
+        stats = Counter(pages=leases.leased if leases is not None else url_count, failed=fail_count,
+                        http=tier_counts['http'], browser=tier_counts['browser'], fallback=fallback_count,
+                        skipped=skipped_count, not_modified=not_modified_count, retried=retry_count,
+                        throttled=sum(rate_limiter.throttled.values()))
+        stats.update(dedup.counts)
+        stats.update(profile.counts)
+        if output is not None:
+            # The parent prints one summary for all workers
+            await output.close(stats)
+            return
+        print_extract_summary(stats, writer.written, elapsed, incremental, f"up to {workers} worker(s)")
+        rate_limiter.print_stats()
+        dedup.print_stats()
+        writer.print_stats()
+        if leases is not None:
+            print_queue_status(leases.queue)
+
+    finally:
+        print("\nClosing crawler...")
+        for task in [*tasks, *retry_tasks]:
+            task.cancel()
+        await asyncio.gather(*tasks, *retry_tasks, return_exceptions=True)
+        if writer is not None:
+            await writer.close()
+        await controller.stop()
+        if crawler is not None:
+            await crawler.close()
+        fetcher.close()
+        state.close()
+        if leases is not None:
+            await leases.close()
+            leases.queue.close()
+        if page_cache is not None:
+            page_cache.close()
+        controller.log_memory(prefix="Final: ")
+
+async def extract_sharded(workers: int, concurrency: Optional[int] = None, rate_limit: float = 0.0,
+                          memory_limit_mb: Optional[int] = None, incremental: bool = False, full_refresh: bool = False,
+                          tier: str = "auto", queue: Optional[str] = None, urls_file: str = URLS_FILE, offset: int = 0,
+                          limit: Optional[int] = None, render_profile: str = RENDER_PROFILE):
+    """
+    Runs `extract_product_data` in `workers` processes, one share of `urls_file` each.
+
+    URLs are split by a stable hash, so a URL always lands on the same worker. Each worker
+    has its own browser, HTTP pool and memory controller, with `concurrency` pages in flight,
+    and enforces its share of `rate_limit` and `memory_limit_mb`. Products are stored by one
+    writer in this process, and the workers' stats are summed into one summary.
+
+    With `queue`, the workers lease URLs from the work queue instead, and queue entries of
+    stored products are completed here once they are written.
+    """
+    print(f"\n=== Extracting Product Data with {workers} Worker Processes ===")
+
+    if queue is None and urls_file == "-":
+        print("Error: worker processes cannot share stdin. Pass a URL file, or use --queue.")
+        return
+    if queue is None and not os.path.exists(urls_file):
+        print(f"Error: {urls_file} not found. Please run the 'discover' mode first.")
+        return
+    try:
+        get_storage_backend()
+    except (ValueError, ImportError) as e:
+        print(f"Error: {e}")
+        return
+
+    # Workers record the state of pages they skip; stored products are recorded here
+    state = CrawlState(CRAWL_STATE_FILE)
+    work_queue = WorkQueue(queue) if queue is not None else None
+    unwritten_state = {}
+    # Queue URLs of products not yet stored, by the worker that leased them
+    unwritten_leases = {}
+
+    def on_written(batch: List[dict]):
+        finished = []
+        for product in batch:
+            record = unwritten_state.pop(product['url'], None)
+            if record is not None:
+                state.record_crawl(*record)
+                finished.append(record[0])
+                unwritten_leases.pop(record[0], None)
+        state.flush()
+        if work_queue is not None:
+            work_queue.complete(finished)
+
+    async def renew_leases():
+        """Keeps the leases of products waiting for the writer, which may outlive their worker."""
+        while True:
+            await asyncio.sleep(QUEUE_LEASE_SECONDS / 3)
+            by_owner = {}
+            for url, owner in list(unwritten_leases.items()):
+                by_owner.setdefault(owner, []).append(url)
+            for owner, urls in by_owner.items():
+                await asyncio.to_thread(work_queue.extend, urls, owner)
+
+    writer = SupabaseWriter(upsert_products, on_written=on_written, label="products")
+    # Each URL belongs to one worker, but one SKU can be found under URLs of two workers
+    cross_worker = DedupIndex()
+
+    def on_row(product: dict, sent: tuple) -> bool:
+        record, owner = sent
+        if CSS_SELECTOR_SKU and cross_worker.classify(product, record[3]) == DedupIndex.DUPLICATE:
+            if work_queue is not None:
+                work_queue.complete([record[0]])
+            return False
+        unwritten_state[product['url']] = record
+        if owner is not None:
+            unwritten_leases[record[0]] = owner
+        return True
+
+    renewer = asyncio.create_task(renew_leases()) if work_queue is not None else None
+    start_time = time.perf_counter()
+    try:
+        stats = await run_sharded(extract_product_data, workers, writer, on_row=on_row, concurrency=concurrency,
+                                  incremental=incremental, full_refresh=full_refresh, tier=tier, queue=queue, urls_file=urls_file,
+                                  offset=offset, limit=limit, render_profile=render_profile,
+                                  **shard_limits(workers, rate_limit, memory_limit_mb))
+        await writer.close()
+        state.flush()
+
+        elapsed = time.perf_counter() - start_time
+        print_extract_summary(stats, writer.written, elapsed, incremental, f"{workers} worker processes")
+        if stats['failed_workers']:
+            print(f"  - Workers that failed: {stats['failed_workers']}")
+        dedup = DedupIndex()
+        dedup.counts.update({outcome: stats[outcome] for outcome in
+                             (DedupIndex.NEW, DedupIndex.CHANGED, DedupIndex.UNCHANGED, DedupIndex.DUPLICATE)})
+        dedup.counts[DedupIndex.DUPLICATE] += cross_worker.counts[DedupIndex.DUPLICATE]
+        dedup.print_stats()
+        writer.print_stats()
+        if work_queue is not None:
+            print_queue_status(work_queue)
+    finally:
+        await writer.close()
+        if renewer is not None:
+            renewer.cancel()
+            await asyncio.gather(renewer, return_exceptions=True)
+        state.close()
+        if work_queue is not None:
+            work_queue.close()
+
+async def extract_listings(start_urls: List[str], concurrency: Optional[int] = None, rate_limit: float = 0.0,
+                           memory_limit_mb: Optional[int] = None, tier: str = "auto",
+                           render_profile: str = RENDER_PROFILE):
+    """
+    Harvests products from category/listing pages, following pagination.
+
+    Every block matching `LISTING_SELECTOR_BASE` on a page is validated and stored as its
+    own product, keyed on the URL of its product link, so a page of 24-100 products costs
+    one page load instead of one per product. "Next page" links are followed until
+    `MAX_LISTING_PAGES` listing pages have been loaded.
+    """
+    print("\n=== Extracting Products from Listing Pages ===")
+
+    try:
+        get_storage_backend()
+    except (ValueError, ImportError) as e:
+        print(f"Error: {e}")
+        return
+
+    listing_fields = [
+        {"name": "name", "selector": LISTING_SELECTOR_NAME, "type": "text"},
+        {"name": "price", "selector": LISTING_SELECTOR_PRICE, "type": "text"},
+        {"name": "image_url", "selector": LISTING_SELECTOR_IMAGE_URL, "type": "attribute", "attribute": "src"},
+        {"name": "link", "selector": LISTING_SELECTOR_LINK, "type": "attribute", "attribute": "href"},
+    ]
+    if LISTING_SELECTOR_DESCRIPTION:
+        listing_fields.append({"name": "description", "selector": LISTING_SELECTOR_DESCRIPTION, "type": "text"})
+    listing_strategy = JsonCssExtractionStrategy(schema={"baseSelector": LISTING_SELECTOR_BASE, "fields": listing_fields})
+    pagination_strategy = JsonCssExtractionStrategy(schema={
+        "baseSelector": "body",
+        "fields": [{"name": "next", "selector": LISTING_SELECTOR_NEXT_PAGE, "type": "attribute", "attribute": "href"}],
+    })
+    profile = RenderProfile(render_profile, wait_for=wait_for_fields(LISTING_SELECTOR_BASE))
+    crawl_config = profile.run_config(cache_mode=CacheMode.BYPASS)
+
+    # Pagination discovers pages as it goes, so every worker starts and waits on the queue
+    controller = MemoryAdaptiveController(memory_limit_mb=memory_limit_mb, max_concurrency=concurrency)
+    crawler = None
+    crawler_lock = asyncio.Lock()
+    fetcher = StaticFetcher(pool_size=controller.max_concurrency)
+    rate_limiter = AdaptiveRateLimiter(rate_limit)
+    await controller.start()
+
+    writer = SupabaseWriter(upsert_products, label="products")
+    dedup = DedupIndex()
+    page_count = 0
+    fail_count = 0
+    no_link_count = 0
+    retry_count = 0
+    tier_counts = {"http": 0, "browser": 0}
+
+    # (URL, attempt); throttled pages are put back with the next attempt
+    page_queue = asyncio.Queue()
+    retry_tasks = set()
+    seen_pages = FingerprintSet()
+    for url in start_urls:
+        url = canonicalize_url(url)
+        if seen_pages.add(url):
+            page_queue.put_nowait((url, 0))
+
+    async def get_crawler() -> AsyncWebCrawler:
+        nonlocal crawler
+        async with crawler_lock:
+            if crawler is None:
+                print(f"Starting browser ({profile.name} render profile) for pages that need rendering...")
+                crawler = await profile.start_crawler()
+        return crawler
+
+    async def fetch_listing(url: str):
+        """Returns the page's HTML, its product blocks and which tier served it."""
+        if tier != "browser":
+            await rate_limiter.wait(url)
+            started = time.perf_counter()
+            try:
+                page = await fetcher.fetch(url)
+            except requests.RequestException as e:
+                print(f"Error fetching {url} over HTTP: {e}")
+                page = None
+            if page is not None and rate_limiter.record(url, page.status_code, time.perf_counter() - started, page.headers):
+                raise Throttled(f"HTTP status {page.status_code}")
+            if page is not None and page.status_code == 200:
+                blocks = await asyncio.to_thread(listing_strategy.run, url, [page.html])
+                if blocks or tier == "http":
+                    return page.html, blocks, "http"
+            elif tier == "http" or (page is not None and page.status_code in (404, 410)):
+                if page is not None:
+                    print(f"Error fetching {url} over HTTP: status {page.status_code}")
+                return None, [], "http"
+
+        # Listings rendered client-side only show their products in the browser
+        browser = await get_crawler()
+        async with controller.slot():
+            await rate_limiter.wait(url)
+            result = await profile.arun(browser, url, crawl_config)
+        if rate_limiter.record(url, result.status_code, headers=result.response_headers):
+            raise Throttled(f"HTTP status {result.status_code}")
+        if not result.success:
+            print(f"Error crawling {url}: {result.error_message}")
+            return None, [], "browser"
+        blocks = await asyncio.to_thread(listing_strategy.run, url, [result.html])
+        return result.html, blocks, "browser"
+
+    async def worker():
+        nonlocal page_count, fail_count, retry_count
+        while True:
+            url, attempt = await page_queue.get()
+            requeued = False
+            try:
+                if attempt == 0:
+                    if page_count >= MAX_LISTING_PAGES:
+                        continue
+                    page_count += 1
                 try:
-                    product_data_list = json.loads(result.extracted_content)
-                    if not product_data_list:
-                        print(f"Warning: No data extracted for {url}, skipping.")
+                    await handle_listing(url)
+                except Throttled as e:
+                    if attempt >= MAX_RETRIES:
+                        print(f"Giving up on listing page {url} after {attempt + 1} attempts: {e}")
                         fail_count += 1
-                        continue
-                    # Validate the extracted data against the Pydantic model
-                    product_data = product_data_list[0]
-                    # The price is extracted as a string like "3.57 USD", so we need to parse it
-                    if 'price' in product_data and isinstance(product_data['price'], str):
-                        product_data['price'] = float(product_data['price'].replace('USD', '').strip())
-
-                    validated_product = Product(**product_data)
-                    product_data_validated = validated_product.model_dump()
-                    product_data_validated['url'] = url
-                    products_batch.append(product_data_validated)
-
-                    if len(products_batch) >= batch_size:
-                        client = get_supabase_client()
-                        # De-duplicate the batch before upserting
-                        unique_products = {p['name']: p for p in products_batch}.values()
-                        # Upsert instead of insert
-                        data, count = client.table(PRODUCTS_TABLE_NAME).upsert(list(unique_products), on_conflict='name').execute()
-                        success_count += len(unique_products)
-                        print(f"Upserted batch of {len(unique_products)} products.")
-                        products_batch = []
-
-                except (json.JSONDecodeError, IndexError, ValidationError, ValueError) as e:
-                    print(f"Error validating or parsing extracted content for {url}: {e}")
+                    else:
+                        retry_count += 1
+                        requeue_later(page_queue, (url, attempt + 1), backoff_delay(attempt + 1), retry_tasks)
+                        requeued = True
+                except Exception as e:
+                    print(f"Error processing listing page {url}: {e}")
                     fail_count += 1
+            finally:
+                if not requeued:
+                    page_queue.task_done()
 
-            elif not result.success:
-                print(f"Error crawling {url}: {result.error_message}")
-                fail_count += 1
+    async def handle_listing(url: str):
+        nonlocal fail_count, no_link_count
+        html, blocks, served_by = await fetch_listing(url)
+        if html is None:
+            fail_count += 1
+            return
+        tier_counts[served_by] += 1
 
-        # Insert any remaining products in the last batch
-        if products_batch:
-            client = get_supabase_client()
-            # De-duplicate the batch before upserting
-            unique_products = {p['name']: p for p in products_batch}.values()
-            # Upsert instead of insert
-            data, count = client.table(PRODUCTS_TABLE_NAME).upsert(list(unique_products), on_conflict='name').execute()
-            success_count += len(unique_products)
-            print(f"Upserted final batch of {len(unique_products)} products.")
+        # Each product block becomes a row keyed on its own product URL
+        rows, product_urls = [], []
+        for block in blocks:
+            link = block.pop("link", None)
+            if not link:
+                no_link_count += 1
+                continue
+            rows.append(block)
+            product_urls.append(canonicalize_url(link, base=url))
+        products, errors = normalize_products(rows, product_urls, with_sku=False)
+        for product_url, message in errors:
+            print(f"Error validating product {product_url} on {url}: {message}")
+        fail_count += len(errors)
+        for product in products:
+            if not LISTING_SELECTOR_DESCRIPTION:
+                # Listing cards rarely show the description; keep the stored one
+                del product["description"]
+            if dedup.classify(product, content_hash(product)) != DedupIndex.DUPLICATE:
+                await writer.put(product)
+        print(f"{url}: {len(products)} products ({served_by})")
 
-        print(f"\nSummary:")
-        print(f"  - Successfully extracted and stored: {success_count}")
-        print(f"  - Failed or no data: {fail_count}")
+        for pagination in pagination_strategy.run(url, [html]):
+            next_url = pagination.get("next")
+            if next_url:
+                next_url = canonicalize_url(next_url, base=url)
+                if seen_pages.add(next_url):
+                    page_queue.put_nowait((next_url, 0))
+
+    start_time = time.perf_counter()
+    worker_tasks = [asyncio.create_task(worker()) for _ in range(controller.max_concurrency)]
+    try:
+        controller.log_memory(prefix="Before crawl: ")
+        await page_queue.join()
+        await writer.close()
 
+        elapsed = time.perf_counter() - start_time
+        print(f"\nSummary:")
+        print(f"  - Listing pages loaded: {page_count} ({tier_counts['http']} over HTTP, {tier_counts['browser']} in the browser)")
+        print(f"  - Products stored: {writer.written}")
+        print(f"  - Failed pages or invalid products: {fail_count}")
+        print(f"  - Product blocks without a link, skipped: {no_link_count}")
+        if rate_limiter.throttled:
+            print(f"  - Pages put back for a retry after 429/503: {retry_count}")
+        print(f"  - Products per page load: {writer.written / page_count if page_count else 0:.1f}")
+        print_render_stats(profile.counts)
+        print(f"  - Throughput: {page_count / elapsed if elapsed else 0:.2f} pages/s")
+        rate_limiter.print_stats()
+        dedup.print_stats()
+        writer.print_stats()
     finally:
         print("\nClosing crawler...")
-        await crawler.close()
+        for task in [*worker_tasks, *retry_tasks]:
+            task.cancel()
+        await writer.close()
+        await controller.stop()
+        if crawler is not None:
+            await crawler.close()
+        fetcher.close()
+        controller.log_memory(prefix="Final: ")
 
 async def main():
     parser = argparse.ArgumentParser(description="E-commerce product crawler and extractor.")
-    parser.add_argument("mode", choices=["discover", "extract"], help="The mode to run the script in.")
+    parser.add_argument("mode", choices=["discover", "extract", "listing"], help="The mode to run the script in.")
+    parser.add_argument("--concurrency", type=int, default=None, help="Maximum number of pages to crawl in parallel; the memory controller scales up to it (default: 1 in extract mode, MAX_CONCURRENCY in discover and listing modes).")
+    parser.add_argument("--memory-limit", type=int, default=None, help="Memory ceiling in MB for this process and its browser (default: MEMORY_LIMIT_MB or 75%% of RAM).")
+    parser.add_argument("--sitemap", nargs="*", default=None, metavar="URL",
+                        help="Discover product URLs from sitemaps instead of crawling pages. Without URLs, they are read from robots.txt (discover mode).")
+    parser.add_argument("--resume", action="store_true", help=f"Continue an interrupted discovery from {CHECKPOINT_FILE} (discover mode).")
+    parser.add_argument("--incremental", action="store_true",
+                        help=f"Skip pages unchanged since the last run, per sitemap lastmod, ETag and Last-Modified tracked in {CRAWL_STATE_FILE} (extract mode).")
+    parser.add_argument("--full-refresh", action="store_true",
+                        help="Store every extracted product, including those unchanged since the last run (extract mode).")
+    parser.add_argument("--from-cache", action="store_true",
+                        help="Re-run extraction and validation on pages in the local page cache instead of crawling (extract mode).")
+    parser.add_argument("--tier", choices=["auto", "http", "browser"], default="auto",
+                        help="How pages are fetched: plain HTTP with browser fallback when the product data is missing (auto), HTTP only, or browser only (extract and listing modes).")
+    parser.add_argument("--render-profile", choices=RENDER_PROFILES, default=RENDER_PROFILE,
+                        help="How the browser tier renders pages: lean skips images, fonts, media, trackers and third-party scripts, default loads everything (extract and listing modes, default: RENDER_PROFILE or lean).")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="Maximum requests per second per host, 0 for no limit until a host answers 429 or 503 (discover, extract and listing modes).")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Worker processes to split the URLs between, each with its own browser and --concurrency pages in flight (extract mode).")
+    parser.add_argument("--queue", nargs="?", const=WORK_QUEUE_FILE, default=None, metavar="PATH",
+                        help=f"Lease URLs from a shared work queue (default: {WORK_QUEUE_FILE}) instead of reading {URLS_FILE}; fill it with `python work_queue.py enqueue` (extract mode).")
+    parser.add_argument("--urls-file", default=URLS_FILE, metavar="PATH",
+                        help=f"Product URLs to extract, one per line; gzip-compressed if it ends in .gz, - for stdin (extract mode, default: {URLS_FILE}).")
+    parser.add_argument("--offset", type=int, default=0, help="Skip this many URLs of the URL file (extract mode).")
+    parser.add_argument("--limit", type=int, default=None, help="Extract at most this many URLs of the URL file (extract mode).")
+    parser.add_argument("--start", nargs="+", default=None, metavar="URL",
+                        help="Category or listing pages to harvest (listing mode, default: LISTING_URLS or ECOMMERCE_TARGET_URL).")
     args = parser.parse_args()
 
     if args.mode == "discover":
         if not ECOMMERCE_TARGET_URL:
             print("ECOMMERCE_TARGET_URL environment variable is not set.")
             return
-        await discover_product_urls()
+        if args.sitemap is not None:
+            await discover_from_sitemaps(args.sitemap)
+        else:
+            await discover_product_urls(max_concurrent=args.concurrency, memory_limit_mb=args.memory_limit, resume=args.resume,
+                                        rate_limit=args.rate_limit)
+    elif args.mode == "extract" and args.workers > 1 and args.from_cache:
+        print("Error: --from-cache reads the local page cache in one process and cannot be combined with --workers.")
+    elif args.mode == "extract" and args.workers > 1:
+        await extract_sharded(args.workers, concurrency=args.concurrency, rate_limit=args.rate_limit,
+                              memory_limit_mb=args.memory_limit, incremental=args.incremental,
+                              full_refresh=args.full_refresh, tier=args.tier,
+                              queue=args.queue, urls_file=args.urls_file, offset=args.offset, limit=args.limit,
+                              render_profile=args.render_profile)
     elif args.mode == "extract":
-        await extract_product_data()
+        await extract_product_data(concurrency=args.concurrency, rate_limit=args.rate_limit, memory_limit_mb=args.memory_limit,
+                                   incremental=args.incremental, full_refresh=args.full_refresh, from_cache=args.from_cache,
+                                   tier=args.tier, queue=args.queue,
+                                   urls_file=args.urls_file, offset=args.offset, limit=args.limit,
+                                   render_profile=args.render_profile)
+    elif args.mode == "listing":
+        start_urls = args.start or [url.strip() for url in LISTING_URLS.split(",") if url.strip()]
+        if not start_urls and ECOMMERCE_TARGET_URL:
+            start_urls = [ECOMMERCE_TARGET_URL]
+        if not start_urls:
+            print("No listing pages given. Pass --start URL or set LISTING_URLS.")
+            return
+        await extract_listings(start_urls, concurrency=args.concurrency, rate_limit=args.rate_limit,
+                               memory_limit_mb=args.memory_limit, tier=args.tier, render_profile=args.render_profile)
 
 
 if __name__ == "__main__":
@@ -1,26 +1,25 @@
 import os
+import re
 import sys
-import psutil
 import asyncio
 import json
 import argparse
-from supabase import create_client, Client
+from itertools import islice
 from dotenv import load_dotenv
-from pydantic import BaseModel, Field, ValidationError
+from pydantic import ValidationError
 from typing import Optional, List
+from storage import Storage, get_storage
 
 load_dotenv()
 
-# Supabase connection details
-SUPABASE_URL = os.environ.get("SUPABASE_URL")
-SUPABASE_KEY = os.environ.get("SUPABASE_KEY")
-supabase: Client = None
+# Products are stored in Supabase, or locally when STORAGE_BACKEND is sqlite or parquet
+storage: Storage = None
 
-def get_supabase_client():
-    global supabase
-    if supabase is None:
-        supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
-    return supabase
+def get_storage_backend() -> Storage:
+    global storage
+    if storage is None:
+        storage = get_storage()
+    return storage
 
 # E-commerce target URL
 ECOMMERCE_TARGET_URL = os.environ.get("ECOMMERCE_TARGET_URL")
@@ -32,6 +31,8 @@ CSS_SELECTOR_PRICE = os.environ.get("CSS_SELECTOR_PRICE", "div.product-price")
 CSS_SELECTOR_DESCRIPTION = os.environ.get("CSS_SELECTOR_DESCRIPTION", "h2.text")
 CSS_SELECTOR_IMAGE_URL = os.environ.get("CSS_SELECTOR_IMAGE_URL", "div.main-image img")
 URLS_FILE = "product_urls.txt"
+# URLs handed to each arun_many call; the file is streamed a chunk at a time
+URL_CHUNK_SIZE = 1000
 
 __location__ = os.path.dirname(os.path.abspath(__file__))
 __output__ = os.path.join(__location__, "output")
@@ -41,29 +42,28 @@ parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(parent_dir)
 
 from crawl4ai import AsyncWebCrawler, BrowserConfig, CrawlerRunConfig, CacheMode, JsonCssExtractionStrategy
+from crawl4ai.async_dispatcher import MemoryAdaptiveDispatcher
 from crawl4ai.deep_crawling import BFSDeepCrawlStrategy
 from crawl4ai.deep_crawling.filters import FilterChain, URLPatternFilter
-
-# Pydantic model for product data extraction
-class Product(BaseModel):
-    name: str = Field(..., description="The name of the product")
-    price: float = Field(..., description="The price of the product")
-    description: Optional[str] = Field(None, description="The description of the product")
-    image_url: Optional[str] = Field(None, description="The URL of the product image")
-
-async def discover_product_urls():
+from memory_controller import MemoryAdaptiveController
+from url_classifier import ProductURLClassifier, ProductURLFilter
+from supabase_writer import SupabaseWriter
+from crawl_state import DedupIndex, content_hash
+from url_utils import canonicalize_url, iter_urls
+from normalize import normalize_products
+from politeness import MAX_RETRIES, AdaptiveRateLimiter, DispatcherRateLimiter
+
+def upsert_products(products: List[dict]):
+    """Upserts a batch of validated products on their canonical URL in one request."""
+    unique_products = list({p['url']: p for p in products}.values())
+    return get_storage_backend().upsert(PRODUCTS_TABLE_NAME, unique_products, on_conflict='url')
+
+async def discover_product_urls(max_concurrent: Optional[int] = None, memory_limit_mb: Optional[int] = None):
     print("\n=== Discovering Product URLs ===")
 
-    # We'll keep track of peak memory usage across all tasks
-    peak_memory = 0
-    process = psutil.Process(os.getpid())
-
-    def log_memory(prefix: str = ""):
-        nonlocal peak_memory
-        current_mem = process.memory_info().rss  # in bytes
-        if current_mem > peak_memory:
-            peak_memory = current_mem
-        print(f"{prefix} Current Memory: {current_mem // (1024 * 1024)} MB, Peak: {peak_memory // (1024 * 1024)} MB")
+    # We'll keep track of peak memory usage and pace the crawl to stay under the ceiling
+    controller = MemoryAdaptiveController(memory_limit_mb=memory_limit_mb, max_concurrency=max_concurrent)
+    log_memory = controller.log_memory
 
     # Minimal browser config
     browser_config = BrowserConfig(
@@ -72,11 +72,16 @@ async def discover_product_urls():
         extra_args=["--disable-gpu", "--disable-dev-shm-usage", "--no-sandbox"],
     )
 
-    # URL filtering to focus on valid HTTP/HTTPS links
+    # URL filtering to focus on valid HTTP/HTTPS links, pruning assets and
+    # filter/facet variants before they are fetched
+    classifier = ProductURLClassifier(include=PRODUCT_URL_PATTERN)
     filter_chain = FilterChain([
         URLPatternFilter(
-            patterns=["http://*", "https://*"],
-        )
+            # A compiled pattern is matched against the full URL; "http://*" globs are
+            # treated as path prefixes by newer crawl4ai releases and match nothing
+            patterns=[re.compile(r"^https?://")],
+        ),
+        ProductURLFilter(classifier),
     ])
 
     # Deep crawling strategy
@@ -92,18 +97,22 @@ async def discover_product_urls():
         deep_crawl_strategy=deep_crawl_strategy,
         stream=True,
         page_timeout=120000,
+        semaphore_count=controller.max_concurrency,
     )
 
     # Create the crawler instance
     crawler = AsyncWebCrawler(config=browser_config)
     await crawler.start()
+    await controller.start()
 
     product_urls = set()
     try:
         log_memory(prefix="Before crawl: ")
 
         async for result in await crawler.arun(url=ECOMMERCE_TARGET_URL, config=crawl_config):
-            if result.success and PRODUCT_URL_PATTERN in result.url:
+            # The deep crawl is a stream, so holding off here stops it from scheduling more pages
+            await controller.wait_for_headroom()
+            if result.success and classifier.is_product(result.url):
                 product_urls.add(result.url)
 
         print(f"\nFound {len(product_urls)} unique product URLs.")
@@ -115,22 +124,25 @@ async def discover_product_urls():
 
     finally:
         print("\nClosing crawler...")
+        await controller.stop()
         await crawler.close()
         # Final memory log
         log_memory(prefix="Final: ")
-        print(f"\nPeak memory usage (MB): {peak_memory // (1024 * 1024)}")
+        print(f"\nPeak memory usage (MB): {controller.peak_memory // (1024 * 1024)}")
 
-async def extract_product_data():
+async def extract_product_data(max_concurrent: Optional[int] = None, memory_limit_mb: Optional[int] = None,
+                               urls_file: str = URLS_FILE, offset: int = 0, limit: Optional[int] = None,
+                               rate_limit: float = 0.0):
     print("\n=== Extracting Product Data ===")
 
-    if not os.path.exists(URLS_FILE):
-        print(f"Error: {URLS_FILE} not found. Please run the 'discover' mode first.")
+    if urls_file != "-" and not os.path.exists(urls_file):
+        print(f"Error: {urls_file} not found. Please run the 'discover' mode first.")
         return
 
-    with open(URLS_FILE, "r") as f:
-        urls = [line.strip() for line in f.readlines()]
-
-    print(f"Found {len(urls)} URLs to process.")
+    # URLs are read lazily and crawled URL_CHUNK_SIZE at a time, so the first chunk is
+    # crawling while the rest of the file is still on disk
+    url_source = iter_urls(urls_file, offset, limit)
+    print(f"Reading URLs from {'stdin' if urls_file == '-' else urls_file}.")
 
     # CSS selectors for product data
     extraction_schema = {
@@ -146,77 +158,114 @@ async def extract_product_data():
     # Extraction strategy
     extraction_strategy = JsonCssExtractionStrategy(schema=extraction_schema)
 
+    # Pace the stream to stay under the memory ceiling
+    controller = MemoryAdaptiveController(memory_limit_mb=memory_limit_mb, max_concurrency=max_concurrent)
+
     crawl_config = CrawlerRunConfig(
         cache_mode=CacheMode.BYPASS,
         extraction_strategy=extraction_strategy,
         stream=True,
+        semaphore_count=controller.max_concurrency,
     )
 
+    # The dispatcher waits on the adaptive per-host limiter. URLs a host throttles are
+    # crawled again with the next chunk, by which time the host's backoff has been applied.
+    rate_limiter = AdaptiveRateLimiter(rate_limit)
+    throttled_attempts = {}
+    retry_urls = []
+
     # Create the crawler instance
     crawler = AsyncWebCrawler()
     await crawler.start()
+    await controller.start()
 
-    products_batch = []
-    batch_size = 50
-    success_count = 0
+    # Products are upserted by a background writer so the stream keeps flowing, and
+    # products already seen this run are never sent twice
+    writer = SupabaseWriter(upsert_products, label="products")
+    dedup = DedupIndex()
     fail_count = 0
+    url_count = 0
     try:
-        async for result in await crawler.arun_many(urls=urls, config=crawl_config):
-            if result.success and result.extracted_content:
-                try:
-                    # Validate the extracted data against the Pydantic model
-                    product_data = json.loads(result.extracted_content)[0]
-                    # The price is extracted as a string like "3.57 USD", so we need to parse it
-                    if 'price' in product_data and isinstance(product_data['price'], str):
-                        product_data['price'] = float(product_data['price'].replace('USD', '').strip())
-
-                    validated_product = Product(**product_data)
-                    product_data_validated = validated_product.dict()
-                    product_data_validated['url'] = result.url
-                    products_batch.append(product_data_validated)
-
-                    if len(products_batch) >= batch_size:
-                        client = get_supabase_client()
-                        data, count = client.table(PRODUCTS_TABLE_NAME).insert(products_batch).execute()
-                        success_count += len(products_batch)
-                        print(f"Inserted batch of {len(products_batch)} products.")
-                        products_batch = []
-
-                except (json.JSONDecodeError, IndexError, ValidationError, ValueError) as e:
-                    print(f"Error validating or parsing extracted content for {result.url}: {e}")
+        controller.log_memory(prefix="Before crawl: ")
+        while True:
+            chunk = await asyncio.to_thread(lambda: list(islice(url_source, URL_CHUNK_SIZE)))
+            if not chunk and not retry_urls:
+                break
+            url_count += len(chunk)
+            chunk, retry_urls = retry_urls + chunk, []
+            dispatcher = MemoryAdaptiveDispatcher(max_session_permit=controller.max_concurrency,
+                                                  rate_limiter=DispatcherRateLimiter(rate_limiter))
+            async for result in await crawler.arun_many(urls=chunk, config=crawl_config, dispatcher=dispatcher):
+                await controller.wait_for_headroom()
+                if rate_limiter.record(result.url, result.status_code, headers=result.response_headers):
+                    attempt = throttled_attempts.get(result.url, 0) + 1
+                    if attempt <= MAX_RETRIES:
+                        throttled_attempts[result.url] = attempt
+                        retry_urls.append(result.url)
+                    else:
+                        print(f"Giving up on {result.url} after {attempt} attempts: HTTP status {result.status_code}")
+                        fail_count += 1
+                    continue
+                throttled_attempts.pop(result.url, None)
+                if result.success and result.extracted_content:
+                    try:
+                        # Normalize the price, text and image URL and validate the product
+                        product_data = json.loads(result.extracted_content)[0]
+                        products, errors = normalize_products([product_data], [canonicalize_url(result.url)])
+                        if errors:
+                            raise ValueError(errors[0][1])
+                        product_data_validated = products[0]
+                        if dedup.classify(product_data_validated, content_hash(product_data_validated)) != DedupIndex.DUPLICATE:
+                            await writer.put(product_data_validated)
+
+                    except (json.JSONDecodeError, IndexError, ValidationError, ValueError) as e:
+                        print(f"Error validating or parsing extracted content for {result.url}: {e}")
+                        fail_count += 1
+
+                elif not result.success:
+                    print(f"Error crawling {result.url}: {result.error_message}")
                     fail_count += 1
 
-            elif not result.success:
-                print(f"Error crawling {result.url}: {result.error_message}")
-                fail_count += 1
-
         # Insert any remaining products in the last batch
-        if products_batch:
-            client = get_supabase_client()
-            data, count = client.table(PRODUCTS_TABLE_NAME).insert(products_batch).execute()
-            success_count += len(products_batch)
-            print(f"Inserted final batch of {len(products_batch)} products.")
+        await writer.close()
 
         print(f"\nSummary:")
-        print(f"  - Successfully extracted and stored: {success_count}")
+        print(f"  - URLs processed: {url_count}")
+        print(f"  - Successfully extracted and stored: {writer.written}")
         print(f"  - Failed or no data: {fail_count}")
+        rate_limiter.print_stats()
+        dedup.print_stats()
+        writer.print_stats()
 
     finally:
         print("\nClosing crawler...")
+        await writer.close()
+        await controller.stop()
         await crawler.close()
+        controller.log_memory(prefix="Final: ")
 
 async def main():
     parser = argparse.ArgumentParser(description="E-commerce product crawler and extractor.")
     parser.add_argument("mode", choices=["discover", "extract"], help="The mode to run the script in.")
+    parser.add_argument("--concurrency", type=int, default=None, help="Maximum number of pages to crawl in parallel (default: MAX_CONCURRENCY).")
+    parser.add_argument("--memory-limit", type=int, default=None, help="Memory ceiling in MB for this process and its browser (default: MEMORY_LIMIT_MB or 75%% of RAM).")
+    parser.add_argument("--urls-file", default=URLS_FILE, metavar="PATH",
+                        help=f"Product URLs to extract, one per line; gzip-compressed if it ends in .gz, - for stdin (default: {URLS_FILE}).")
+    parser.add_argument("--offset", type=int, default=0, help="Skip this many URLs of the URL file.")
+    parser.add_argument("--limit", type=int, default=None, help="Extract at most this many URLs of the URL file.")
+    parser.add_argument("--rate-limit", type=float, default=0.0,
+                        help="Maximum requests per second per host, 0 for no limit until a host answers 429 or 503 (extract mode).")
     args = parser.parse_args()
 
     if args.mode == "discover":
         if not ECOMMERCE_TARGET_URL:
             print("ECOMMERCE_TARGET_URL environment variable is not set.")
             return
-        await discover_product_urls()
+        await discover_product_urls(max_concurrent=args.concurrency, memory_limit_mb=args.memory_limit)
     elif args.mode == "extract":
-        await extract_product_data()
+        await extract_product_data(max_concurrent=args.concurrency, memory_limit_mb=args.memory_limit,
+                                   urls_file=args.urls_file, offset=args.offset, limit=args.limit,
+                                   rate_limit=args.rate_limit)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,159 @@
+import html
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+
+# Markup of a product page, with the classes the default CSS_SELECTOR_* values look for
+PRODUCT_PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>{name}</title></head>
+<body>
+<div class="header"><a href="/">Store</a> <a href="/en/category/books">Books</a></div>
+<h1 class="title">{name}</h1>
+<div class="product-price">{price:.2f} USD</div>
+<div class="main-image"><img src="/media/catalog/{number}.jpg" alt="{name}"></div>
+<div class="description">{description}</div>
+<div class="footer">{footer}</div>
+</body></html>
+"""
+
+
+class FixtureStore:
+    """
+    A local stand-in for a store: `count` static product pages served over HTTP.
+
+    Each response is held back `latency` seconds, to stand for the network and the
+    store's own time to answer, so a crawl can be timed without sending traffic to a
+    real site. Product pages are at `/en/product/book-<n>`; other paths return 404.
+    Use it as a context manager, or call `start()` and `stop()`.
+    """
+
+    def __init__(self, count: int = 200, latency: float = 0.05):
+        self.count = count
+        self.latency = latency
+        store = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                time.sleep(store.latency)
+                body = store.page(self.path)
+                if body is None:
+                    self.send_error(404)
+                    return
+                data = body.encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def urls(self) -> List[str]:
+        return [f"{self.base_url}/en/product/book-{number}" for number in range(self.count)]
+
+    def page(self, path: str):
+        prefix = "/en/product/book-"
+        if not path.startswith(prefix) or not path[len(prefix):].isdigit():
+            return None
+        number = int(path[len(prefix):])
+        if number >= self.count:
+            return None
+        return PRODUCT_PAGE.format(
+            name=html.escape(f"Book {number}"), number=number, price=5 + number % 40 + 0.99,
+            description=html.escape(f"The story of book {number}. " * 20),
+            footer="Shipping, returns and contact details. " * 50,
+        )
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == "__main__":
+    # Throughput of `extract` against the fixture store: the serial loop (concurrency 1)
+    # against the bounded worker pool, with the products each run stored compared
+    import os
+    import sys
+    import asyncio
+    import shutil
+    import argparse
+    import tempfile
+    from contextlib import redirect_stdout
+    from io import StringIO
+
+    parser = argparse.ArgumentParser(description="Time extract against a local fixture store.")
+    parser.add_argument("--pages", type=int, default=200, help="Product pages in the fixture store.")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds each response is held back.")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16], help="Concurrency levels to time.")
+    parser.add_argument("--tier", choices=["auto", "http", "browser"], default="auto",
+                        help="How pages are fetched; browser needs Playwright's Chromium installed.")
+    args = parser.parse_args()
+
+    # Settings are read when the crawler is imported, so they are fixed here first: the
+    # fixture's selectors, no page cache, and products stored in a throwaway SQLite file
+    workdir = tempfile.mkdtemp(prefix="extract-benchmark-")
+    os.environ.update({
+        "STORAGE_BACKEND": "sqlite", "PAGE_CACHE_MAX_MB": "0", "CSS_SELECTOR_SKU": "",
+        "CSS_SELECTOR_BASE": "body", "CSS_SELECTOR_NAME": "h1.title", "CSS_SELECTOR_PRICE": "div.product-price",
+        "CSS_SELECTOR_DESCRIPTION": "div.description", "CSS_SELECTOR_IMAGE_URL": "div.main-image img",
+    })
+    os.chdir(workdir)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import ecommerce_crawler
+    from storage import SQLiteStorage
+
+    async def run(urls_file: str, concurrency: int):
+        ecommerce_crawler.storage = SQLiteStorage(os.path.join(workdir, f"products-{concurrency}.db"))
+        # Every run starts from an empty crawl state, so no product is skipped as unchanged
+        if os.path.exists(ecommerce_crawler.CRAWL_STATE_FILE):
+            os.remove(ecommerce_crawler.CRAWL_STATE_FILE)
+        started = time.perf_counter()
+        with redirect_stdout(StringIO()):
+            await ecommerce_crawler.extract_product_data(concurrency=concurrency, tier=args.tier, urls_file=urls_file)
+        elapsed = time.perf_counter() - started
+        rows = ecommerce_crawler.storage.select_all(ecommerce_crawler.PRODUCTS_TABLE_NAME)
+        ecommerce_crawler.storage.close()
+        products = sorted((row["url"], row["name"], row["price"], row["description"], row["image_url"]) for row in rows)
+        return elapsed, products
+
+    async def compare():
+        with FixtureStore(args.pages, args.latency) as store:
+            urls_file = os.path.join(workdir, "product_urls.txt")
+            with open(urls_file, "w") as f:
+                f.write("\n".join(store.urls()) + "\n")
+            print(f"{args.pages} pages, {args.latency * 1000:.0f} ms per response, {args.tier} tier:")
+            baseline, baseline_products = None, None
+            for concurrency in args.concurrency:
+                elapsed, products = await run(urls_file, concurrency)
+                baseline = baseline or elapsed
+                baseline_products = baseline_products if baseline_products is not None else products
+                same = "same products" if products == baseline_products else "DIFFERENT products"
+                print(f"  concurrency {concurrency:>3}: {elapsed:.2f}s, {len(products) / elapsed:.1f} pages/s, "
+                      f"{baseline / elapsed:.1f}x, {len(products)} stored ({same})")
+
+    try:
+        asyncio.run(compare())
+    finally:
+        os.chdir(os.path.dirname(workdir))
+        shutil.rmtree(workdir, ignore_errors=True)
@@ -0,0 +1,161 @@
+import os
+import asyncio
+import psutil
+from contextlib import asynccontextmanager
+from typing import Optional
+
+# Memory ceiling for a crawl, in MB. Defaults to 75% of the host's physical memory.
+MEMORY_LIMIT_MB = os.environ.get("MEMORY_LIMIT_MB")
+MAX_CONCURRENCY = int(os.environ.get("MAX_CONCURRENCY", "16"))
+
+
+def default_memory_limit_mb() -> int:
+    """MEMORY_LIMIT_MB if set, else 75% of physical memory."""
+    if MEMORY_LIMIT_MB:
+        return int(MEMORY_LIMIT_MB)
+    return int(psutil.virtual_memory().total * 0.75) // (1024 * 1024)
+
+
+class MemoryAdaptiveController:
+    """
+    Shared concurrency limiter that follows the crawl's memory usage.
+
+    A background task samples the RSS of this process (plus its children, which is
+    where Chromium lives) every `sample_interval` seconds. Above `high_water` of the
+    ceiling the concurrency limit is halved, below `low_water` it grows by one slot
+    while there is demand for it, and at the ceiling new tasks are paused until
+    memory comes back down. At least one task is always allowed to run so a crawl
+    can never stall on its own baseline memory.
+    """
+
+    def __init__(
+        self,
+        memory_limit_mb: Optional[int] = None,
+        max_concurrency: Optional[int] = None,
+        min_concurrency: int = 1,
+        initial_concurrency: Optional[int] = None,
+        sample_interval: float = 1.0,
+        include_children: bool = True,
+        high_water: float = 0.85,
+        low_water: float = 0.70,
+    ):
+        if memory_limit_mb is None:
+            memory_limit_mb = default_memory_limit_mb()
+        self.memory_limit = memory_limit_mb * 1024 * 1024
+        self.max_concurrency = max(1, max_concurrency or MAX_CONCURRENCY)
+        self.min_concurrency = max(1, min(min_concurrency, self.max_concurrency))
+        self.limit = min(self.max_concurrency, initial_concurrency or max(self.min_concurrency, self.max_concurrency // 4))
+        self.sample_interval = sample_interval
+        self.include_children = include_children
+        self.high_water = high_water
+        self.low_water = low_water
+
+        self.process = psutil.Process(os.getpid())
+        self.current_memory = 0
+        self.peak_memory = 0
+        self.paused = False
+        self.active = 0
+        self._waiting = 0
+        self._condition = None
+        self._sampler = None
+        # Wake-ups in flight; the event loop only keeps weak references to tasks
+        self._notifications = set()
+
+    def sample(self) -> int:
+        """Measures memory now and adjusts the limit. Returns the sampled bytes."""
+        current_mem = self.process.memory_info().rss
+        if self.include_children:
+            for child in self.process.children(recursive=True):
+                try:
+                    current_mem += child.memory_info().rss
+                except (psutil.NoSuchProcess, psutil.AccessDenied):
+                    pass
+        self.current_memory = current_mem
+        if current_mem > self.peak_memory:
+            self.peak_memory = current_mem
+
+        usage = current_mem / self.memory_limit
+        previous_limit, was_paused = self.limit, self.paused
+        if usage >= 1.0:
+            self.paused = True
+            self.limit = max(self.min_concurrency, self.limit // 2)
+        elif usage >= self.high_water:
+            self.paused = False
+            self.limit = max(self.min_concurrency, self.limit // 2)
+        else:
+            self.paused = False
+            # Only grow when the slots we already have are all in use
+            if usage < self.low_water and self.active + self._waiting > self.limit:
+                self.limit = min(self.max_concurrency, self.limit + 1)
+
+        if self.paused and not was_paused:
+            print(f"Memory at {current_mem // (1024 * 1024)} MB is over the {self.memory_limit // (1024 * 1024)} MB ceiling, pausing new tasks.")
+        elif was_paused and not self.paused:
+            print(f"Memory back under the ceiling, resuming with concurrency {self.limit}.")
+        elif self.limit != previous_limit:
+            print(f"Adjusted concurrency {previous_limit} -> {self.limit} (memory {current_mem // (1024 * 1024)} MB).")
+
+        if self._condition is not None and (self.limit > previous_limit or was_paused):
+            task = asyncio.get_running_loop().create_task(self._notify())
+            self._notifications.add(task)
+            task.add_done_callback(self._notifications.discard)
+        return current_mem
+
+    def log_memory(self, prefix: str = ""):
+        self.sample()
+        print(f"{prefix} Current Memory: {self.current_memory // (1024 * 1024)} MB, Peak: {self.peak_memory // (1024 * 1024)} MB, Concurrency: {self.limit}")
+
+    async def start(self):
+        self._condition = asyncio.Condition()
+        self.sample()
+        self._sampler = asyncio.create_task(self._run_sampler())
+
+    async def stop(self):
+        if self._sampler:
+            self._sampler.cancel()
+            try:
+                await self._sampler
+            except asyncio.CancelledError:
+                pass
+            self._sampler = None
+
+    async def _run_sampler(self):
+        while True:
+            await asyncio.sleep(self.sample_interval)
+            self.sample()
+
+    async def _notify(self):
+        async with self._condition:
+            self._condition.notify_all()
+
+    def _can_start(self) -> bool:
+        if self.active == 0:
+            return True
+        return not self.paused and self.active < self.limit
+
+    async def acquire(self):
+        async with self._condition:
+            self._waiting += 1
+            try:
+                await self._condition.wait_for(self._can_start)
+            finally:
+                self._waiting -= 1
+            self.active += 1
+
+    async def release(self):
+        async with self._condition:
+            self.active -= 1
+            self._condition.notify_all()
+
+    @asynccontextmanager
+    async def slot(self):
+        await self.acquire()
+        try:
+            yield
+        finally:
+            await self.release()
+
+    async def wait_for_headroom(self):
+        """Blocks while memory is over the ceiling, for loops that cannot take a slot."""
+        while self.paused:
+            await asyncio.sleep(self.sample_interval)
@@ -0,0 +1,192 @@
+import os
+import json
+import time
+import zlib
+import sqlite3
+import tempfile
+import threading
+from contextlib import contextmanager
+from hashlib import sha256
+from typing import Optional
+
+# Where rendered pages are kept, and how much disk they may use (0 disables the cache)
+PAGE_CACHE_DIR = os.environ.get("PAGE_CACHE_DIR", ".page_cache")
+PAGE_CACHE_MAX_MB = int(os.environ.get("PAGE_CACHE_MAX_MB", "2048"))
+
+
+def render_key(**settings) -> str:
+    """Short fingerprint of the settings that affect how a page renders."""
+    return sha256(json.dumps(settings, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:16]
+
+
+class PageCache:
+    """
+    Content-addressed, size-bounded cache of rendered HTML.
+
+    Pages are looked up by (URL, render key) in a small SQLite index that points at a
+    blob named after the SHA-256 of the HTML, so identical pages are stored once. Blobs
+    are zlib-compressed on disk. When the cache grows past `max_bytes`, the least
+    recently used blobs are evicted until it is back under 90% of the limit.
+
+    Each `put`, with any eviction it triggers, is one write transaction, so several
+    processes can share a cache directory and store the same page at once. The size of the
+    cache is kept in the index by triggers, so every process evicts against the same total. Compressing and writing blobs takes time,
+    so call `put` from a thread (`asyncio.to_thread`) in async code. The connection is
+    shared across threads behind a lock.
+    """
+
+    def __init__(self, directory: str = PAGE_CACHE_DIR, max_bytes: int = PAGE_CACHE_MAX_MB * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        # Worker processes share the index, so wait for the write lock rather than failing
+        self.conn = sqlite3.connect(os.path.join(directory, "index.db"), timeout=60, isolation_level=None,
+                                    check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            BEGIN IMMEDIATE;
+            CREATE TABLE IF NOT EXISTS pages (
+                url TEXT NOT NULL,
+                render_key TEXT NOT NULL,
+                content_hash TEXT NOT NULL,
+                fetched_at REAL NOT NULL,
+                PRIMARY KEY (url, render_key)
+            );
+            CREATE INDEX IF NOT EXISTS pages_content ON pages (content_hash);
+            CREATE TABLE IF NOT EXISTS blobs (
+                content_hash TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS blobs_lru ON blobs (last_access);
+            CREATE TABLE IF NOT EXISTS usage (
+                id INTEGER PRIMARY KEY CHECK (id = 0),
+                total_bytes INTEGER NOT NULL
+            );
+            INSERT OR IGNORE INTO usage SELECT 0, COALESCE(SUM(size), 0) FROM blobs;
+            CREATE TRIGGER IF NOT EXISTS blobs_added AFTER INSERT ON blobs BEGIN
+                UPDATE usage SET total_bytes = total_bytes + new.size WHERE id = 0;
+            END;
+            CREATE TRIGGER IF NOT EXISTS blobs_removed AFTER DELETE ON blobs BEGIN
+                UPDATE usage SET total_bytes = total_bytes - old.size WHERE id = 0;
+            END;
+            COMMIT;
+        """)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @property
+    def total_bytes(self) -> int:
+        """Compressed size of all cached blobs, across every process using the cache."""
+        with self.lock:
+            return self._total_bytes()
+
+    def _total_bytes(self) -> int:
+        return self.conn.execute("SELECT total_bytes FROM usage WHERE id = 0").fetchone()[0]
+
+    def _blob_path(self, content_hash: str) -> str:
+        return os.path.join(self.directory, content_hash[:2], f"{content_hash[2:]}.html.z")
+
+    @contextmanager
+    def _transaction(self):
+        # IMMEDIATE takes the write lock up front, so concurrent writers queue up instead
+        # of failing to upgrade a read transaction
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def _write_blob(self, path: str, compressed: bytes):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # A temporary file of its own, so writers of the same page never share one
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(compressed)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def put(self, url: str, key: str, html: str):
+        data = html.encode("utf-8")
+        content_hash = sha256(data).hexdigest()
+        compressed = zlib.compress(data, 6)
+        path = self._blob_path(content_hash)
+        now = time.time()
+
+        with self._transaction():
+            exists = self.conn.execute("SELECT 1 FROM blobs WHERE content_hash = ?", (content_hash,)).fetchone()
+            if not exists or not os.path.exists(path):
+                self._write_blob(path, compressed)
+            self.conn.execute("""
+                INSERT INTO blobs (content_hash, size, last_access) VALUES (?, ?, ?)
+                ON CONFLICT (content_hash) DO UPDATE SET last_access = excluded.last_access
+            """, (content_hash, len(compressed), now))
+            self.conn.execute("""
+                INSERT INTO pages (url, render_key, content_hash, fetched_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT (url, render_key) DO UPDATE SET content_hash = excluded.content_hash, fetched_at = excluded.fetched_at
+            """, (url, key, content_hash, now))
+
+            if self._total_bytes() > self.max_bytes:
+                self._evict(int(self.max_bytes * 0.9))
+
+    def get(self, url: str, key: str) -> Optional[str]:
+        with self.lock:
+            row = self.conn.execute("SELECT content_hash FROM pages WHERE url = ? AND render_key = ?", (url, key)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        content_hash = row[0]
+        try:
+            with open(self._blob_path(content_hash), "rb") as f:
+                html = zlib.decompress(f.read()).decode("utf-8")
+        except (OSError, zlib.error):
+            with self.lock:
+                self.conn.execute("DELETE FROM pages WHERE url = ? AND render_key = ?", (url, key))
+            self.misses += 1
+            return None
+        with self.lock:
+            self.conn.execute("UPDATE blobs SET last_access = ? WHERE content_hash = ?", (time.time(), content_hash))
+        self.hits += 1
+        return html
+
+    def iter_urls(self, key: str):
+        """URLs cached under `key`, oldest first."""
+        with self.lock:
+            urls = self.conn.execute("SELECT url FROM pages WHERE render_key = ? ORDER BY fetched_at", (key,)).fetchall()
+        for (url,) in urls:
+            yield url
+
+    def _evict(self, target_bytes: int):
+        # Runs inside put's transaction, so no other writer re-adds a blob while its file is removed
+        total = self._total_bytes()
+        evicted = []
+        for content_hash, size in self.conn.execute("SELECT content_hash, size FROM blobs ORDER BY last_access"):
+            if total <= target_bytes:
+                break
+            try:
+                os.remove(self._blob_path(content_hash))
+            except FileNotFoundError:
+                pass
+            total -= size
+            evicted.append((content_hash,))
+        self.conn.executemany("DELETE FROM pages WHERE content_hash = ?", evicted)
+        self.conn.executemany("DELETE FROM blobs WHERE content_hash = ?", evicted)
+
+    def evict(self, target_bytes: int):
+        """Removes least recently used blobs until the cache is at most `target_bytes`."""
+        with self._transaction():
+            self._evict(target_bytes)
+
+    def close(self):
+        # Waits for a put still running in another thread
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,222 @@
+import os
+import time
+import random
+import asyncio
+from collections import Counter, deque
+from email.utils import parsedate_to_datetime
+from typing import Any, Dict, Mapping, Optional, Set
+from urllib.parse import urlparse
+
+from crawl4ai.async_dispatcher import RateLimiter
+
+# Times a page answered with 429 or 503 is put back for another try before it counts as failed
+MAX_RETRIES = int(os.environ.get("MAX_RETRIES", "3"))
+# Backoff before the first retry, doubling per attempt, and the longest any host is waited for
+RETRY_BASE_DELAY = float(os.environ.get("RETRY_BASE_DELAY", "2.0"))
+RETRY_MAX_DELAY = float(os.environ.get("RETRY_MAX_DELAY", "300.0"))
+# A host is never slowed down below this many requests per second
+MIN_HOST_RATE = float(os.environ.get("MIN_HOST_RATE", "0.2"))
+# Requests per second a host with no limit is assumed to have been sent when it throttles
+# before its rate could be measured; the first 429 or 503 halves it
+THROTTLE_START_RATE = float(os.environ.get("THROTTLE_START_RATE", "4.0"))
+
+THROTTLE_STATUSES = (429, 503)
+# Requests per second added back per second of responses that are neither throttled nor slow
+RATE_INCREASE = 0.5
+# Responses this many times slower than the host's best are taken as a sign of load
+SLOW_RESPONSE_FACTOR = 2.0
+# Weight of the newest response in the host's average latency
+LATENCY_WEIGHT = 0.2
+
+
+def backoff_delay(attempt: int, base: float = RETRY_BASE_DELAY, cap: float = RETRY_MAX_DELAY) -> float:
+    """
+    Seconds to wait before retry number `attempt` (from 1): exponential with full jitter,
+    so pages throttled together do not all come back at the same moment.
+    """
+    return random.uniform(0, min(cap, base * (1 << max(0, attempt - 1))))
+
+
+def retry_after(headers: Optional[Mapping[str, str]]) -> Optional[float]:
+    """Seconds asked for by a `Retry-After` header, given as seconds or as an HTTP date."""
+    value = next((v for k, v in (headers or {}).items() if k.lower() == "retry-after"), None)
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class Throttled(Exception):
+    """The host answered 429 or 503; the page should be tried again later."""
+
+
+def requeue_later(queue: asyncio.Queue, item: Any, delay: float, pending: Set[asyncio.Task]):
+    """
+    Puts `item` back on `queue` after `delay` seconds, without holding up a worker.
+
+    The get() the item came from is only marked done once it is back on the queue, so the
+    caller must not call task_done() for it, and `queue.join()` waits for the retry too.
+    The task is kept in `pending` until it has run, so it can be cancelled on shutdown.
+    """
+    async def requeue():
+        await asyncio.sleep(delay)
+        await queue.put(item)
+        queue.task_done()
+
+    task = asyncio.create_task(requeue())
+    pending.add(task)
+    task.add_done_callback(pending.discard)
+
+
+class _HostState:
+    __slots__ = ("rate", "next_slot", "blocked_until", "throttle_streak", "latency", "best_latency",
+                 "last_slowdown", "recent")
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.next_slot = 0.0
+        self.blocked_until = 0.0
+        self.throttle_streak = 0
+        self.latency = None
+        self.best_latency = None
+        self.last_slowdown = 0.0
+        # When the most recent requests were sent, to measure the rate actually reached
+        self.recent = deque(maxlen=32)
+
+    def measured(self) -> bool:
+        return len(self.recent) >= 2 and self.recent[-1] > self.recent[0]
+
+    def observed_rate(self) -> float:
+        if not self.measured():
+            return self.rate
+        return (len(self.recent) - 1) / (self.recent[-1] - self.recent[0])
+
+
+class AdaptiveRateLimiter:
+    """
+    Per-host token bucket (with a burst of one) whose rate follows how the host responds.
+
+    `rate` is the most requests per second any host is sent, 0 for no limit until a host
+    pushes back. A 429 or 503 halves the host's rate (the rate it was actually sent, or
+    `THROTTLE_START_RATE` before that could be measured) and pauses it for the `Retry-After`
+    the server asked for, or an exponential backoff. Responses that get much slower than
+    the host's best also bring the rate down, and every other response raises it again a
+    little at a time, up to `rate`.
+    """
+
+    def __init__(self, rate: float = 0.0, min_rate: float = MIN_HOST_RATE):
+        self.max_rate = rate
+        self.min_rate = min(min_rate, rate) if rate > 0 else min_rate
+        self.throttled = Counter()
+        self._hosts: Dict[str, _HostState] = {}
+
+    def _host(self, url: str) -> _HostState:
+        host = urlparse(url).netloc
+        state = self._hosts.get(host)
+        if state is None:
+            state = self._hosts[host] = _HostState(self.max_rate)
+        return state
+
+    async def wait(self, url: str):
+        """Waits for the host's next free slot and any pause it asked for, then claims the slot."""
+        state = self._host(url)
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            slot = max(now, state.next_slot, state.blocked_until)
+            if slot <= now:
+                break
+            if state.rate:
+                # Reserve the slot before sleeping so concurrent workers queue up behind it
+                state.next_slot = slot + 1.0 / state.rate
+                await asyncio.sleep(slot - now)
+                # A pause that started while this request slept still applies
+                if state.blocked_until <= loop.time():
+                    break
+            else:
+                await asyncio.sleep(slot - now)
+        if state.rate and state.next_slot <= now:
+            state.next_slot = now + 1.0 / state.rate
+        state.recent.append(loop.time())
+
+    def record(self, url: str, status_code: Optional[int] = None, latency: Optional[float] = None,
+               headers: Optional[Mapping[str, str]] = None) -> bool:
+        """
+        Adapts the host's rate to one response. `status_code` is None when the request
+        failed without a response, which changes nothing.
+
+        Returns:
+            bool: True if the host throttled the request and it should be retried later.
+        """
+        if status_code is None:
+            return False
+        state = self._host(url)
+        now = asyncio.get_running_loop().time()
+
+        if status_code in THROTTLE_STATUSES:
+            self.throttled[urlparse(url).netloc] += 1
+            # Requests sent together are throttled together; back off once per pause
+            if now >= state.blocked_until:
+                state.throttle_streak += 1
+                if state.measured():
+                    current = min(state.rate or float("inf"), state.observed_rate())
+                else:
+                    # Nothing measured yet: falling to the floor would take minutes to recover from
+                    current = state.rate or THROTTLE_START_RATE
+                state.rate = max(self.min_rate, current / 2)
+            pause = retry_after(headers)
+            if pause is None:
+                pause = backoff_delay(state.throttle_streak)
+            state.blocked_until = max(state.blocked_until, now + min(pause, RETRY_MAX_DELAY))
+            state.next_slot = max(state.next_slot, state.blocked_until)
+            return True
+
+        state.throttle_streak = 0
+        if latency is not None and status_code < 500:
+            state.latency = latency if state.latency is None else \
+                (1 - LATENCY_WEIGHT) * state.latency + LATENCY_WEIGHT * latency
+            state.best_latency = state.latency if state.best_latency is None else min(state.best_latency, state.latency)
+            if state.latency > SLOW_RESPONSE_FACTOR * state.best_latency and state.best_latency > 0:
+                # Concurrent slow responses arrive together; slow down once per second at most
+                current = state.rate or state.observed_rate()
+                if current and now - state.last_slowdown >= 1.0:
+                    state.last_slowdown = now
+                    state.rate = max(self.min_rate, 0.9 * current)
+                return False
+
+        if state.rate:
+            # Additive increase: about RATE_INCREASE more requests per second, every second
+            ceiling = self.max_rate or 2 * max(state.observed_rate(), self.min_rate)
+            state.rate = min(ceiling, state.rate + RATE_INCREASE / state.rate)
+        return False
+
+    def print_stats(self):
+        if not self.throttled:
+            return
+        for host, count in self.throttled.most_common():
+            rate = self._hosts[host].rate
+            print(f"  - {host}: throttled {count} time(s), now limited to {rate:.2f} requests/s")
+
+
+class DispatcherRateLimiter(RateLimiter):
+    """
+    Lets crawl4ai's `arun_many` dispatchers wait on an AdaptiveRateLimiter. Responses are
+    recorded by the caller, which also sees their `Retry-After` headers.
+    """
+
+    def __init__(self, limiter: AdaptiveRateLimiter):
+        super().__init__()
+        self.limiter = limiter
+
+    async def wait_if_needed(self, url: str) -> None:
+        await self.limiter.wait(url)
+
+    def update_delay(self, url: str, status_code: int) -> bool:
+        return True
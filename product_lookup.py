@@ -0,0 +1,254 @@
+import re
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from product_search import tokenize
+
+# Share of a name's trigrams a product name must contain to match it
+MIN_NAME_MATCH = 0.75
+# Share of a search's trigrams a product name must contain to be listed for it
+MIN_SEARCH_MATCH = 0.6
+# How much closer the best name match must be than the next one to be taken as the product meant
+NAME_MATCH_MARGIN = 0.15
+# Most products listed in one answer
+MAX_LISTED = 10
+
+GREETING = "Hello, and thank you for contacting Najjar Online!"
+CLOSING = "If there is anything else I can help you with, please let me know."
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+# Thousands separated with commas ("1,299.50"), or a decimal point or comma ("12.5", "12,5")
+_AMOUNT = r"(?:\$|£|€|usd|gbp|eur|lbp)?\s*(\d{1,3}(?:,\d{3})+(?:\.\d+)?|\d+(?:[.,]\d+)?)\s*(?:\$|£|€|usd|gbp|eur|lbp|dollars?|pounds?|euros?)?"
+_BETWEEN_RE = re.compile(r"\bbetween\s+" + _AMOUNT + r"\s*(?:and|to|-)\s*" + _AMOUNT)
+_UNDER_RE = re.compile(r"\b(?:under|below|less than|cheaper than|up to|at most|no more than|max(?:imum)?)\s+" + _AMOUNT)
+_OVER_RE = re.compile(r"\b(?:over|above|more than|more expensive than|at least|min(?:imum)?)\s+" + _AMOUNT)
+_PRICE_OF_RES = (
+    re.compile(r"^(?:what(?:'s| is| are)|tell me|can you tell me|give me)?\s*(?:the\s+)?(?:price|cost)s?\s+(?:of|for)\s+(?:the\s+|a\s+|an\s+)?(.+)$"),
+    re.compile(r"^how much (?:is|are|does|do|for|would)\s+(?:the\s+|a\s+|an\s+)?(.+?)(?:\s+cost)?$"),
+    re.compile(r"^(.+?)\s+(?:price|cost)$"),
+)
+_SEARCH_RE = re.compile(r"^(?:do you (?:have|sell|carry|stock)|have you got|is there|are there|search(?: for)?|find|show me|"
+                        r"list|i(?:'m| am) looking for|looking for|i want|i need)\s+(?:any\s+|a\s+|an\s+|the\s+|some\s+|all\s+)?(.+)$")
+# Questions that need judgement, not a lookup
+_OPEN_ENDED = frozenset("""
+    best better cheapest compare comparison difference different recommend recommendation suggest should which why
+    gift good worth review reviews similar like alternative alternatives vs versus popular deal deals discount
+""".split())
+# Words that name no product, as in "anything under $20"
+_GENERIC = frozenset("anything something things thing stuff everything one ones options cheap".split())
+
+
+def trigrams(text: Optional[str]) -> Set[str]:
+    """Trigrams of each word, padded like PostgreSQL's pg_trgm, so word starts count more."""
+    grams = set()
+    for word in _WORD_RE.findall(str(text or "").lower()):
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+def _price(product: dict) -> Optional[float]:
+    try:
+        return float(product.get("price"))
+    except (TypeError, ValueError):
+        return None
+
+
+def _amount(text: str) -> float:
+    # A comma followed by exactly three digits separates thousands, as in "$1,299"
+    if re.fullmatch(r"\d{1,3}(?:,\d{3})+(?:\.\d+)?", text):
+        return float(text.replace(",", ""))
+    return float(text.replace(",", "."))
+
+
+def _singular(text: str) -> str:
+    return " ".join(word[:-1] if len(word) > 3 and word.endswith("s") and not word.endswith("ss") else word
+                    for word in text.split())
+
+
+class ProductLookup:
+    """
+    Answers questions that are lookups straight from the products, without the LLM.
+
+    It keeps a trigram index over product names, for names spelled a little differently
+    or only in part, and the products sorted by price, for price ranges. `answer`
+    recognizes three kinds of question: the price of a named product ("how much is
+    Book 17?"), products in a price range ("anything under $20?", "books between 10
+    and 15") and name searches ("do you have harry potter?"). Anything else, or a lookup
+    that finds nothing, returns None and is left to the LLM. `products` is the dict of
+    products the index is built from, shared with the agent's ProductIndex; call `update`
+    with the keys of the products that changed in it.
+    """
+
+    def __init__(self, products: Dict[object, dict]):
+        self.products = products
+        self.counts = Counter()
+        self._postings: Dict[str, Set] = {}
+        self._names: Dict[object, Tuple[str, Set[str]]] = {}
+        # Prices in ascending order, and the product of each
+        self._prices: List[float] = []
+        self._price_keys: List = []
+        self._price_of_key: Dict[object, float] = {}
+
+    def _unindex(self, key):
+        name = self._names.pop(key, None)
+        if name is not None:
+            for gram in name[1]:
+                postings = self._postings.get(gram)
+                if postings is not None:
+                    postings.discard(key)
+                    if not postings:
+                        del self._postings[gram]
+        price = self._price_of_key.pop(key, None)
+        if price is not None:
+            start = bisect_left(self._prices, price)
+            i = self._price_keys.index(key, start, bisect_right(self._prices, price))
+            del self._prices[i], self._price_keys[i]
+
+    def update(self, keys: Iterable):
+        """Re-indexes the products with `keys`, and drops those no longer in `products`."""
+        for key in keys:
+            self._unindex(key)
+            product = self.products.get(key)
+            if product is None:
+                continue
+            grams = trigrams(product.get("name"))
+            self._names[key] = (" ".join(_WORD_RE.findall(str(product.get("name") or "").lower())), grams)
+            for gram in grams:
+                self._postings.setdefault(gram, set()).add(key)
+            price = _price(product)
+            if price is not None:
+                i = bisect_right(self._prices, price)
+                self._prices.insert(i, price)
+                self._price_keys.insert(i, key)
+                self._price_of_key[key] = price
+
+    def match_names(self, text: str, min_match: float) -> List[Tuple[object, float, float]]:
+        """
+        Products whose name contains at least `min_match` of the trigrams of `text`, and every
+        number in it, as (key, share of `text` matched, similarity of the whole names), closest
+        first. Numbers must match exactly, so "book 170" is not taken for "Book 17".
+        """
+        numbers = {word for word in _WORD_RE.findall(text.lower()) if word.isdigit()}
+        grams = trigrams(text)
+        if not grams:
+            return []
+        shared = Counter()
+        for gram in grams:
+            for key in self._postings.get(gram, ()):
+                shared[key] += 1
+        matches = []
+        for key, count in shared.items():
+            contained = count / len(grams)
+            if contained >= min_match and numbers <= set(self._names[key][0].split()):
+                matches.append((key, contained, 2 * count / (len(grams) + len(self._names[key][1]))))
+        matches.sort(key=lambda match: (match[1], match[2]), reverse=True)
+        return matches
+
+    def in_price_range(self, low: float = 0.0, high: float = float("inf")) -> List:
+        """Keys of the products priced from `low` to `high`, cheapest first."""
+        return self._price_keys[bisect_left(self._prices, low):bisect_right(self._prices, high)]
+
+    def _line(self, key, details: bool = False) -> str:
+        product = self.products[key]
+        price = _price(product)
+        line = f"- **{product.get('name')}**: " + (
+            f"{price:.2f} {product.get('currency') or ''}".rstrip() if price is not None else "price not listed")
+        if product.get("url"):
+            line += f" ({product['url']})"
+        description = str(product.get("description") or "").strip()
+        if details and description:
+            line += f"\n  {description[:300]}{'...' if len(description) > 300 else ''}"
+        return line
+
+    def _reply(self, answer: str, keys: List, details: bool = False) -> str:
+        lines = [GREETING, "", answer, ""] + [self._line(key, details) for key in keys[:MAX_LISTED]]
+        if len(keys) > MAX_LISTED:
+            lines.append(f"- ... and {len(keys) - MAX_LISTED} more")
+        return "\n".join(lines + ["", CLOSING])
+
+    def _price_of(self, name: str) -> Optional[str]:
+        matches = self.match_names(name, MIN_NAME_MATCH)
+        if not matches:
+            return None
+        wanted = " ".join(_WORD_RE.findall(name))
+        exact = [key for key, _, _ in matches if self._names[key][0] == wanted]
+        if exact or len(matches) == 1 or matches[0][2] - matches[1][2] >= NAME_MATCH_MARGIN:
+            key = exact[0] if exact else matches[0][0]
+            product = self.products[key]
+            price = _price(product)
+            if price is None:
+                return self._reply(f"**{product.get('name')}** does not have a listed price at the moment.", [key], True)
+            currency = f" {product.get('currency')}" if product.get("currency") else ""
+            return self._reply(f"**{product.get('name')}** is priced at **{price:.2f}{currency}**.", [key], True)
+        keys = [key for key, _, _ in matches]
+        return self._reply(f"Several products match \"{name}\". Here are their prices:", keys)
+
+    def _price_range(self, question: str, match: re.Match, low: float, high: float) -> Optional[str]:
+        rest = question[:match.start()] + " " + question[match.end():]
+        search = _SEARCH_RE.match(rest.strip())
+        words = [word for word in tokenize(search.group(1) if search else rest) if word not in _GENERIC]
+        keys = self.in_price_range(low, high)
+        if words:
+            named = {key for key, _, _ in self.match_names(_singular(" ".join(words)), MIN_SEARCH_MATCH)}
+            keys = [key for key in keys if key in named]
+        if not keys:
+            return None
+        what = f"{len(keys)} {'product' if len(keys) == 1 else 'products'}" + (f" matching \"{' '.join(words)}\"" if words else "")
+        if high == float("inf"):
+            where = f"priced at {low:.2f} or more"
+        elif low:
+            where = f"priced between {low:.2f} and {high:.2f}"
+        else:
+            where = f"priced at {high:.2f} or less"
+        return self._reply(f"We have {what} {where}, from the cheapest:", keys)
+
+    def _search(self, text: str) -> Optional[str]:
+        words = [word for word in tokenize(text) if word not in _GENERIC]
+        if not words:
+            return None
+        matches = self.match_names(_singular(" ".join(words)), MIN_SEARCH_MATCH)
+        if not matches:
+            return None
+        keys = [key for key, _, _ in matches]
+        found = "one product" if len(keys) == 1 else f"{len(keys)} products"
+        return self._reply(f"Yes, we have {found} matching \"{' '.join(words)}\":", keys, len(keys) == 1)
+
+    def answer(self, question: str) -> Optional[str]:
+        """The answer to a lookup question, in the agent's markdown layout, or None for the LLM."""
+        text = " ".join(question.lower().replace("?", " ").replace("!", " ").split()).rstrip(".")
+        if not text or not self._names or _OPEN_ENDED.intersection(_WORD_RE.findall(text)):
+            self.counts["to_llm"] += 1
+            return None
+        intent, reply = None, None
+        between, under, over = _BETWEEN_RE.search(text), _UNDER_RE.search(text), _OVER_RE.search(text)
+        if between:
+            low, high = sorted((_amount(between.group(1)), _amount(between.group(2))))
+            intent, reply = "price_range", self._price_range(text, between, low, high)
+        elif under or over:
+            match = under or over
+            low, high = (0.0, _amount(match.group(1))) if under else (_amount(match.group(1)), float("inf"))
+            intent, reply = "price_range", self._price_range(text, match, low, high)
+        else:
+            for pattern in _PRICE_OF_RES:
+                match = pattern.match(text)
+                if match:
+                    intent, reply = "price_of", self._price_of(match.group(1).strip())
+                    break
+            else:
+                match = _SEARCH_RE.match(text)
+                if match:
+                    intent, reply = "search", self._search(match.group(1))
+        if reply is None:
+            self.counts["to_llm"] += 1
+            if intent:
+                self.counts[f"{intent}_not_found"] += 1
+            return None
+        self.counts[intent] += 1
+        return reply
+
+    def metrics(self) -> dict:
+        return {name: self.counts[name] for name in ("price_of", "price_range", "search", "to_llm",
+                                                     "price_of_not_found", "price_range_not_found",
+                                                     "search_not_found")}
@@ -0,0 +1,145 @@
+import os
+import re
+import math
+import heapq
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# BM25 term-frequency saturation and length normalization
+BM25_K1 = 1.5
+BM25_B = 0.75
+# A word in the product name counts as much as this many in the description
+NAME_WEIGHT = 3
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+_STOPWORDS = frozenset("""
+    a an and are as at be by do does for from have has how i in is it me my of on or please
+    show tell that the their there these this to us we what when where which who with you your
+    price prices cost much many available availability buy sell stock product products item items
+""".split())
+
+
+def tokenize(text: Optional[str]) -> List[str]:
+    """Lowercase word tokens, without stopwords and words every shopping question has; digits are kept, so ISBNs and sizes match."""
+    if not text:
+        return []
+    return [token for token in _TOKEN_RE.findall(str(text).lower()) if token not in _STOPWORDS]
+
+
+def product_key(product: dict):
+    """What identifies a product row: its canonical URL, or its id for rows stored without one."""
+    return product.get("url") or product.get("id") or product.get("name")
+
+
+class ProductIndex:
+    """
+    In-memory BM25 index over product names and descriptions.
+
+    Each product is one document, with its name weighted `NAME_WEIGHT` times. Postings are
+    kept per term, so a search only touches the products that share a word with the
+    question, and `update`/`remove` re-index just the products that changed.
+    """
+
+    def __init__(self):
+        self.products: Dict[object, dict] = {}
+        self._postings: Dict[str, Dict[object, int]] = {}
+        self._lengths: Dict[object, int] = {}
+        # What each product was indexed from, to skip rows that did not change
+        self._indexed: Dict[object, Tuple] = {}
+        self._total_length = 0
+
+    def __len__(self) -> int:
+        return len(self.products)
+
+    def _terms(self, product: dict) -> Counter:
+        terms = Counter(tokenize(product.get("description")))
+        for token in tokenize(product.get("name")):
+            terms[token] += NAME_WEIGHT
+        return terms
+
+    def _unindex(self, key):
+        for term in self._indexed.pop(key, (None, ()))[1]:
+            postings = self._postings.get(term)
+            if postings is not None:
+                postings.pop(key, None)
+                if not postings:
+                    del self._postings[term]
+        self._total_length -= self._lengths.pop(key, 0)
+        self.products.pop(key, None)
+
+    def update(self, products: Iterable[dict]) -> int:
+        """Adds new products and re-indexes changed ones; returns how many were (re-)indexed."""
+        changed = 0
+        for product in products:
+            key = product_key(product)
+            if key is None:
+                continue
+            source = (product.get("name"), product.get("description"))
+            self.products[key] = product
+            indexed = self._indexed.get(key)
+            if indexed is not None and indexed[0] == source:
+                continue
+            self._unindex(key)
+            self.products[key] = product
+            terms = self._terms(product)
+            for term, count in terms.items():
+                self._postings.setdefault(term, {})[key] = count
+            length = sum(terms.values())
+            self._lengths[key] = length
+            self._total_length += length
+            self._indexed[key] = (source, tuple(terms))
+            changed += 1
+        return changed
+
+    def remove(self, keys: Iterable) -> int:
+        removed = 0
+        for key in keys:
+            if key in self.products:
+                self._unindex(key)
+                removed += 1
+        return removed
+
+    def sync(self, products: List[dict]) -> Tuple[int, int]:
+        """Makes the index match `products` (the whole table); returns (re-indexed, removed)."""
+        keys = {product_key(product) for product in products}
+        removed = self.remove([key for key in self.products if key not in keys])
+        return self.update(products), removed
+
+    def search(self, query: str, k: int = 20) -> List[dict]:
+        """The `k` products that best match `query`, best first; empty if no word matches."""
+        terms = set(tokenize(query))
+        if not terms or not self.products:
+            return []
+        count = len(self.products)
+        average_length = self._total_length / count or 1.0
+        scores: Dict[object, float] = {}
+        for term in terms:
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for key, frequency in postings.items():
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self._lengths[key] / average_length)
+                scores[key] = scores.get(key, 0.0) + idf * frequency * (BM25_K1 + 1) / (frequency + norm)
+        best = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+        return [self.products[key] for key, _ in best]
+
+
+if __name__ == "__main__":
+    # Searches the stored products, e.g. python product_search.py "harry potter price"
+    import sys
+    import time
+    from storage import get_storage
+
+    PRODUCTS_TABLE_NAME = os.environ.get("PRODUCTS_TABLE_NAME", "products")
+    storage = get_storage()
+    started = time.perf_counter()
+    index = ProductIndex()
+    index.update(storage.select_all(PRODUCTS_TABLE_NAME))
+    print(f"Indexed {len(index)} products in {time.perf_counter() - started:.2f}s")
+    query = " ".join(sys.argv[1:])
+    started = time.perf_counter()
+    results = index.search(query, k=10)
+    print(f"{len(results)} results for {query!r} in {(time.perf_counter() - started) * 1000:.1f} ms:")
+    for product in results:
+        print(f"  {product.get('name')} - {product.get('price')} {product.get('currency') or ''}")
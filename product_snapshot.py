@@ -0,0 +1,171 @@
+import os
+import time
+import asyncio
+from collections import Counter
+from typing import Callable, List, Optional, Set, Tuple
+
+from storage import Storage
+from product_search import ProductIndex, product_key, tokenize
+
+# Seconds between checks for products written since the last refresh
+SNAPSHOT_REFRESH_INTERVAL = float(os.environ.get("SNAPSHOT_REFRESH_INTERVAL", "30"))
+# Seconds between full reloads, which also drop deleted products
+SNAPSHOT_FULL_RELOAD_INTERVAL = float(os.environ.get("SNAPSHOT_FULL_RELOAD_INTERVAL", "3600"))
+# Timestamp columns tried, in order, as the watermark of incremental refreshes
+WATERMARK_COLUMNS = ("updated_at", "created_at")
+
+
+def _content(row: dict) -> dict:
+    return {name: value for name, value in row.items() if name not in WATERMARK_COLUMNS}
+
+
+def _words(row: Optional[dict]) -> Set[str]:
+    return set(tokenize(row.get("name")) + tokenize(row.get("description"))) if row else set()
+
+
+class ProductSnapshot:
+    """
+    The products table held in memory, with its search index, for the agent to answer from.
+
+    `refresh` loads the whole table the first time. After that it only asks storage for
+    the rows whose `updated_at` (or, for tables without one, `created_at`) is at or after
+    the newest value seen, and re-indexes those. Every `full_reload_interval` seconds the
+    whole table is read again, which drops deleted products and picks up updates the
+    watermark column does not record. `version` goes up whenever a product changes, and
+    each of `listeners` is called with the keys of the products that changed and the
+    search words in their old and new names and descriptions.
+    """
+
+    def __init__(self, storage: Storage, table: str, index: Optional[ProductIndex] = None,
+                 refresh_interval: float = SNAPSHOT_REFRESH_INTERVAL,
+                 full_reload_interval: float = SNAPSHOT_FULL_RELOAD_INTERVAL):
+        self.storage = storage
+        self.table = table
+        self.index = index if index is not None else ProductIndex()
+        self.refresh_interval = refresh_interval
+        self.full_reload_interval = full_reload_interval
+        self.column: Optional[str] = None
+        self.watermark = None
+        self.version = 0
+        self.counts = Counter()
+        self.listeners: List[Callable[[Set, Set[str]], None]] = []
+        self.last_error: Optional[str] = None
+        self._refreshed_at: Optional[float] = None
+        self._full_reload_at: Optional[float] = None
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def loaded(self) -> bool:
+        return self._refreshed_at is not None
+
+    def _fetch(self, full: bool) -> Tuple[List[dict], bool]:
+        if full:
+            return self.storage.select_all(self.table), True
+        rows = self.storage.select_since(self.table, self.column, self.watermark)
+        if self.column != WATERMARK_COLUMNS[0] and any(WATERMARK_COLUMNS[0] in row for row in rows):
+            # The table has started keeping updated_at since the last full reload; upserts
+            # leave created_at alone, so switch over with one more full read
+            return self.storage.select_all(self.table), True
+        return rows, False
+
+    def _apply(self, rows: List[dict], full: bool) -> Set:
+        changed, words = set(), set()
+        for row in rows:
+            old = self.index.products.get(product_key(row))
+            if _content(old or {}) != _content(row):
+                changed.add(product_key(row))
+                words |= _words(old) | _words(row)
+        if full:
+            keys = {product_key(row) for row in rows}
+            removed = [key for key in self.index.products if key not in keys]
+            for key in removed:
+                words |= _words(self.index.products[key])
+            self.index.sync(rows)
+            changed.update(removed)
+            self.column = next((column for column in WATERMARK_COLUMNS if rows and column in rows[0]), None)
+            self.watermark = None
+        else:
+            self.index.update(rows)
+        if self.column:
+            newest = max((row[self.column] for row in rows if row.get(self.column) is not None), default=None)
+            if newest is not None and (self.watermark is None or newest > self.watermark):
+                self.watermark = newest
+        if changed:
+            self.version += 1
+            for listener in self.listeners:
+                listener(changed, words)
+        return changed
+
+    async def refresh(self, full: bool = False) -> Set:
+        """
+        Brings the snapshot up to date, reading only what changed unless `full` is set or a
+        full reload is due. Returns the keys of the products that were added, changed or removed.
+        """
+        async with self._lock:
+            now = time.monotonic()
+            full = (full or self.watermark is None
+                    or now - self._full_reload_at >= self.full_reload_interval)
+            try:
+                # Storage clients block, so the read runs in a thread; the index is only
+                # changed here, on the event loop, between requests
+                rows, full = await asyncio.to_thread(self._fetch, full)
+            except Exception as e:
+                self.counts["errors"] += 1
+                self.last_error = str(e)
+                raise
+            changed = self._apply(rows, full)
+            self.counts["full_reloads" if full else "refreshes"] += 1
+            self.counts["rows_read"] += len(rows)
+            self.counts["products_changed"] += len(changed)
+            self.last_error = None
+            self._refreshed_at = time.time()
+            if full:
+                self._full_reload_at = now
+            return changed
+
+    async def get(self) -> ProductIndex:
+        """The index to answer a question from; only loads storage if nothing is loaded yet."""
+        if self.loaded:
+            self.counts["hits"] += 1
+        else:
+            self.counts["misses"] += 1
+            await self.refresh(full=True)
+        return self.index
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                print(f"Could not refresh the product snapshot: {e}")
+
+    def start(self):
+        """Starts refreshing in the background, every `refresh_interval` seconds."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def metrics(self) -> dict:
+        return {
+            "products": len(self.index),
+            "version": self.version,
+            "watermark_column": self.column,
+            "watermark": self.watermark,
+            "refreshed_at": self._refreshed_at,
+            # Seconds since storage was last read successfully; changes written since are not served yet
+            "staleness_seconds": None if self._refreshed_at is None else round(time.time() - self._refreshed_at, 3),
+            "refresh_interval": self.refresh_interval,
+            "last_error": self.last_error,
+            **{name: self.counts[name] for name in ("hits", "misses", "refreshes", "full_reloads",
+                                                     "rows_read", "products_changed", "errors")},
+        }
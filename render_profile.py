@@ -0,0 +1,200 @@
+import os
+import json
+import time
+import asyncio
+from collections import Counter
+from typing import Mapping, Optional
+from urllib.parse import urlparse
+
+from crawl4ai import AsyncWebCrawler, BrowserConfig, CrawlerRunConfig
+from dotenv import load_dotenv
+from page_cache import render_key
+
+load_dotenv()
+
+# How extraction renders pages in the browser: "lean" blocks what extraction never reads
+RENDER_PROFILE = os.environ.get("RENDER_PROFILE", "lean")
+RENDER_PROFILES = ("lean", "default")
+# Resource types the lean profile does not download; the DOM still has every src attribute
+RENDER_BLOCK_TYPES = os.environ.get("RENDER_BLOCK_TYPES", "image,media,font")
+# More hosts to block, and third-party hosts whose scripts the store needs to render
+RENDER_BLOCK_DOMAINS = os.environ.get("RENDER_BLOCK_DOMAINS", "")
+RENDER_ALLOW_DOMAINS = os.environ.get("RENDER_ALLOW_DOMAINS", "")
+# How long the lean profile waits for the product fields before loading the page again without waiting (ms)
+RENDER_WAIT_TIMEOUT = int(os.environ.get("RENDER_WAIT_TIMEOUT", "15000"))
+
+# Analytics, ads and session-recording hosts; matched on the host and all its subdomains
+TRACKER_DOMAINS = (
+    "google-analytics.com", "googletagmanager.com", "googlesyndication.com", "googleadservices.com",
+    "doubleclick.net", "adservice.google.com", "facebook.net", "connect.facebook.net", "hotjar.com",
+    "clarity.ms", "scorecardresearch.com", "amazon-adsystem.com", "adnxs.com", "criteo.com",
+    "taboola.com", "outbrain.com", "mixpanel.com", "segment.com", "segment.io", "newrelic.com",
+    "nr-data.net", "tiktok.com", "snapchat.com", "pinterest.com", "bing.com", "yandex.ru",
+)
+
+
+def _split(value: str) -> tuple:
+    return tuple(item.strip().lower() for item in value.split(",") if item.strip())
+
+
+def _matches(host: str, domains: tuple) -> bool:
+    return any(host == domain or host.endswith("." + domain) for domain in domains)
+
+
+def _site(host: str) -> str:
+    """The last two labels of a host, close enough to tell first-party from third-party hosts."""
+    return ".".join(host.rsplit(".", 2)[-2:])
+
+
+def wait_for_fields(*selectors: str) -> str:
+    """A crawl4ai `wait_for` condition that holds once every selector matches an element with text."""
+    return ("js:() => " + json.dumps(list(selectors))
+            + ".every(s => { const el = document.querySelector(s); return el && el.textContent.trim(); })")
+
+
+def print_render_stats(counts: Mapping[str, float]):
+    pages = counts["render_pages"]
+    if not pages:
+        return
+    print(f"  - Browser renders: {pages}, {counts['render_time'] / pages:.2f}s and "
+          f"{counts['render_bytes'] / pages / 1024:.0f} KB transferred per page "
+          f"({counts['render_requests'] / pages:.1f} requests, {counts['render_blocked'] / pages:.1f} blocked)")
+    if counts["render_wait_timeouts"]:
+        print(f"  - Loaded again without waiting, product fields never appeared: {counts['render_wait_timeouts']}")
+
+
+class RenderProfile:
+    """
+    How the browser tier renders a page, and what it costs.
+
+    The "default" profile is a stock browser that loads everything. The "lean" profile
+    aborts requests for images, media and fonts, for known trackers and for scripts from
+    other sites (unless allowed with `RENDER_ALLOW_DOMAINS`), turns off Chromium's
+    background services, and returns the page as soon as `wait_for` holds instead of
+    waiting out the load. crawl4ai fails a page whose `wait_for` never holds, as on an
+    out-of-stock page without a price, so after `RENDER_WAIT_TIMEOUT` such a page is
+    loaded once more without waiting and returned as it is. Both profiles count the
+    pages, render time, bytes transferred and blocked requests in `counts`.
+    """
+
+    def __init__(self, name: str = RENDER_PROFILE, wait_for: Optional[str] = None):
+        if name not in RENDER_PROFILES:
+            raise ValueError(f"Unknown render profile {name!r}; expected one of {', '.join(RENDER_PROFILES)}")
+        self.name = name
+        self.wait_for = wait_for if name == "lean" else None
+        self.block_types = frozenset(_split(RENDER_BLOCK_TYPES))
+        self.block_domains = TRACKER_DOMAINS + _split(RENDER_BLOCK_DOMAINS)
+        self.allow_domains = _split(RENDER_ALLOW_DOMAINS)
+        self.counts = Counter()
+
+    def browser_config(self) -> BrowserConfig:
+        if self.name == "default":
+            return BrowserConfig()
+        return BrowserConfig(
+            headless=True,
+            verbose=False,
+            light_mode=True,
+            extra_args=["--disable-gpu", "--disable-dev-shm-usage", "--no-sandbox",
+                        "--blink-settings=imagesEnabled=false"],
+        )
+
+    def run_config(self, **settings) -> CrawlerRunConfig:
+        if self.name == "lean":
+            if self.wait_for:
+                settings.setdefault("wait_for", self.wait_for)
+                settings.setdefault("wait_for_timeout", RENDER_WAIT_TIMEOUT)
+            settings.setdefault("delay_before_return_html", 0)
+        return CrawlerRunConfig(**settings)
+
+    def cache_key(self) -> str:
+        """The page cache's render key for pages this profile renders."""
+        config = self.run_config()
+        if self.name == "default":
+            return render_key(browser="default", page_timeout=config.page_timeout, wait_for=config.wait_for)
+        return render_key(browser=self.name, page_timeout=config.page_timeout, wait_for=config.wait_for,
+                          block_types=sorted(self.block_types), block_domains=sorted(self.block_domains),
+                          allow_domains=sorted(self.allow_domains))
+
+    async def start_crawler(self) -> AsyncWebCrawler:
+        crawler = AsyncWebCrawler(config=self.browser_config())
+        crawler.crawler_strategy.set_hook("on_page_context_created", self._on_page_context_created)
+        await crawler.start()
+        return crawler
+
+    async def arun(self, crawler: AsyncWebCrawler, url: str, config: CrawlerRunConfig):
+        started = time.perf_counter()
+        try:
+            result = await crawler.arun(url=url, config=config)
+            if (not result.success and config.wait_for
+                    and "Wait condition failed" in (result.error_message or "")):
+                self.counts["render_wait_timeouts"] += 1
+                result = await crawler.arun(url=url, config=config.clone(wait_for=None))
+            return result
+        finally:
+            self.counts["render_pages"] += 1
+            self.counts["render_time"] += time.perf_counter() - started
+
+    async def _on_page_context_created(self, page, context=None, **kwargs):
+        first_party = None
+
+        async def route(route):
+            nonlocal first_party
+            request = route.request
+            host = (urlparse(request.url).hostname or "").lower()
+            if first_party is None and request.is_navigation_request():
+                first_party = _site(host)
+            if (request.resource_type in self.block_types or _matches(host, self.block_domains)
+                    or (request.resource_type == "script" and first_party is not None
+                        and _site(host) != first_party and not _matches(host, self.allow_domains))):
+                self.counts["render_blocked"] += 1
+                await route.abort()
+            else:
+                await route.continue_()
+
+        async def on_finished(request):
+            self.counts["render_requests"] += 1
+            try:
+                sizes = await request.sizes()
+            except Exception:
+                # The page was closed before the sizes could be read
+                return
+            self.counts["render_bytes"] += sizes["responseHeadersSize"] + sizes["responseBodySize"]
+
+        page.on("requestfinished", on_finished)
+        if self.name == "lean":
+            await page.route("**/*", route)
+        return page
+
+
+if __name__ == "__main__":
+    # Renders the same pages with both profiles and compares their cost per page
+    import sys
+
+    urls = sys.argv[1:]
+    if not urls:
+        print("Usage: python render_profile.py URL [URL ...]")
+        sys.exit(1)
+    wait_for = wait_for_fields(os.environ.get("CSS_SELECTOR_NAME", "h1.title, .product-title"),
+                               os.environ.get("CSS_SELECTOR_PRICE", "div.product-price, .product-price-container"))
+
+    async def compare():
+        for name in RENDER_PROFILES[::-1]:
+            profile = RenderProfile(name, wait_for=wait_for)
+            config = profile.run_config(verbose=False)
+            crawler = await profile.start_crawler()
+            try:
+                print(f"\n{name} profile:")
+                for url in urls:
+                    before = Counter(profile.counts)
+                    result = await profile.arun(crawler, url, config)
+                    # Let the last requests report their sizes
+                    await asyncio.sleep(0.5)
+                    page = profile.counts - before
+                    print(f"  {url}: {page['render_time']:.2f}s, {page['render_bytes'] / 1024:.0f} KB, "
+                          f"{page['render_requests']} requests, {page['render_blocked']} blocked"
+                          + ("" if result.success else f" (failed: {result.error_message})"))
+                print_render_stats(profile.counts)
+            finally:
+                await crawler.close()
+
+    asyncio.run(compare())
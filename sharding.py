@@ -0,0 +1,157 @@
+import time
+import queue
+import asyncio
+import traceback
+import multiprocessing
+from collections import Counter
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from memory_controller import default_memory_limit_mb
+from supabase_writer import SupabaseWriter, WRITE_BATCH_SIZE, WRITE_FLUSH_INTERVAL
+from url_utils import url_fingerprint
+
+# Batches of rows in flight between the worker processes and the parent's writer. When
+# the channel is full, workers wait, so a slow database still slows every worker down.
+SHARD_CHANNEL_SIZE = 64
+
+
+def shard_of(url: str, workers: int) -> int:
+    """
+    The worker that owns `url`, from a stable 64-bit hash of the URL.
+
+    Python's own `hash()` is salted per process, so it cannot be used to split work
+    between processes. Every host's URLs are spread evenly over all workers, which is
+    what lets each worker enforce `1/workers` of the per-host rate limit.
+    """
+    return url_fingerprint(url) % workers
+
+
+def shard_urls(urls: List[str], shard: int, workers: int) -> List[str]:
+    return [url for url in urls if shard_of(url, workers) == shard]
+
+
+def shard_limits(workers: int, rate_limit: float = 0.0, memory_limit_mb: Optional[int] = None) -> Dict[str, Any]:
+    """Splits the per-host rate limit and the memory ceiling between `workers` processes."""
+    return {
+        "rate_limit": rate_limit / workers,
+        "memory_limit_mb": max(1, (memory_limit_mb or default_memory_limit_mb()) // workers),
+    }
+
+
+class ShardOutput:
+    """
+    The worker-process end of a sharded crawl, used in place of a SupabaseWriter.
+
+    Rows are sent to the parent in batches of `batch_size`, or sooner once the oldest row
+    has waited `flush_interval` seconds and another row comes in. Each row may carry a
+    `record` (for example its crawl state) that the parent receives with it. `close()`
+    sends what is left, then the worker's stats.
+    """
+
+    def __init__(self, channel, shard: int, batch_size: int = WRITE_BATCH_SIZE,
+                 flush_interval: float = WRITE_FLUSH_INTERVAL):
+        self.channel = channel
+        self.shard = shard
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.closed = False
+        self._batch = []
+        self._oldest = 0.0
+
+    async def put(self, row: dict, record: Any = None):
+        if not self._batch:
+            self._oldest = time.monotonic()
+        self._batch.append((row, record))
+        if len(self._batch) >= self.batch_size or time.monotonic() - self._oldest >= self.flush_interval:
+            await self.flush()
+
+    async def flush(self):
+        if self._batch:
+            batch, self._batch = self._batch, []
+            # Blocks while the parent's channel is full
+            await asyncio.to_thread(self.channel.put, ("rows", self.shard, batch))
+
+    async def close(self, stats: Optional[Dict[str, float]] = None):
+        if self.closed:
+            return
+        await self.flush()
+        self.closed = True
+        await asyncio.to_thread(self.channel.put, ("done", self.shard, dict(stats or {})))
+
+
+def _run_shard(target: Callable[..., Awaitable], shard: int, workers: int, channel, kwargs: Dict[str, Any]):
+    output = ShardOutput(channel, shard)
+    try:
+        asyncio.run(target(shard=(shard, workers), output=output, **kwargs))
+        if not output.closed:
+            # The target returned early; still hand over anything it produced
+            asyncio.run(output.close())
+    except Exception:
+        channel.put(("error", shard, traceback.format_exc()))
+
+
+def _receive(channel, timeout: float):
+    try:
+        return channel.get(timeout=timeout)
+    except queue.Empty:
+        return None
+
+
+async def run_sharded(target: Callable[..., Awaitable], workers: int, writer: SupabaseWriter,
+                      on_row: Optional[Callable[[dict, Any], bool]] = None, **kwargs) -> Counter:
+    """
+    Runs `target` in `workers` processes and stores what they produce through `writer`.
+
+    Each process calls `target(shard=(i, workers), output=ShardOutput, **kwargs)` with its
+    own event loop, browser and HTTP pool, so parsing, extraction and validation use one
+    core per worker. The rows workers send are handed to `writer`, which runs in this
+    process, so storage sees one batched stream no matter how many workers there are.
+    `on_row(row, record)` is called for every row before it is queued and may return
+    False to drop it.
+
+    Returns:
+        Counter: The stats reported by the workers, summed, plus "failed_workers".
+    """
+    # Forked children would inherit the parent's event loop and threads; spawn starts clean
+    context = multiprocessing.get_context("spawn")
+    channel = context.Queue(maxsize=SHARD_CHANNEL_SIZE)
+    processes = {}
+    for shard in range(workers):
+        process = context.Process(target=_run_shard, args=(target, shard, workers, channel, kwargs),
+                                  name=f"crawl-worker-{shard}")
+        process.start()
+        processes[shard] = process
+    print(f"Started {workers} worker processes.")
+
+    totals = Counter()
+    running = set(processes)
+    try:
+        while running:
+            message = await asyncio.to_thread(_receive, channel, 1.0)
+            if message is None:
+                for shard in sorted(running):
+                    if not processes[shard].is_alive():
+                        # Killed or out of memory; whatever it sent before has been received
+                        print(f"Worker {shard} exited with code {processes[shard].exitcode} before finishing.")
+                        totals["failed_workers"] += 1
+                        running.discard(shard)
+                continue
+
+            kind, shard, payload = message
+            if kind == "rows":
+                for row, record in payload:
+                    if on_row is None or on_row(row, record) is not False:
+                        await writer.put(row)
+            elif kind == "done":
+                totals.update(payload)
+                running.discard(shard)
+            elif kind == "error":
+                print(f"Worker {shard} failed:\n{payload}")
+                totals["failed_workers"] += 1
+                running.discard(shard)
+    finally:
+        for process in processes.values():
+            await asyncio.to_thread(process.join, 0 if running else 10)
+            if process.is_alive():
+                process.terminate()
+    return totals
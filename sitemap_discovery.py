@@ -0,0 +1,197 @@
+import asyncio
+import zlib
+from datetime import datetime, timezone
+from typing import AsyncIterator, Callable, Iterable, List, NamedTuple, Optional
+from urllib.parse import urljoin
+from xml.etree import ElementTree
+
+import requests
+from requests.adapters import HTTPAdapter
+
+CHUNK_SIZE = 64 * 1024
+BATCH_SIZE = 500  # entries handed from a parser thread to the event loop at a time
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+class _Stopped(Exception):
+    """Raised in parser threads once the consumer has stopped reading."""
+
+
+class SitemapEntry(NamedTuple):
+    loc: str
+    lastmod: Optional[str] = None
+
+
+def parse_lastmod(lastmod: Optional[str]) -> Optional[datetime]:
+    """Parses a W3C datetime from a sitemap (e.g. "2024-05-01" or "2024-05-01T10:00:00+00:00")."""
+    if not lastmod:
+        return None
+    try:
+        parsed = datetime.fromisoformat(lastmod.strip().replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def _local_name(tag: str) -> str:
+    return tag.rsplit("}", 1)[-1]
+
+
+def fetch_sitemap(session: requests.Session, sitemap_url: str, on_entry: Callable[[SitemapEntry], None]) -> List[str]:
+    """
+    Streams one sitemap (plain or gzipped) through an incremental XML parser.
+
+    Page entries are passed to `on_entry` as they are parsed and the element tree is
+    cleared behind them, so memory stays flat regardless of the sitemap's size.
+
+    Returns:
+        List[str]: Child sitemap URLs if this is a sitemap index, otherwise empty.
+    """
+    children = []
+    parser = ElementTree.XMLPullParser(events=("start", "end"))
+    decompressor = None
+    root = None
+    loc = lastmod = None
+
+    with session.get(sitemap_url, stream=True, timeout=60) as response:
+        response.raise_for_status()
+        first_chunk = True
+        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+            # .xml.gz files are served as plain binary, so sniff for the gzip header
+            if first_chunk:
+                first_chunk = False
+                if chunk[:2] == GZIP_MAGIC:
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            parser.feed(decompressor.decompress(chunk) if decompressor else chunk)
+
+            for event, elem in parser.read_events():
+                if event == "start":
+                    if root is None:
+                        root = elem
+                    continue
+                tag = _local_name(elem.tag)
+                if tag == "loc":
+                    loc = (elem.text or "").strip()
+                elif tag == "lastmod":
+                    lastmod = (elem.text or "").strip() or None
+                elif tag in ("url", "sitemap"):
+                    if loc:
+                        if tag == "sitemap":
+                            children.append(urljoin(sitemap_url, loc))
+                        else:
+                            on_entry(SitemapEntry(loc, lastmod))
+                    loc = lastmod = None
+                    root.clear()
+        if decompressor:
+            parser.feed(decompressor.flush())
+    parser.close()
+    return children
+
+
+def find_sitemaps(site_url: str, session: Optional[requests.Session] = None) -> List[str]:
+    """Reads the Sitemap: lines from robots.txt, falling back to /sitemap.xml."""
+    session = session or requests.Session()
+    try:
+        response = session.get(urljoin(site_url, "/robots.txt"), timeout=30)
+        if response.ok:
+            sitemaps = [line.split(":", 1)[1].strip() for line in response.text.splitlines()
+                        if line.lower().startswith("sitemap:")]
+            if sitemaps:
+                return sitemaps
+    except requests.RequestException as e:
+        print(f"Error reading robots.txt for {site_url}: {e}")
+    return [urljoin(site_url, "/sitemap.xml")]
+
+
+async def iter_sitemap_entries(sitemap_urls: Iterable[str], max_concurrent: int = 8,
+                               modified_since: Optional[datetime] = None,
+                               queue_size: int = 20) -> AsyncIterator[SitemapEntry]:
+    """
+    Yields every page in the given sitemaps, following sitemap indexes.
+
+    Child sitemaps are fetched concurrently (up to `max_concurrent` at a time) on
+    worker threads. Entries flow back in batches through a queue bounded to
+    `queue_size` batches, so a slow consumer holds the parsers back instead of
+    buffering whole sitemaps in memory. Entries whose lastmod is older than
+    `modified_since` are skipped.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=queue_size)
+    semaphore = asyncio.Semaphore(max_concurrent)
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=max_concurrent, pool_maxsize=max_concurrent)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    seen_sitemaps = set()
+    tasks = set()
+    closed = False
+    done = object()
+
+    def handoff(batch: List[SitemapEntry]):
+        if closed:
+            raise _Stopped()
+        # Blocks the parser thread while the queue is full
+        asyncio.run_coroutine_threadsafe(queue.put(batch), loop).result()
+
+    def parse(sitemap_url: str) -> List[str]:
+        batch = []
+
+        def on_entry(entry: SitemapEntry):
+            nonlocal batch
+            if modified_since is not None:
+                entry_modified = parse_lastmod(entry.lastmod)
+                if entry_modified is not None and entry_modified < modified_since:
+                    return
+            batch.append(entry)
+            if len(batch) >= BATCH_SIZE:
+                handoff(batch)
+                batch = []
+
+        children = fetch_sitemap(session, sitemap_url, on_entry)
+        if batch:
+            handoff(batch)
+        return children
+
+    async def process(sitemap_url: str):
+        async with semaphore:
+            try:
+                children = await asyncio.to_thread(parse, sitemap_url)
+            except _Stopped:
+                return
+            except (requests.RequestException, ElementTree.ParseError, zlib.error) as e:
+                print(f"Error fetching sitemap {sitemap_url}: {e}")
+                children = []
+        for child in children:
+            schedule(child)
+
+    def schedule(sitemap_url: str):
+        if sitemap_url in seen_sitemaps:
+            return
+        seen_sitemaps.add(sitemap_url)
+        task = asyncio.create_task(process(sitemap_url))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    async def supervise():
+        while tasks:
+            await asyncio.wait(set(tasks))
+        await queue.put(done)
+
+    for sitemap_url in sitemap_urls:
+        schedule(sitemap_url)
+    supervisor = asyncio.create_task(supervise())
+
+    try:
+        while True:
+            batch = await queue.get()
+            if batch is done:
+                break
+            for entry in batch:
+                yield entry
+    finally:
+        closed = True
+        supervisor.cancel()
+        # Unblock any parser thread still waiting on a full queue
+        while not queue.empty():
+            queue.get_nowait()
+        session.close()
@@ -0,0 +1,79 @@
+import os
+import re
+import codecs
+import asyncio
+from typing import Dict, List, NamedTuple, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+HTTP_USER_AGENT = os.environ.get(
+    "HTTP_USER_AGENT",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36",
+)
+# Fields a product needs before we trust a page that was not rendered in a browser
+REQUIRED_FIELDS = ("name", "price")
+
+# <meta charset="..."> or <meta http-equiv="Content-Type" content="...; charset=...">
+_META_CHARSET_RE = re.compile(rb"""<meta[^>]+charset\s*=\s*["']?\s*([A-Za-z0-9_.:-]+)""", re.IGNORECASE)
+
+
+def decode_html(response: requests.Response) -> str:
+    """
+    The text of an HTML response. Without a charset in the Content-Type header, requests
+    falls back to ISO-8859-1, which garbles UTF-8 and Arabic names, so the page's own
+    <meta charset> is used instead, or else the encoding detected from the bytes.
+    """
+    if "charset" in response.headers.get("content-type", "").lower():
+        return response.text
+    match = _META_CHARSET_RE.search(response.content[:4096])
+    encoding = None
+    if match:
+        try:
+            encoding = codecs.lookup(match.group(1).decode("ascii")).name
+        except LookupError:
+            pass
+    return response.content.decode(encoding or response.apparent_encoding or "utf-8", errors="replace")
+
+
+class StaticPage(NamedTuple):
+    url: str
+    status_code: int
+    html: str
+    headers: Dict[str, str]
+
+
+class StaticFetcher:
+    """
+    Pooled HTTP client for pages whose content is in the server-rendered HTML.
+
+    Requests go through one `requests.Session` with a connection pool sized for the
+    crawl's concurrency, and run on worker threads so they do not block the event loop.
+    """
+
+    def __init__(self, pool_size: int = 16, timeout: float = 30.0):
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers["User-Agent"] = HTTP_USER_AGENT
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _get(self, url: str, headers: Optional[Dict[str, str]]) -> StaticPage:
+        response = self.session.get(url, headers=headers, timeout=self.timeout)
+        html = decode_html(response) if response.status_code == 200 else ""
+        return StaticPage(response.url, response.status_code, html, {k.lower(): v for k, v in response.headers.items()})
+
+    async def fetch(self, url: str, headers: Optional[Dict[str, str]] = None) -> StaticPage:
+        return await asyncio.to_thread(self._get, url, headers)
+
+    def close(self):
+        self.session.close()
+
+
+def has_required_fields(product_data_list: List[dict]) -> bool:
+    """True if the first extracted product has every field the browser tier would be needed for."""
+    if not product_data_list:
+        return False
+    product_data = product_data_list[0]
+    return all(str(product_data.get(field) or "").strip() for field in REQUIRED_FIELDS)
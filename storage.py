@@ -0,0 +1,307 @@
+import os
+import glob
+import json
+import sqlite3
+import argparse
+import threading
+from abc import ABC, abstractmethod
+from typing import Callable, Dict, List, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Where crawled data is stored: "supabase", "sqlite" or "parquet". The local backends
+# write to STORAGE_PATH (a database file for SQLite, a directory for Parquet).
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "supabase").lower()
+STORAGE_PATH = os.environ.get("STORAGE_PATH")
+SUPABASE_URL = os.environ.get("SUPABASE_URL")
+SUPABASE_KEY = os.environ.get("SUPABASE_KEY")
+SYNC_BATCH_SIZE = 500
+# Rows read per request; PostgREST caps a response at 1000 rows by default
+SUPABASE_PAGE_SIZE = 1000
+
+
+class Storage(ABC):
+    """
+    Minimal table storage used by the crawlers and the agent.
+
+    Rows are plain dicts. `upsert` replaces rows whose `on_conflict` column matches,
+    `insert` always adds rows, and `select_all` returns every row of a table.
+    `select_since` returns the rows whose `column` is at or after `since`, to pick up
+    what changed after a timestamp column's last seen value.
+    """
+
+    @abstractmethod
+    def upsert(self, table: str, rows: List[dict], on_conflict: str) -> int:
+        ...
+
+    @abstractmethod
+    def insert(self, table: str, rows: List[dict]) -> int:
+        ...
+
+    @abstractmethod
+    def select_all(self, table: str) -> List[dict]:
+        ...
+
+    def select_since(self, table: str, column: str, since) -> List[dict]:
+        return [row for row in self.select_all(table) if row.get(column) is not None and row[column] >= since]
+
+    def close(self):
+        pass
+
+
+class SupabaseStorage(Storage):
+    """Tables in Supabase, through the PostgREST client."""
+
+    def __init__(self, url: Optional[str] = SUPABASE_URL, key: Optional[str] = SUPABASE_KEY):
+        if not url or not key:
+            raise ValueError("SUPABASE_URL and SUPABASE_KEY must be set to use the Supabase storage backend.")
+        from supabase import create_client
+        self.client = create_client(url, key)
+
+    def upsert(self, table: str, rows: List[dict], on_conflict: str) -> int:
+        if rows:
+            self.client.table(table).upsert(rows, on_conflict=on_conflict).execute()
+        return len(rows)
+
+    def insert(self, table: str, rows: List[dict]) -> int:
+        if rows:
+            self.client.table(table).insert(rows).execute()
+        return len(rows)
+
+    def _select_pages(self, query: Callable) -> List[dict]:
+        # Query builders are changed in place, so each page gets a fresh one from `query`.
+        # Pages are ordered on `id` last, so rows neither repeat nor go missing between them.
+        rows = []
+        while True:
+            start = len(rows)
+            page = query().order("id").range(start, start + SUPABASE_PAGE_SIZE - 1).execute().data
+            rows.extend(page)
+            if len(page) < SUPABASE_PAGE_SIZE:
+                return rows
+
+    def select_all(self, table: str) -> List[dict]:
+        return self._select_pages(lambda: self.client.table(table).select("*"))
+
+    def select_since(self, table: str, column: str, since) -> List[dict]:
+        return self._select_pages(lambda: self.client.table(table).select("*").gte(column, since).order(column))
+
+
+# ISO 8601 timestamps in UTC, which sort as text
+_NOW = "strftime('%Y-%m-%dT%H:%M:%fZ', 'now')"
+
+
+def _sql_type(value) -> str:
+    if isinstance(value, (bool, int)):
+        return "INTEGER"
+    if isinstance(value, float):
+        return "REAL"
+    return "TEXT"
+
+
+def _sql_value(value):
+    return json.dumps(value) if isinstance(value, (dict, list)) else value
+
+
+class SQLiteStorage(Storage):
+    """
+    Tables in a local SQLite database in WAL mode.
+
+    Tables and columns are created from the rows written to them, with an `id` and a
+    `created_at` column like the Supabase tables, and an indexed `updated_at` column set
+    on every insert and upsert. Batches are written with one
+    `executemany` per batch, upserting on a unique index over the conflict column.
+    The connection is shared across threads behind a lock.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or STORAGE_PATH or "crawl_data.db"
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.lock = threading.Lock()
+        self._columns: Dict[str, set] = {}
+
+    def _ensure_table(self, table: str, rows: List[dict], on_conflict: Optional[str] = None):
+        columns = self._columns.get(table)
+        if columns is None:
+            self.conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS "{table}" (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    created_at TEXT NOT NULL DEFAULT ({_NOW}),
+                    updated_at TEXT
+                )
+            """)
+            columns = {row[1] for row in self.conn.execute(f'PRAGMA table_info("{table}")')}
+            if "updated_at" not in columns:
+                # Tables written before updated_at was kept
+                self.conn.execute(f'ALTER TABLE "{table}" ADD COLUMN updated_at TEXT')
+                columns.add("updated_at")
+            self.conn.execute(f'CREATE INDEX IF NOT EXISTS "{table}_updated_at" ON "{table}" (updated_at)')
+            self._columns[table] = columns
+
+        for row in rows:
+            for name, value in row.items():
+                if name not in columns and value is not None:
+                    self.conn.execute(f'ALTER TABLE "{table}" ADD COLUMN "{name}" {_sql_type(value)}')
+                    columns.add(name)
+        for name in {name for row in rows for name in row} - columns:
+            # Only ever None so far, so there is no type to go by
+            self.conn.execute(f'ALTER TABLE "{table}" ADD COLUMN "{name}"')
+            columns.add(name)
+
+        if on_conflict:
+            if on_conflict not in columns:
+                self.conn.execute(f'ALTER TABLE "{table}" ADD COLUMN "{on_conflict}"')
+                columns.add(on_conflict)
+            self.conn.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS "{table}_{on_conflict}_key" ON "{table}" ("{on_conflict}")')
+
+    def _write(self, table: str, rows: List[dict], on_conflict: Optional[str]) -> int:
+        if not rows:
+            return 0
+        with self.lock, self.conn:
+            self._ensure_table(table, rows, on_conflict)
+            names = sorted({name for row in rows for name in row} - {"updated_at"})
+            column_list = ", ".join(f'"{name}"' for name in names + ["updated_at"])
+            placeholders = ", ".join(["?" for _ in names] + [_NOW])
+            sql = f'INSERT INTO "{table}" ({column_list}) VALUES ({placeholders})'
+            if on_conflict:
+                updates = ", ".join(f'"{name}" = excluded."{name}"' for name in names + ["updated_at"] if name != on_conflict)
+                sql += f' ON CONFLICT ("{on_conflict}") DO UPDATE SET {updates}'
+            self.conn.executemany(sql, [tuple(_sql_value(row.get(name)) for name in names) for row in rows])
+        return len(rows)
+
+    def upsert(self, table: str, rows: List[dict], on_conflict: str) -> int:
+        return self._write(table, rows, on_conflict)
+
+    def insert(self, table: str, rows: List[dict]) -> int:
+        return self._write(table, rows, None)
+
+    def select_all(self, table: str) -> List[dict]:
+        with self.lock:
+            try:
+                return [dict(row) for row in self.conn.execute(f'SELECT * FROM "{table}" ORDER BY id')]
+            except sqlite3.OperationalError:
+                return []  # nothing written yet
+
+    def select_since(self, table: str, column: str, since) -> List[dict]:
+        with self.lock:
+            try:
+                return [dict(row) for row in self.conn.execute(
+                    f'SELECT * FROM "{table}" WHERE "{column}" >= ? ORDER BY "{column}"', (since,))]
+            except sqlite3.OperationalError:
+                return []
+
+    def close(self):
+        self.conn.close()
+
+
+class ParquetStorage(Storage):
+    """
+    Tables as directories of Parquet files, written with pyarrow (`pip install pyarrow`).
+
+    Every batch becomes one new part file, so writes are append-only and run at disk
+    speed. Upserts are resolved on read: for each conflict key, the row from the latest
+    part wins. The conflict column of each table is kept in `_tables.json`.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError as e:
+            raise ImportError("The Parquet storage backend needs pyarrow: pip install pyarrow") from e
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.path = path or STORAGE_PATH or "crawl_data"
+        os.makedirs(self.path, exist_ok=True)
+        self.lock = threading.Lock()
+        self._meta_path = os.path.join(self.path, "_tables.json")
+        self._meta = {}
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path) as f:
+                self._meta = json.load(f)
+
+    def _parts(self, table: str) -> List[str]:
+        return sorted(glob.glob(os.path.join(self.path, table, "part-*.parquet")))
+
+    def _write(self, table: str, rows: List[dict], on_conflict: Optional[str]) -> int:
+        if not rows:
+            return 0
+        with self.lock:
+            if on_conflict and self._meta.get(table) != on_conflict:
+                self._meta[table] = on_conflict
+                with open(self._meta_path, "w") as f:
+                    json.dump(self._meta, f)
+            table_dir = os.path.join(self.path, table)
+            os.makedirs(table_dir, exist_ok=True)
+            parts = self._parts(table)
+            next_part = int(os.path.basename(parts[-1])[5:-8]) + 1 if parts else 0
+            path = os.path.join(table_dir, f"part-{next_part:08d}.parquet")
+            self.pq.write_table(self.pa.Table.from_pylist([{k: _sql_value(v) for k, v in row.items()} for row in rows]),
+                                f"{path}.tmp")
+            os.replace(f"{path}.tmp", path)
+        return len(rows)
+
+    def upsert(self, table: str, rows: List[dict], on_conflict: str) -> int:
+        return self._write(table, rows, on_conflict)
+
+    def insert(self, table: str, rows: List[dict]) -> int:
+        return self._write(table, rows, None)
+
+    def select_all(self, table: str) -> List[dict]:
+        rows = []
+        for part in self._parts(table):
+            rows.extend(self.pq.read_table(part).to_pylist())
+        key = self._meta.get(table)
+        if key:
+            rows = list({row.get(key): row for row in rows}.values())
+        return rows
+
+
+BACKENDS = {
+    "supabase": SupabaseStorage,
+    "sqlite": SQLiteStorage,
+    "parquet": ParquetStorage,
+}
+
+
+def get_storage(backend: Optional[str] = None) -> Storage:
+    """Creates the storage backend named by `backend` or STORAGE_BACKEND."""
+    backend = (backend or STORAGE_BACKEND).lower()
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown storage backend {backend!r}, expected one of: {', '.join(BACKENDS)}")
+    return BACKENDS[backend]()
+
+
+def sync(table: str, source_backend: str, on_conflict: Optional[str] = None):
+    """Copies a table from a local backend to Supabase, in batches."""
+    source = get_storage(source_backend)
+    target = SupabaseStorage()
+    try:
+        rows = source.select_all(table)
+        # Local bookkeeping columns are left for Supabase to fill in
+        rows = [{k: v for k, v in row.items() if k not in ("id", "created_at", "updated_at")} for row in rows]
+        for start in range(0, len(rows), SYNC_BATCH_SIZE):
+            batch = rows[start:start + SYNC_BATCH_SIZE]
+            if on_conflict:
+                target.upsert(table, batch, on_conflict=on_conflict)
+            else:
+                target.insert(table, batch)
+        print(f"Synced {len(rows)} rows of {table} from {source_backend} to Supabase.")
+    finally:
+        source.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Copy locally stored crawl data to Supabase.")
+    parser.add_argument("table", help="The table to sync, e.g. products or Data.")
+    parser.add_argument("--from", dest="source", choices=["sqlite", "parquet"],
+                        default=STORAGE_BACKEND if STORAGE_BACKEND != "supabase" else "sqlite",
+                        help="The local backend to read from (default: STORAGE_BACKEND, or sqlite).")
+    parser.add_argument("--on-conflict", default=None,
+                        help="Upsert on this column instead of inserting, e.g. url for products.")
+    args = parser.parse_args()
+    sync(args.table, args.source, args.on_conflict)
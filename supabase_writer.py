@@ -0,0 +1,217 @@
+import os
+import time
+import random
+import asyncio
+from typing import Callable, List, Optional
+
+# Rows per write, seconds a partial batch may wait, rows buffered before producers
+# are held back, and attempts per batch before it is given up on
+WRITE_BATCH_SIZE = int(os.environ.get("WRITE_BATCH_SIZE", "50"))
+WRITE_FLUSH_INTERVAL = float(os.environ.get("WRITE_FLUSH_INTERVAL", "2.0"))
+WRITE_QUEUE_SIZE = int(os.environ.get("WRITE_QUEUE_SIZE", "500"))
+WRITE_MAX_RETRIES = int(os.environ.get("WRITE_MAX_RETRIES", "5"))
+
+_CLOSE = object()
+
+
+class SupabaseWriter:
+    """
+    Background stage that writes rows in batches while the crawl keeps running.
+
+    Rows are handed over with `put()` and collected from a bounded queue into batches of
+    `batch_size`, or fewer once the oldest row has waited `flush_interval` seconds. Each
+    batch is written by the synchronous `write_batch` callable (typically a Supabase
+    upsert) on a worker thread, so the event loop never blocks on the database. Failed
+    writes are retried with exponential backoff and jitter. When the queue is full,
+    `put()` waits, which slows the crawler down to the speed of the database.
+
+    `on_written`, if given, is called on the event loop with every batch that was stored.
+    """
+
+    def __init__(self, write_batch: Callable[[List[dict]], Optional[int]], batch_size: int = WRITE_BATCH_SIZE,
+                 flush_interval: float = WRITE_FLUSH_INTERVAL, queue_size: int = WRITE_QUEUE_SIZE,
+                 max_retries: int = WRITE_MAX_RETRIES, backoff: float = 1.0,
+                 on_written: Optional[Callable[[List[dict]], None]] = None, label: str = "rows"):
+        self.write_batch = write_batch
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.max_retries = max(1, max_retries)
+        self.backoff = backoff
+        self.on_written = on_written
+        self.label = label
+        self.queue = asyncio.Queue(maxsize=max(queue_size, self.batch_size))
+        self._task = None
+
+        self.written = 0
+        self.failed = 0
+        self.batches = 0
+        self.retries = 0
+        self.write_time = 0.0
+        self.blocked_time = 0.0  # time producers spent waiting on a full queue
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def put(self, row: dict):
+        if self._task is None:
+            await self.start()
+        elif self._task.done():
+            self._task.result()  # surface the error that stopped the writer
+        if self.queue.full():
+            started = time.perf_counter()
+            await self.queue.put(row)
+            self.blocked_time += time.perf_counter() - started
+        else:
+            self.queue.put_nowait(row)
+            # Let the writer pick the row up even if the producer never awaits anything else
+            await asyncio.sleep(0)
+
+    async def close(self):
+        """Writes everything still queued and stops the writer."""
+        if self._task is None:
+            return
+        task, self._task = self._task, None
+        if not task.done():
+            await self.queue.put(_CLOSE)
+        await task
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if not batch else max(0.0, deadline - loop.time())
+            try:
+                row = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                await self._write(batch)
+                batch = []
+                continue
+
+            if row is _CLOSE:
+                if batch:
+                    await self._write(batch, final=True)
+                return
+            if not batch:
+                deadline = loop.time() + self.flush_interval
+            batch.append(row)
+            if len(batch) >= self.batch_size:
+                await self._write(batch)
+                batch = []
+
+    async def _write(self, batch: List[dict], final: bool = False):
+        for attempt in range(1, self.max_retries + 1):
+            started = time.perf_counter()
+            try:
+                sent = await asyncio.to_thread(self.write_batch, batch)
+            except Exception as e:
+                self.write_time += time.perf_counter() - started
+                if attempt == self.max_retries:
+                    print(f"Error writing batch of {len(batch)} {self.label}, giving up after {attempt} attempts: {e}")
+                    self.failed += len(batch)
+                    return
+                delay = self.backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+                print(f"Error writing batch of {len(batch)} {self.label} (attempt {attempt}/{self.max_retries}), retrying in {delay:.1f}s: {e}")
+                self.retries += 1
+                await asyncio.sleep(delay)
+                continue
+
+            self.write_time += time.perf_counter() - started
+            sent = len(batch) if sent is None else sent
+            self.written += sent
+            self.batches += 1
+            print(f"Stored {'final ' if final else ''}batch of {sent} {self.label}.")
+            if self.on_written is not None:
+                self.on_written(batch)
+            return
+
+    def print_stats(self):
+        print(f"  - Writer: {self.written} {self.label} in {self.batches} batches, {self.retries} retries, "
+              f"{self.failed} failed, {self.write_time:.1f}s writing, crawl held back {self.blocked_time:.1f}s")
+
+
+if __name__ == "__main__":
+    # Runs the writer through the Supabase client against a local stand-in for its REST
+    # endpoint that fails every few requests, and checks that every row is stored once,
+    # in batches no larger than the batch size, with `on_written` told about each row
+    import json
+    import sys
+    import argparse
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    from storage import SupabaseStorage
+
+    parser = argparse.ArgumentParser(description="Check SupabaseWriter against a local stand-in REST endpoint.")
+    parser.add_argument("--rows", type=int, default=1000, help="Rows to write.")
+    parser.add_argument("--batch-size", type=int, default=50, help="Rows per batch.")
+    parser.add_argument("--fail-every", type=int, default=3, help="Answer every Nth request with 503, 0 for never.")
+    parser.add_argument("--delay", type=float, default=0.01, help="Seconds the endpoint takes per request.")
+    args = parser.parse_args()
+
+    stored, batch_sizes, requests_seen = {}, [], [0]
+    lock = threading.Lock()
+
+    class StandIn(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            rows = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            time.sleep(args.delay)
+            with lock:
+                requests_seen[0] += 1
+                failing = args.fail_every and requests_seen[0] % args.fail_every == 0
+                if not failing:
+                    batch_sizes.append(len(rows))
+                    for row in rows:
+                        stored[row["url"]] = stored.get(row["url"], 0) + 1
+            body = json.dumps({"message": "stand-in failure"} if failing else rows).encode("utf-8")
+            self.send_response(503 if failing else 201)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    client = SupabaseStorage(f"http://127.0.0.1:{server.server_port}", "stand-in-key")
+    acknowledged = []
+
+    async def check():
+        writer = SupabaseWriter(lambda batch: client.upsert("products", batch, on_conflict="url"),
+                                batch_size=args.batch_size, flush_interval=0.2, queue_size=args.batch_size,
+                                backoff=0.05, on_written=lambda batch: acknowledged.extend(row["url"] for row in batch),
+                                label="rows")
+        started = time.perf_counter()
+        # A partial batch is written once it has waited flush_interval, without waiting for more rows
+        partial = max(1, args.batch_size // 2)
+        for i in range(partial):
+            await writer.put({"url": f"https://example.com/product/{i}", "name": f"Product {i}", "price": i})
+        await asyncio.sleep(1.0)
+        flushed_on_time = len(acknowledged) == partial
+        for i in range(partial, args.rows):
+            await writer.put({"url": f"https://example.com/product/{i}", "name": f"Product {i}", "price": i})
+        # The last, partial batch is written on close
+        await writer.close()
+        elapsed = time.perf_counter() - started
+        writer.print_stats()
+        return writer, flushed_on_time, elapsed
+
+    writer, flushed_on_time, elapsed = asyncio.run(check())
+    server.shutdown()
+    checks = [
+        ("every row stored", len(stored) == args.rows),
+        ("no row stored twice", all(count == 1 for count in stored.values())),
+        ("batches no larger than the batch size", max(batch_sizes, default=0) <= args.batch_size),
+        ("failed requests retried", writer.retries > 0 or not args.fail_every),
+        ("nothing given up on", writer.failed == 0),
+        ("on_written told about every row", sorted(acknowledged) == sorted(stored)),
+        ("partial batch flushed after the flush interval", flushed_on_time),
+        ("crawl held back while the queue was full", writer.blocked_time > 0),
+    ]
+    print(f"{args.rows} rows in {len(batch_sizes)} batches over {requests_seen[0]} requests, {elapsed:.2f}s:")
+    for name, passed in checks:
+        print(f"  {'ok' if passed else 'FAILED'}: {name}")
+    sys.exit(0 if all(passed for _, passed in checks) else 1)
@@ -0,0 +1,154 @@
+import os
+import sys
+import gzip
+from array import array
+from hashlib import blake2b
+from itertools import islice
+from typing import Iterable, Iterator, Optional
+from urllib.parse import parse_qsl, urlencode, urljoin, urlsplit, urlunsplit
+
+# Query parameters that never change the page content. Anything starting with "utm_" is dropped too.
+TRACKING_PARAMS = {
+    "gclid", "gbraid", "wbraid", "fbclid", "msclkid", "yclid", "dclid", "srsltid",
+    "mc_cid", "mc_eid", "_ga", "_gl", "igshid", "ref", "ref_src", "sessionid", "sid",
+}
+# Extra site-specific parameters to ignore, e.g. sort orders or view modes
+IGNORED_QUERY_PARAMS = {p.strip().lower() for p in os.environ.get("IGNORED_QUERY_PARAMS", "").split(",") if p.strip()}
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def canonicalize_url(url: str, base: Optional[str] = None) -> str:
+    """
+    Normalizes a URL so that trivially different spellings of the same page compare equal.
+
+    Resolves it against `base`, lowercases the scheme and host, drops default ports,
+    fragments, trailing slashes and tracking parameters, and sorts what is left of
+    the query string.
+    """
+    if base:
+        url = urljoin(base, url)
+    scheme, netloc, path, query, _ = urlsplit(url.strip())
+    scheme = scheme.lower()
+
+    host = netloc.lower()
+    if "@" in host:
+        host = host.rsplit("@", 1)[1]
+    if ":" in host and not host.endswith("]"):
+        hostname, _, port = host.rpartition(":")
+        if not port or (port.isdigit() and int(port) == DEFAULT_PORTS.get(scheme)):
+            host = hostname
+
+    while "//" in path:
+        path = path.replace("//", "/")
+    if len(path) > 1 and path.endswith("/"):
+        path = path.rstrip("/") or "/"
+    if not path:
+        path = "/"
+
+    if query:
+        params = [
+            (key, value) for key, value in parse_qsl(query, keep_blank_values=True)
+            if not key.lower().startswith("utm_")
+            and key.lower() not in TRACKING_PARAMS
+            and key.lower() not in IGNORED_QUERY_PARAMS
+        ]
+        query = urlencode(sorted(params))
+
+    return urlunsplit((scheme, host, path, query, ""))
+
+
+def iter_urls(source: str, offset: int = 0, limit: Optional[int] = None) -> Iterator[str]:
+    """
+    Streams URLs, one per line, from a file, a gzip-compressed file (`.gz`) or stdin (`-`).
+
+    Blank lines are skipped. `offset` and `limit` count URLs, so `--offset 1000000 --limit
+    1000000` is the second million of a file no matter how many blank lines it has.
+    """
+    if source == "-":
+        f = sys.stdin
+    elif source.endswith(".gz"):
+        f = gzip.open(source, "rt", encoding="utf-8")
+    else:
+        f = open(source, "r", encoding="utf-8")
+    try:
+        urls = (url for url in (line.strip() for line in f) if url)
+        yield from islice(urls, offset, None if limit is None else offset + limit)
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def url_fingerprint(url: str) -> int:
+    """64-bit hash of a URL; 0 is reserved to mark empty slots in FingerprintSet."""
+    return int.from_bytes(blake2b(url.encode("utf-8"), digest_size=8).digest(), "little") or 1
+
+
+class FingerprintSet:
+    """
+    Memory-compact set of URLs for million-page crawls.
+
+    Only a 64-bit fingerprint of each URL is kept, in an open-addressing hash table
+    backed by an `array('Q')`. That costs 8 bytes per slot (10-20 bytes per URL
+    depending on load) instead of the 100+ bytes a `set` of full URL strings needs.
+    The trade-off is that two different URLs can share a fingerprint, in which case
+    the second one is wrongly reported as already seen; `false_positive_rate()`
+    gives the current odds of that for the next lookup.
+    """
+
+    MAX_LOAD = 0.7
+
+    def __init__(self, urls: Iterable[str] = (), capacity: int = 1 << 10):
+        size = 1
+        while size < capacity:
+            size <<= 1
+        self._slots = array("Q", bytes(8 * size))
+        self._mask = size - 1
+        self._count = 0
+        for url in urls:
+            self.add(url)
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _find(self, fingerprint: int) -> int:
+        slots, mask = self._slots, self._mask
+        index = fingerprint & mask
+        while True:
+            slot = slots[index]
+            if slot == fingerprint or slot == 0:
+                return index
+            index = (index + 1) & mask
+
+    def __contains__(self, url: str) -> bool:
+        return self._slots[self._find(url_fingerprint(url))] != 0
+
+    def add(self, url: str) -> bool:
+        """Adds `url`. Returns False if it (or a URL with the same fingerprint) was already there."""
+        fingerprint = url_fingerprint(url)
+        index = self._find(fingerprint)
+        if self._slots[index]:
+            return False
+        self._slots[index] = fingerprint
+        self._count += 1
+        if self._count > self.MAX_LOAD * len(self._slots):
+            self._grow()
+        return True
+
+    def _grow(self):
+        old_slots = self._slots
+        self._slots = array("Q", bytes(16 * len(old_slots)))
+        self._mask = len(self._slots) - 1
+        for fingerprint in old_slots:
+            if fingerprint:
+                self._slots[self._find(fingerprint)] = fingerprint
+
+    def memory_bytes(self) -> int:
+        return sys.getsizeof(self._slots)
+
+    def bytes_per_url(self) -> float:
+        return self.memory_bytes() / self._count if self._count else 0.0
+
+    def false_positive_rate(self) -> float:
+        """Probability that a new, unseen URL collides with a stored fingerprint."""
+        return self._count / 2 ** 64
@@ -0,0 +1,307 @@
+import os
+import sys
+import time
+import socket
+import asyncio
+import sqlite3
+import argparse
+import threading
+from collections import deque
+from itertools import islice
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# The queue database, how long a worker may hold a URL before others can take it over,
+# how many times a URL is tried before it is dead-lettered, and the first retry delay
+WORK_QUEUE_FILE = os.environ.get("WORK_QUEUE_FILE", "work_queue.db")
+QUEUE_LEASE_SECONDS = float(os.environ.get("QUEUE_LEASE_SECONDS", "300"))
+QUEUE_MAX_ATTEMPTS = int(os.environ.get("QUEUE_MAX_ATTEMPTS", "3"))
+QUEUE_RETRY_DELAY = float(os.environ.get("QUEUE_RETRY_DELAY", "60"))
+ENQUEUE_CHUNK_SIZE = 10000
+
+
+def worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class WorkQueue:
+    """
+    Durable queue of URLs to crawl, shared by any number of extract workers.
+
+    Every URL is a row in `tasks` with a status: "pending" (waiting), "leased" (taken by
+    a worker until `visible_at`), "done" or "dead" (dead-lettered). `lease()` hands a
+    worker URLs nobody else holds, in one write transaction, so two workers never get
+    the same URL at the same time. A worker that crashes simply stops renewing its
+    leases: once `visible_at` passes, its URLs become visible again and are retried.
+    Failed URLs come back after an exponential backoff, and after `max_attempts` tries,
+    failed or abandoned, they are dead-lettered with the last error.
+
+    The database can be shared by workers on several machines through a network share,
+    as long as the share supports SQLite's file locking. The connection is shared across
+    threads behind a lock.
+    """
+
+    PENDING = "pending"
+    LEASED = "leased"
+    DONE = "done"
+    DEAD = "dead"
+
+    def __init__(self, path: str = WORK_QUEUE_FILE, max_attempts: int = QUEUE_MAX_ATTEMPTS):
+        self.path = path
+        self.max_attempts = max(1, max_attempts)
+        # Workers contend for the write lock, so wait for it rather than failing
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS tasks (
+                url TEXT PRIMARY KEY,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                owner TEXT,
+                visible_at REAL NOT NULL DEFAULT 0,
+                last_error TEXT,
+                updated_at REAL
+            );
+            CREATE INDEX IF NOT EXISTS tasks_ready ON tasks (status, visible_at);
+        """)
+        self.conn.commit()
+        self.lock = threading.Lock()
+
+    def enqueue(self, urls: Iterable[str]) -> int:
+        """Adds URLs that are not queued yet, streaming them in chunks. Returns how many were new."""
+        added = 0
+        urls = (url.strip() for url in urls)
+        while True:
+            chunk = list(islice(urls, ENQUEUE_CHUNK_SIZE))
+            if not chunk:
+                return added
+            chunk = [(url,) for url in chunk if url]
+            with self.lock, self.conn:
+                before = self.conn.total_changes
+                self.conn.executemany("INSERT OR IGNORE INTO tasks (url) VALUES (?)", chunk)
+                added += self.conn.total_changes - before
+
+    def lease(self, owner: str, limit: int, lease_seconds: float = QUEUE_LEASE_SECONDS) -> List[str]:
+        """Takes up to `limit` visible URLs for `owner` until `lease_seconds` from now."""
+        now = time.time()
+        with self.lock, self.conn:
+            # URLs whose workers kept disappearing are not handed out again
+            self.conn.execute("""
+                UPDATE tasks SET status = 'dead', owner = NULL, updated_at = ?,
+                    last_error = COALESCE(last_error, 'lease expired')
+                WHERE status = 'leased' AND visible_at <= ? AND attempts >= ?
+            """, (now, now, self.max_attempts))
+            rows = self.conn.execute("""
+                UPDATE tasks SET status = 'leased', owner = ?, attempts = attempts + 1, visible_at = ?, updated_at = ?
+                WHERE url IN (
+                    SELECT url FROM tasks WHERE status IN ('pending', 'leased') AND visible_at <= ?
+                    ORDER BY visible_at LIMIT ?
+                )
+                RETURNING url
+            """, (owner, now + lease_seconds, now, now, limit)).fetchall()
+        return [row[0] for row in rows]
+
+    def extend(self, urls: Iterable[str], owner: str, lease_seconds: float = QUEUE_LEASE_SECONDS) -> List[str]:
+        """Renews `owner`'s leases on URLs that are still being worked on; returns those still leased to it."""
+        now = time.time()
+        renewed = []
+        with self.lock, self.conn:
+            for url in urls:
+                cursor = self.conn.execute(
+                    "UPDATE tasks SET visible_at = ?, updated_at = ? WHERE url = ? AND owner = ? AND status = 'leased'",
+                    (now + lease_seconds, now, url, owner),
+                )
+                if cursor.rowcount:
+                    renewed.append(url)
+        return renewed
+
+    def complete(self, urls: Iterable[str]):
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "UPDATE tasks SET status = 'done', owner = NULL, last_error = NULL, updated_at = ? WHERE url = ? AND status != 'done'",
+                [(now, url) for url in urls],
+            )
+
+    def fail(self, failures: Iterable[Tuple[str, str]], retry_delay: float = QUEUE_RETRY_DELAY):
+        """Puts failed URLs back after a backoff that doubles per attempt, or dead-letters them."""
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.executemany("""
+                UPDATE tasks SET
+                    status = CASE WHEN attempts >= ? THEN 'dead' ELSE 'pending' END,
+                    visible_at = ? + ? * (1 << (attempts - 1)),
+                    owner = NULL, last_error = ?, updated_at = ?
+                WHERE url = ? AND status = 'leased'
+            """, [(self.max_attempts, now, retry_delay, error, now, url) for url, error in failures])
+
+    def dead_letter(self, failures: Iterable[Tuple[str, str]]):
+        """Gives up on URLs that no retry can fix, such as pages that no longer exist."""
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "UPDATE tasks SET status = 'dead', owner = NULL, last_error = ?, updated_at = ? WHERE url = ? AND status = 'leased'",
+                [(error, now, url) for url, error in failures],
+            )
+
+    def release(self, urls: Iterable[str], owner: str):
+        """Hands back leased URLs that were never started, without counting an attempt."""
+        with self.lock, self.conn:
+            self.conn.executemany("""
+                UPDATE tasks SET status = 'pending', owner = NULL, visible_at = 0, attempts = attempts - 1
+                WHERE url = ? AND owner = ? AND status = 'leased'
+            """, [(url, owner) for url in urls])
+
+    def requeue_dead(self) -> int:
+        with self.lock, self.conn:
+            return self.conn.execute(
+                "UPDATE tasks SET status = 'pending', attempts = 0, visible_at = 0 WHERE status = 'dead'"
+            ).rowcount
+
+    def counts(self) -> Dict[str, int]:
+        counts = {self.PENDING: 0, self.LEASED: 0, self.DONE: 0, self.DEAD: 0}
+        with self.lock:
+            counts.update(self.conn.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status").fetchall())
+        return counts
+
+    def dead_letters(self, limit: int = 20) -> List[Tuple[str, int, str]]:
+        with self.lock:
+            return self.conn.execute(
+                "SELECT url, attempts, last_error FROM tasks WHERE status = 'dead' ORDER BY updated_at DESC LIMIT ?", (limit,)
+            ).fetchall()
+
+    def close(self):
+        self.conn.close()
+
+
+class LeaseClient:
+    """
+    One crawl process's view of a WorkQueue, for use from the event loop.
+
+    `next()` hands out URLs one at a time from leases taken `batch_size` at a time.
+    Leases on URLs still being worked on are renewed in the background. When a URL is
+    finished, `settle()` marks it done, or failed if `fail()` was called for it (retried
+    later, or dead-lettered right away with `retry=False`). URLs
+    passed to `hand_off()` are finished by whoever stores their product, through
+    `complete()` or `WorkQueue.complete` in another process. Their leases keep being
+    renewed until then. Outcomes are buffered and written with the next lease.
+    """
+
+    def __init__(self, work_queue: WorkQueue, batch_size: int, owner: Optional[str] = None,
+                 lease_seconds: float = QUEUE_LEASE_SECONDS):
+        self.queue = work_queue
+        self.batch_size = max(1, batch_size)
+        self.owner = owner or worker_id()
+        self.lease_seconds = lease_seconds
+        self.leased = 0
+        self._local = deque()
+        self._held = set()
+        self._failures: Dict[str, Tuple[str, bool]] = {}
+        self._handed_off = set()
+        self._done: List[str] = []
+        self._failed: List[Tuple[str, str]] = []
+        self._dead: List[Tuple[str, str]] = []
+        self._lock = asyncio.Lock()
+        self._heartbeat = None
+
+    async def next(self) -> Optional[str]:
+        """The next URL to crawl, or None once the queue has nothing visible left."""
+        if self._heartbeat is None:
+            self._heartbeat = asyncio.create_task(self._renew())
+        async with self._lock:
+            if not self._local:
+                await self.flush()
+                urls = await asyncio.to_thread(self.queue.lease, self.owner, self.batch_size, self.lease_seconds)
+                self._local.extend(urls)
+                self._held.update(urls)
+                self.leased += len(urls)
+            return self._local.popleft() if self._local else None
+
+    def fail(self, url: str, error: str, retry: bool = True):
+        self._failures[url] = (error, retry)
+
+    def hand_off(self, url: str):
+        self._handed_off.add(url)
+
+    def settle(self, url: str):
+        failure = self._failures.pop(url, None)
+        if failure is not None:
+            error, retry = failure
+            (self._failed if retry else self._dead).append((url, error))
+        elif url in self._handed_off:
+            # Still held, so the lease is renewed while the product waits to be stored
+            return
+        else:
+            self._done.append(url)
+        self._held.discard(url)
+
+    def complete(self, urls: Iterable[str]):
+        """Marks handed-off URLs done once their products are stored."""
+        for url in urls:
+            self._handed_off.discard(url)
+            self._held.discard(url)
+            self._done.append(url)
+
+    async def flush(self):
+        done, self._done = self._done, []
+        failed, self._failed = self._failed, []
+        dead, self._dead = self._dead, []
+        if done:
+            await asyncio.to_thread(self.queue.complete, done)
+        if failed:
+            await asyncio.to_thread(self.queue.fail, failed)
+        if dead:
+            await asyncio.to_thread(self.queue.dead_letter, dead)
+
+    async def _renew(self):
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            held = list(self._held)
+            if held:
+                renewed = set(await asyncio.to_thread(self.queue.extend, held, self.owner, self.lease_seconds))
+                # Handed-off URLs that another process has stored are no longer ours to renew
+                for url in [url for url in held if url in self._handed_off and url not in renewed]:
+                    self._handed_off.discard(url)
+                    self._held.discard(url)
+
+    async def close(self):
+        """Writes buffered outcomes and hands back URLs that were leased but never started."""
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
+            self._heartbeat = None
+        await self.flush()
+        if self._local:
+            unstarted = list(self._local)
+            self._local.clear()
+            self._held.difference_update(unstarted)
+            await asyncio.to_thread(self.queue.release, unstarted, self.owner)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the shared queue that `extract --queue` workers pull URLs from.")
+    parser.add_argument("command", choices=["enqueue", "status", "retry-dead"],
+                        help="enqueue: add URLs from a file; status: show counts and recent dead letters; retry-dead: requeue dead-lettered URLs.")
+    parser.add_argument("file", nargs="?", default="product_urls.txt",
+                        help="URL file to enqueue, one URL per line, or - for stdin (default: product_urls.txt).")
+    parser.add_argument("--queue", default=WORK_QUEUE_FILE, help=f"Queue database (default: WORK_QUEUE_FILE or {WORK_QUEUE_FILE}).")
+    args = parser.parse_args()
+
+    work_queue = WorkQueue(args.queue)
+    try:
+        if args.command == "enqueue":
+            if args.file == "-":
+                added = work_queue.enqueue(sys.stdin)
+            else:
+                with open(args.file) as f:
+                    added = work_queue.enqueue(f)
+            print(f"Queued {added} new URLs in {args.queue}.")
+        elif args.command == "retry-dead":
+            print(f"Requeued {work_queue.requeue_dead()} dead-lettered URLs.")
+        counts = work_queue.counts()
+        print(", ".join(f"{status}: {count}" for status, count in counts.items()))
+        if args.command == "status" and counts[WorkQueue.DEAD]:
+            print("Most recent dead letters:")
+            for url, attempts, error in work_queue.dead_letters():
+                print(f"  {url} ({attempts} attempts): {error}")
+    finally:
+        work_queue.close()